@@ -2,21 +2,29 @@
 Utility functions to compute Cohen's Kappa/Fleiss' Kappa from a reliability matrix
 Allows for consistency in code with Krippendorff's Alpha
 
+The kappas are computed with the vectorized implementations of src/agreement/kappa.py, which also evaluate many
+pairs/groups of annotators at once (BatchedCohenKappa is used for agreement with leave-one-out aggregates and in
+permutation tests). Values that are missing or not one of the labels are not counted for Cohen's Kappa.
+
 NOTE: this is not used in the paper, but we provide it for completeness
 """
-from sklearn.metrics import cohen_kappa_score
-from statsmodels.stats.inter_rater import fleiss_kappa
+import numpy as np
+
+from src.agreement.kappa import cohen_kappa, fleiss_kappa
+
+
+def _values(reliability_matrix) -> np.ndarray:
+    return reliability_matrix.to_numpy() if hasattr(reliability_matrix, "to_numpy") else np.asarray(reliability_matrix)
 
 
-def cohen_kappa_reliability_matrix(labels, reliability_matrix):
+def cohen_kappa_reliability_matrix(labels, reliability_matrix, weighting=None):
+    """
+    :param weighting: None, "linear" or "quadratic", as in sklearn.metrics.cohen_kappa_score
+    """
     assert len(reliability_matrix) == 2, "reliability matrix must have 2 rows for Cohen's Kappa"
-    return cohen_kappa_score(reliability_matrix.iloc[0].to_list(), reliability_matrix.iloc[1].to_list(), 
-                             labels=labels)
+    values = _values(reliability_matrix)
+    return float(cohen_kappa(values[:1], values[1:], labels, weighting)[0])
 
 
 def fleiss_kappa_reliability_matrix(labels, reliability_matrix):
-    assert reliability_matrix.isna().sum().sum() == 0, "reliability matrix must be fully ranked for Fleiss Kappa"
-    fleiss_input_table_data = []
-    for col in reliability_matrix.columns:
-        fleiss_input_table_data.append([(reliability_matrix[col].dropna() == label).sum() for label in labels])
-    return fleiss_kappa(fleiss_input_table_data)
+    return fleiss_kappa(_values(reliability_matrix), labels)
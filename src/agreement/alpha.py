@@ -0,0 +1,164 @@
+"""
+Batched Krippendorff's alpha between pairs of rows
+
+Computing agreement with an aggregate calls krippendorff.alpha on a 2-row reliability matrix for every
+annotator, which recomputes the value domain, coincidence matrix and distance matrix each time.
+BatchedAlpha instead takes a stack of row pairs and computes all of the alphas at once, reusing the
+distance tables for a task. Results match krippendorff.alpha (level of measurement and value domain
+are read from the partial functions configured in src/config/agreement.py).
+"""
+from functools import lru_cache, partial
+from typing import Callable, Optional, Sequence
+
+import krippendorff
+import numpy as np
+
+
+SUPPORTED_LEVELS = {"nominal", "ordinal", "interval"}
+
+
+def _alpha_from_disagreement(observed: np.ndarray, expected: np.ndarray) -> np.ndarray:
+    # pairs without disagreement to expect (e.g., no pairable values) are NaN, as with krippendorff.alpha
+    out = np.full(observed.shape, np.nan)
+    np.divide(observed, expected, out=out, where=expected != 0)
+    return 1 - out
+
+
+class BatchedAlpha:
+    """
+    Krippendorff's alpha for many pairs of rows at once
+
+    Each pair is one row of `first` and the corresponding row of `second`; NaN marks a missing value.
+    """
+
+    def __init__(self, level_of_measurement: str = "interval", value_domain: Optional[Sequence] = None):
+        assert level_of_measurement in SUPPORTED_LEVELS, \
+            f"level of measurement must be one of {SUPPORTED_LEVELS}"
+        self.level_of_measurement = level_of_measurement
+        self.value_domain = None if value_domain is None else np.asarray(value_domain, dtype=float)
+        self._nominal_distances = None if self.value_domain is None else self._nominal_table(len(self.value_domain))
+
+    @staticmethod
+    def from_agreement_fn(agreement_fn: Callable) -> Optional["BatchedAlpha"]:
+        """
+        Create a batched kernel from an agreement function in PAIRWISE_AGREEMENT_FN_MAP,
+        or None if it is not a supported partial of krippendorff.alpha
+        """
+        if not isinstance(agreement_fn, partial) or agreement_fn.func is not krippendorff.alpha or agreement_fn.args:
+            return None
+        kwargs = agreement_fn.keywords
+        if set(kwargs) - {"level_of_measurement", "value_domain"} or \
+                kwargs.get("level_of_measurement", "interval") not in SUPPORTED_LEVELS:
+            return None
+        value_domain = kwargs.get("value_domain")
+        return BatchedAlpha._cached(kwargs.get("level_of_measurement", "interval"),
+                                    None if value_domain is None else tuple(np.asarray(value_domain, dtype=float)))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _cached(level_of_measurement: str, value_domain: Optional[tuple]) -> "BatchedAlpha":
+        # keyed by the parameters of the kernel rather than by the partial, which pool workers unpickle anew
+        # for every job
+        return BatchedAlpha(level_of_measurement, value_domain)
+
+    @staticmethod
+    def _nominal_table(n_values: int) -> np.ndarray:
+        return 1 - np.eye(n_values)
+
+    def __call__(self, first: np.ndarray, second: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        :param first: array of shape (n_pairs, n_items)
+        :param second: array of shape (n_pairs, n_items)
+        :param weights: optional array of shape (n_pairs, n_items) with the number of times each item is counted
+            (e.g., bootstrap resampling counts); an item with weight k gives the same alpha as k copies of it
+        :return: array of shape (n_pairs,) with alpha for each pair of rows
+        """
+        first = np.asarray(first, dtype=float)
+        second = np.asarray(second, dtype=float)
+        pairable = ~np.isnan(first) & ~np.isnan(second)
+        if self.value_domain is not None:
+            # values outside of the domain are not counted
+            pairable &= np.isin(first, self.value_domain) & np.isin(second, self.value_domain)
+        if weights is not None:
+            weights = np.broadcast_to(np.asarray(weights, dtype=float), pairable.shape)
+            pairable &= weights > 0
+
+        if self.level_of_measurement == "interval":
+            return self._interval(first, second, pairable, weights)
+        return self._categorical(first, second, pairable, weights)
+
+    @staticmethod
+    def _interval(first: np.ndarray, second: np.ndarray, pairable: np.ndarray,
+                  weights: Optional[np.ndarray] = None) -> np.ndarray:
+        # the squared difference metric reduces to sums over the pairable values, so no value domain is needed
+        weights = pairable if weights is None else np.where(pairable, weights, 0)
+        first = np.where(pairable, first, 0)
+        second = np.where(pairable, second, 0)
+        return BatchedAlpha.alpha_from_sums(2 * weights.sum(axis=1), (weights * (first + second)).sum(axis=1),
+                                            (weights * (first ** 2 + second ** 2)).sum(axis=1),
+                                            2 * (weights * (first - second) ** 2).sum(axis=1))
+
+    @staticmethod
+    def alpha_from_sums(n: np.ndarray, total: np.ndarray, total_sq: np.ndarray, observed: np.ndarray) -> np.ndarray:
+        """
+        Interval alpha of each pair from the sums over its pairable values
+        :param n: the number of pairable values (twice the number of pairable units)
+        :param total: the sum of the pairable values
+        :param total_sq: the sum of their squares
+        :param observed: twice the sum of squared differences within units
+        """
+        expected = 2 * (n * total_sq - total ** 2) / np.maximum(n - 1, 1)
+        return _alpha_from_disagreement(observed, expected)
+
+    def _categorical(self, first: np.ndarray, second: np.ndarray, pairable: np.ndarray,
+                     weights: Optional[np.ndarray] = None) -> np.ndarray:
+        value_domain = self.value_domain
+        if value_domain is None:
+            value_domain = np.unique(np.concatenate((first[pairable], second[pairable])))
+        n_values = len(value_domain)
+        n_pairs = len(first)
+
+        # coincidence matrix of each pair: every pairable unit adds (a, b) and (b, a)
+        pair_idx = np.broadcast_to(np.arange(n_pairs)[:, np.newaxis], pairable.shape)[pairable]
+        first_codes = np.searchsorted(value_domain, first[pairable])
+        second_codes = np.searchsorted(value_domain, second[pairable])
+        offsets = pair_idx * n_values * n_values
+        unit_weights = None if weights is None else weights[pairable]
+        coincidences = (
+            np.bincount(offsets + first_codes * n_values + second_codes, weights=unit_weights,
+                        minlength=n_pairs * n_values * n_values) +
+            np.bincount(offsets + second_codes * n_values + first_codes, weights=unit_weights,
+                        minlength=n_pairs * n_values * n_values)
+        ).reshape(n_pairs, n_values, n_values).astype(float)
+        return self.alpha_from_coincidences(coincidences)
+
+    def alpha_from_coincidences(self, coincidences: np.ndarray) -> np.ndarray:
+        """
+        Nominal or ordinal alpha of each pair from its coincidence matrix
+        :param coincidences: array of shape (n_pairs, n_values, n_values), over the kernel's value domain if it has
+            one (otherwise over the sorted values observed in the batch)
+        """
+        n_values = coincidences.shape[1]
+        n_v = coincidences.sum(axis=2)
+        n = n_v.sum(axis=1)
+        if self.level_of_measurement == "nominal":
+            distances = self._nominal_distances if self.value_domain is not None else self._nominal_table(n_values)
+            distances = np.broadcast_to(distances, coincidences.shape)
+        else:
+            distances = self._ordinal_distances(n_v)
+
+        expected_coincidences = (n_v[:, :, np.newaxis] * n_v[:, np.newaxis, :] -
+                                 n_v[:, :, np.newaxis] * np.eye(n_values)) / (n - 1)[:, np.newaxis, np.newaxis]
+        return _alpha_from_disagreement((coincidences * distances).sum(axis=(1, 2)),
+                                        (expected_coincidences * distances).sum(axis=(1, 2)))
+
+    @staticmethod
+    def _ordinal_distances(n_v: np.ndarray) -> np.ndarray:
+        # (sum of n_g for g between c and k - (n_c + n_k) / 2) ** 2
+        n_values = n_v.shape[1]
+        cumulative = np.concatenate((np.zeros((len(n_v), 1)), n_v.cumsum(axis=1)), axis=1)
+        indices = np.arange(n_values)
+        low = np.minimum(indices[:, np.newaxis], indices[np.newaxis, :])
+        high = np.maximum(indices[:, np.newaxis], indices[np.newaxis, :])
+        between = cumulative[:, high + 1] - cumulative[:, low]
+        return (between - (n_v[:, low] + n_v[:, high]) / 2) ** 2
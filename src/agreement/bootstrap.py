@@ -0,0 +1,192 @@
+"""
+Bootstrap confidence intervals for agreement with aggregates
+
+Items (columns of the reliability matrix) and/or annotators (within each demographic group) are resampled
+with replacement, and the means of the statistics of agreement_with_aggregate (F-ALL, F-ALLF, F-ALLM, M-ALL,
+M-ALLM, M-ALLF) are recomputed for every resample. Resampled matrices are never materialized:
+* a resample is a vector of counts per item and per annotator
+* item counts weight the coincidences of the alphas (an item drawn k times counts as k copies of it)
+* annotator counts weight the per-annotator statistics of AgreementPermutationTest in the group aggregates,
+  and the annotator's agreement in the means
+Resamples are drawn in independently seeded chunks, so results do not depend on the number of processes.
+"""
+from contextlib import ExitStack
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from src.agreement.demographic_agreement import aggregate_keys
+from src.agreement.permutation_test import DEFAULT_BLOCK_ELEMENTS, AgreementPermutationTest
+from src.util.shared_matrix import SharedHandle, SharedReliabilityMatrix, attach, detach
+from src.util.sparse_matrix import ReliabilityMatrix, SparseReliabilityMatrix, matrix_values
+
+
+RESAMPLING = ["items", "annotators", "both"]
+DEFAULT_CHUNK_SIZE = 100
+
+
+class BootstrapChunk(NamedTuple):
+    n_resamples: int
+    seed: np.random.SeedSequence
+
+
+def bootstrap_chunks(n_resamples: int, seed: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[BootstrapChunk]:
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    return [BootstrapChunk(size, chunk_seed)
+            for size, chunk_seed in zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes)))]
+
+
+class AgreementBootstrap(AgreementPermutationTest):
+    """
+    Means of the statistics of agreement_with_aggregate for weighted (resampled) items and annotators
+
+    Annotators keep their demographic labels, so the statistics of the relabeled groups in
+    AgreementPermutationTest become counts-weighted statistics of the actual groups.
+    """
+
+    def __init__(self, values: Union[np.ndarray, SparseReliabilityMatrix], group_rows: Dict[str, Sequence[int]],
+                 agreement_fn: Callable, aggregation: Callable = np.mean,
+                 block_elements: int = DEFAULT_BLOCK_ELEMENTS):
+        super().__init__(values, group_rows, agreement_fn, aggregation, block_elements)
+        self.keys = [key for dem in self.groups for key in aggregate_keys(dem)]
+        self.n_items = self.aggregator.n_items
+        self.group_sizes = [len(group_rows[dem]) for dem in self.groups]
+        # annotators outside of the groups only count towards the aggregate of all annotators (and are not resampled)
+        outside_stats = self.aggregator.total_stats - self.group_total
+        self.item_outside_stats = np.moveaxis(outside_stats[:, self.items], 1, 0)
+        # the statistics of all resamples in a block are held at once
+        self.block_size = max(1, self.block_size // 3)
+
+    def means(self, annotator_weights: np.ndarray, item_weights: np.ndarray) -> np.ndarray:
+        """
+        :param annotator_weights: array of shape (n_resamples, n_annotators) with the count of each annotator in
+            self.rows
+        :param item_weights: array of shape (n_resamples, n_items) with the count of each item
+        :return: array of shape (n_resamples, len(self.keys)) with the weighted mean of each statistic
+        """
+        means = [self._block_means(annotator_weights[start:start + self.block_size],
+                                   item_weights[start:start + self.block_size])
+                 for start in range(0, len(annotator_weights), self.block_size)]
+        return np.concatenate(means) if means else np.empty((0, len(self.keys)))
+
+    def _block_means(self, annotator_weights: np.ndarray, item_weights: np.ndarray) -> np.ndarray:
+        n_resamples, n_annotators = annotator_weights.shape
+        one_hot = self.labels[np.newaxis, :] == np.arange(len(self.groups))[:, np.newaxis]
+        group_stats = self._group_stats(one_hot[np.newaxis] * annotator_weights[:, np.newaxis, :])
+        # statistics at each annotator's items: (resamples, annotators, stats, items)
+        own_group_stats = group_stats[np.arange(n_resamples)[:, np.newaxis, np.newaxis, np.newaxis],
+                                      self.labels[np.newaxis, :, np.newaxis, np.newaxis],
+                                      np.arange(group_stats.shape[2])[np.newaxis, np.newaxis, :, np.newaxis],
+                                      self.items[np.newaxis, :, np.newaxis, :]]
+        item_group_total = np.moveaxis(group_stats.sum(axis=1)[:, :, self.items], 2, 1)
+        # every copy of an annotator is held out of its own aggregates
+        own_stats = annotator_weights[:, :, np.newaxis, np.newaxis] * self.item_stats[np.newaxis]
+        aggregates = (
+            self._aggregate(item_group_total + self.item_outside_stats - own_stats),
+            self._aggregate(own_group_stats - own_stats),
+            self._aggregate(item_group_total - own_group_stats),
+        )
+
+        width = self.items.shape[1]
+        annotations = np.broadcast_to(self.item_annotations, aggregates[0].shape).reshape(-1, width)
+        weights = item_weights[:, self.items].reshape(-1, width)
+        alphas = [self._alphas(aggregate.reshape(-1, width), annotations, weights).reshape(n_resamples, n_annotators)
+                  for aggregate in aggregates]
+
+        means = []
+        for group in range(len(self.groups)):
+            for values in alphas:
+                # NaNs are dropped, as in agreement_with_aggregate
+                counts = np.where((self.labels == group) & ~np.isnan(values), annotator_weights, 0)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    means.append((counts * np.nan_to_num(values)).sum(axis=1) / counts.sum(axis=1))
+        return np.stack(means, axis=1)
+
+    def observed(self) -> np.ndarray:
+        return self.means(np.ones((1, len(self.rows)), dtype=int), np.ones((1, self.n_items), dtype=int))[0]
+
+    def resample(self, chunk: BootstrapChunk, resampling: str = "both") -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (annotator weights, item weights) of the resamples in the chunk
+        """
+        assert resampling in RESAMPLING, f"resampling must be one of {RESAMPLING}"
+        rng = np.random.default_rng(chunk.seed)
+        annotator_weights = np.ones((chunk.n_resamples, len(self.rows)), dtype=int)
+        item_weights = np.ones((chunk.n_resamples, self.n_items), dtype=int)
+        if resampling in ("annotators", "both"):
+            # annotators are resampled within their group, so group sizes stay the same
+            annotator_weights = np.concatenate([rng.multinomial(size, np.full(size, 1 / size), chunk.n_resamples)
+                                                for size in self.group_sizes], axis=1)
+        if resampling in ("items", "both"):
+            item_weights = rng.multinomial(self.n_items, np.full(self.n_items, 1 / self.n_items), chunk.n_resamples)
+        return annotator_weights, item_weights
+
+    def chunk_means(self, chunk: BootstrapChunk, resampling: str = "both") -> np.ndarray:
+        return self.means(*self.resample(chunk, resampling))
+
+
+class _SharedBootstrapJob(NamedTuple):
+    matrix: SharedHandle
+    group_rows: Dict[str, np.ndarray]
+    agreement_fn: Callable
+    aggregation: Callable
+    resampling: str
+
+
+# the bootstrap built by a worker process for the most recent job
+_worker_bootstrap: Dict[str, Any] = {}
+
+
+def _shared_bootstrap_worker(job: _SharedBootstrapJob, chunk: BootstrapChunk) -> np.ndarray:
+    key = (job.matrix.name, job.aggregation, tuple((dem, rows.tobytes()) for dem, rows in job.group_rows.items()))
+    if _worker_bootstrap.get("key") != key:
+        # release the previous matrix before attaching to a new one
+        previous = _worker_bootstrap.pop("job", None)
+        _worker_bootstrap.clear()
+        if previous is not None and previous.matrix.name != job.matrix.name:
+            detach(previous.matrix)
+        _worker_bootstrap.update(key=key, job=job, bootstrap=AgreementBootstrap(
+            attach(job.matrix), job.group_rows, job.agreement_fn, job.aggregation))
+    return _worker_bootstrap["bootstrap"].chunk_means(chunk, job.resampling)
+
+
+def agreement_bootstrap(reliability_matrix: ReliabilityMatrix, demographics: Dict[str, List[str]],
+                        agreement_fn: Callable, aggregation: Callable = np.mean, n_resamples: int = 2000,
+                        resampling: str = "both", confidence: float = 0.95, seed: int = 123,
+                        mp_pool: Optional[Pool] = None,
+                        shared_matrix: Optional[SharedReliabilityMatrix] = None) -> pd.DataFrame:
+    """
+    Percentile bootstrap confidence intervals for the mean of each statistic of agreement_with_aggregate
+
+    When using a pool, the reliability matrix is published to shared memory (unless an already published
+    `shared_matrix` is passed) and workers receive chunks of resamples. Results do not depend on the pool.
+    :param resampling: resample "items", "annotators" (within each demographic group) or "both"
+    :return: DataFrame indexed by statistic with the observed mean and the bounds of its confidence interval
+    """
+    user_to_row = {user: i for i, user in enumerate(reliability_matrix.index)}
+    # rows are sorted, so that seeded results do not depend on the order of the annotators in `demographics`
+    group_rows = {dem: np.sort(np.array([user_to_row[user] for user in users], dtype=int))
+                  for dem, users in demographics.items()}
+    bootstrap = AgreementBootstrap(matrix_values(reliability_matrix), group_rows, agreement_fn, aggregation)
+    chunks = bootstrap_chunks(n_resamples, seed)
+    with ExitStack() as stack:
+        if mp_pool is not None:
+            if shared_matrix is None:
+                shared_matrix = stack.enter_context(SharedReliabilityMatrix(reliability_matrix))
+            job = _SharedBootstrapJob(shared_matrix.handle, group_rows, agreement_fn, aggregation, resampling)
+            chunk_means = mp_pool.starmap(_shared_bootstrap_worker, [(job, chunk) for chunk in chunks])
+        else:
+            chunk_means = [bootstrap.chunk_means(chunk, resampling)
+                           for chunk in tqdm(chunks, desc="Bootstrap chunks", leave=False)]
+    means = np.concatenate(chunk_means)
+
+    tail = 100 * (1 - confidence) / 2
+    return pd.DataFrame({
+        "mean": bootstrap.observed(),
+        "lower": np.nanpercentile(means, tail, axis=0),
+        "upper": np.nanpercentile(means, 100 - tail, axis=0),
+        "resamples": (~np.isnan(means)).sum(axis=0),
+    }, index=pd.Index(bootstrap.keys, name="statistic"))
@@ -2,14 +2,22 @@
 Functions for computing agreement between demographic groups
 """
 from collections import defaultdict
+from contextlib import ExitStack
 from multiprocessing import Pool
-from typing import Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 from more_itertools import flatten
 from tqdm import tqdm
 
+from src.agreement.kappa import batched_kernel
+from src.agreement.leave_one_out import LEAVE_ONE_OUT_AGGREGATIONS, LeaveOneOutAggregator
+from src.util.checkpoint import Checkpoint
+from src.util.scheduler import Chunk, balanced_chunks, default_n_chunks, imap_balanced
+from src.util.shared_matrix import SharedHandle, SharedReliabilityMatrix, attach, detach
+from src.util.sparse_matrix import ReliabilityMatrix, as_sparse, matrix_values
+
 
 def _agreement_with_aggregate_computation(aggregate, user_annotations, agreement_fn: Callable, 
                                           integer_aggregate: bool):
@@ -42,20 +50,134 @@ def _agreement_with_aggregate_helper(reliability_matrix: pd.DataFrame, demograph
     # for ordinal aggregate when using medians - use this when aggregation is not mean
     integer_aggregate = aggregation != np.mean
 
-    same_str = "ALLF" if dem == "F" else "ALLM"
-    oth_str = "ALLF" if dem == "M" else "ALLM"
+    all_str, same_str, oth_str = aggregate_keys(dem)
 
     return {
-        f"{dem}-ALL": _agreement_with_aggregate_computation(aggregated, user_annotations, agreement_fn, integer_aggregate),
-        f"{dem}-{same_str}": _agreement_with_aggregate_computation(in_group_aggregate, user_annotations, agreement_fn, integer_aggregate),
-        f"{dem}-{oth_str}": _agreement_with_aggregate_computation(oo_group_aggregate, user_annotations, agreement_fn, integer_aggregate)
+        all_str: _agreement_with_aggregate_computation(aggregated, user_annotations, agreement_fn, integer_aggregate),
+        same_str: _agreement_with_aggregate_computation(in_group_aggregate, user_annotations, agreement_fn, integer_aggregate),
+        oth_str: _agreement_with_aggregate_computation(oo_group_aggregate, user_annotations, agreement_fn, integer_aggregate)
     }
 
-def agreement_with_aggregate(reliability_matrix: pd.DataFrame, demographics: Dict[str, str], 
+
+def aggregate_keys(dem: str) -> Tuple[str, str, str]:
+    same_str = "ALLF" if dem == "F" else "ALLM"
+    oth_str = "ALLF" if dem == "M" else "ALLM"
+    return f"{dem}-ALL", f"{dem}-{same_str}", f"{dem}-{oth_str}"
+
+
+def _leave_one_out_helper(user_annotations: pd.Series, aggregates: Dict[str, pd.Series], 
+                          agreement_fn: Callable, integer_aggregate: bool):
+    return {k: _agreement_with_aggregate_computation(aggregate, user_annotations, agreement_fn, integer_aggregate)
+            for k, aggregate in aggregates.items()}
+
+
+def _leave_one_out_inputs(aggregator: LeaveOneOutAggregator, row: int, dem: str, agreement_fn: Callable, 
+                          integer_aggregate: bool):
+    # only items annotated by the user are used when computing agreement, so the rest are dropped here
+    user_annotations = aggregator.annotations(row)
+    items = np.flatnonzero(~np.isnan(user_annotations))
+    aggregates = {k: pd.Series(aggregate[items], index=items) 
+                  for k, aggregate in zip(aggregate_keys(dem), aggregator.aggregates(row, dem))}
+    return pd.Series(user_annotations[items], index=items), aggregates, agreement_fn, integer_aggregate
+
+
+def _batched_leave_one_out_helper(aggregator: LeaveOneOutAggregator, rows: List[int], dem: str, 
+                                  kernel: Callable, integer_aggregate: bool) -> List[Dict[str, float]]:
+    """
+    Compute agreement of several users in a group with their leave-one-out aggregates with a single kernel call
+    """
+    # rows only hold the items annotated by each user, padded with NaN to the longest row of the matrix (a width that
+    # does not depend on the rows of the batch, so that the kernel's sums do not depend on how rows are chunked)
+    user_items = [np.flatnonzero(~np.isnan(aggregator.annotations(row))) for row in rows]
+    width = int(aggregator.matrix.row_lengths().max(initial=0))
+    annotations = np.full((len(rows), width), np.nan)
+    aggregates = np.full((3, len(rows), width), np.nan)
+    for i, (row, items) in enumerate(zip(rows, user_items)):
+        annotations[i, :len(items)] = aggregator.annotations(row)[items]
+        for j, aggregate in enumerate(aggregator.aggregates(row, dem)):
+            aggregates[j, i, :len(items)] = aggregate[items]
+
+    annotations = np.tile(annotations, (3, 1))
+    aggregates = aggregates.reshape(3 * len(rows), width)
+    if integer_aggregate:
+        # same as _agreement_with_aggregate_computation: mean of agreement with rounded up/down aggregates
+        alphas = (kernel(np.ceil(aggregates), annotations) + kernel(np.floor(aggregates), annotations)) / 2
+    else:
+        alphas = kernel(aggregates, annotations)
+    alphas = alphas.reshape(3, len(rows))
+
+    keys = aggregate_keys(dem)
+    return [{k: alphas[j, i] for j, k in enumerate(keys)} for i in range(len(rows))]
+
+
+def _leave_one_out_rows(aggregator: LeaveOneOutAggregator, rows: List[int], dem: str, agreement_fn: Callable, 
+                        integer_aggregate: bool) -> List[Dict[str, float]]:
+    kernel = batched_kernel(agreement_fn)
+    if kernel is not None:
+        return _batched_leave_one_out_helper(aggregator, rows, dem, kernel, integer_aggregate)
+    return [_leave_one_out_helper(*_leave_one_out_inputs(aggregator, row, dem, agreement_fn, integer_aggregate))
+            for row in rows]
+
+
+class _SharedLeaveOneOutJob(NamedTuple):
+    matrix: SharedHandle
+    group_rows: Dict[str, np.ndarray]
+    aggregation: Callable
+    agreement_fn: Callable
+
+
+# the aggregator built by a worker process for the most recent job
+_worker_aggregator: Dict[str, Any] = {}
+
+
+def _shared_leave_one_out_worker(job: _SharedLeaveOneOutJob, dem: str, rows: List[int]) -> List[Dict[str, float]]:
+    key = (job.matrix.name, job.aggregation, tuple((dem, rows.tobytes()) for dem, rows in job.group_rows.items()))
+    if _worker_aggregator.get("key") != key:
+        # release the previous matrix before attaching to a new one
+        previous = _worker_aggregator.pop("job", None)
+        _worker_aggregator.clear()
+        if previous is not None and previous.matrix.name != job.matrix.name:
+            detach(previous.matrix)
+        _worker_aggregator.update(key=key, job=job, aggregator=LeaveOneOutAggregator(
+            attach(job.matrix), job.group_rows, job.aggregation))
+    return _leave_one_out_rows(_worker_aggregator["aggregator"], rows, dem, job.agreement_fn, 
+                               job.aggregation != np.mean)
+
+
+class _AggregateJob(NamedTuple):
+    reliability_matrix: pd.DataFrame
+    demographics: Dict[str, List[str]]
+    agreement_fn: Callable
+    aggregation: Callable
+
+
+def _agreement_with_aggregate_rows(job: _AggregateJob, dem: str, rows: List[int]) -> List[Dict[str, float]]:
+    users = job.reliability_matrix.index
+    return [_agreement_with_aggregate_helper(job.reliability_matrix, job.demographics, users[row], dem,
+                                             job.demographics[dem], job.agreement_fn, job.aggregation)
+            for row in rows]
+
+
+def _annotation_counts(reliability_matrix: ReliabilityMatrix) -> np.ndarray:
+    if isinstance(reliability_matrix, pd.DataFrame):
+        return reliability_matrix.notna().sum(axis=1).to_numpy()
+    return as_sparse(reliability_matrix).row_lengths()
+
+
+def agreement_with_aggregate(reliability_matrix: ReliabilityMatrix, demographics: Dict[str, str], 
                              agreement_fn: Callable, aggregation: Callable = np.mean,
-                             mp_pool: Optional[Pool] = None):
+                             mp_pool: Optional[Pool] = None, 
+                             shared_matrix: Optional[SharedReliabilityMatrix] = None, n_chunks: Optional[int] = None,
+                             checkpoint: Optional[Checkpoint] = None):
     """
     Following general method from https://arxiv.org/pdf/2110.05699.pdf
+
+    The reliability matrix may be a SparseReliabilityMatrix or CodedReliabilityMatrix, which is only densified for
+    aggregations that are not in LEAVE_ONE_OUT_AGGREGATIONS. When using a pool, the reliability matrix is published to
+    shared memory (unless an already published `shared_matrix` is passed), and the annotators of all groups are
+    submitted at once in about `n_chunks` chunks of similar cost (src/util/scheduler.py).
+    With a checkpoint (src/util/checkpoint.py), the results of completed chunks are saved periodically, and the
+    annotators whose results are in the checkpoint are not computed again.
     """
 
     # 6 results:
@@ -66,18 +188,53 @@ def agreement_with_aggregate(reliability_matrix: pd.DataFrame, demographics: Dic
     # F-ALL: how much do females agree with full aggregate
     # M-ALL: how much do males agree with full aggregate
 
-    # compute M/F agreement with full aggregation
-    demographic_results = defaultdict(list)
-    for dem, users in tqdm(demographics.items(), desc="Demographics loop"):
+    # group statistics are computed once, rather than re-aggregating the matrix for each annotator
+    use_leave_one_out = aggregation in LEAVE_ONE_OUT_AGGREGATIONS
+    if not use_leave_one_out and not isinstance(reliability_matrix, pd.DataFrame):
+        # other aggregations re-aggregate the dense matrix for each annotator
+        reliability_matrix = reliability_matrix.to_dense()
+    user_to_row = {user: i for i, user in enumerate(reliability_matrix.index)}
+    group_rows = {dem: np.array([user_to_row[user] for user in users], dtype=int) 
+                  for dem, users in demographics.items()}
+
+    with ExitStack() as stack:
+        if use_leave_one_out and mp_pool is not None:
+            # workers attach to a single shared copy of the matrix and only receive annotator rows
+            if shared_matrix is None:
+                shared_matrix = stack.enter_context(SharedReliabilityMatrix(reliability_matrix))
+            job, worker = _SharedLeaveOneOutJob(shared_matrix.handle, group_rows, aggregation, agreement_fn), \
+                _shared_leave_one_out_worker
+        elif use_leave_one_out:
+            aggregator = LeaveOneOutAggregator(matrix_values(reliability_matrix), group_rows, aggregation)
+        else:
+            job, worker = _AggregateJob(reliability_matrix, demographics, agreement_fn, aggregation), \
+                _agreement_with_aggregate_rows
+
+        # results of the annotators already done (in a resumed checkpoint), by "{dem}/{row}"
+        row_results = checkpoint.state.setdefault("results", {}) if checkpoint is not None else {}
+        remaining = {dem: [row for row in rows.tolist() if f"{dem}/{row}" not in row_results]
+                     for dem, rows in group_rows.items()}
+        chunks = balanced_chunks(remaining, _annotation_counts(reliability_matrix) + 1, n_chunks or default_n_chunks())
         if mp_pool is None:
-            results = [_agreement_with_aggregate_helper(reliability_matrix, demographics, user, dem, users, 
-                                                        agreement_fn, aggregation) for user in users]
+            def run(chunk: Chunk) -> List[Dict[str, float]]:
+                if use_leave_one_out:
+                    return _leave_one_out_rows(aggregator, chunk.rows, chunk.group, agreement_fn,
+                                               aggregation != np.mean)
+                return _agreement_with_aggregate_rows(job, chunk.group, chunk.rows)
+            completed = ((chunk, run(chunk)) for chunk in chunks)
         else:
-            inputs = [(reliability_matrix, demographics, user, dem, users, agreement_fn, aggregation)
-                    for user in users]
-            results = mp_pool.starmap(_agreement_with_aggregate_helper, inputs)
+            # the annotators of all groups are scheduled at once, so the pool is not idle between groups
+            completed = imap_balanced(mp_pool, worker, chunks, job)
+        for chunk, results in tqdm(completed, total=len(chunks), desc="Agreement chunks"):
+            row_results.update({f"{chunk.group}/{row}": result for row, result in zip(chunk.rows, results)})
+            if checkpoint is not None:
+                checkpoint.maybe_save()
+        group_results = {dem: [row_results[f"{dem}/{row}"] for row in group_rows[dem]] for dem in demographics}
 
-        for result in results:
+    # compute M/F agreement with full aggregation
+    demographic_results = defaultdict(list)
+    for dem in demographics:
+        for result in group_results[dem]:
             for k, v in result.items():
                 # filter NaNs, which occur when there are no other annotators with the same gender 
                 # or there are no annotators with the other gender
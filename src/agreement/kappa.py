@@ -0,0 +1,162 @@
+"""
+Vectorized Cohen's and Fleiss' kappa
+
+Labels are coded as their positions in `labels`, and the count tables of a whole batch (the confusion matrices of
+many pairs of rows for Cohen's kappa, the item x label tables of many groups of raters for Fleiss' kappa) are built
+with a single np.bincount over a flattened (batch, ..., label) index. Results match sklearn's cohen_kappa_score and
+statsmodels' fleiss_kappa for the same labels.
+"""
+from functools import lru_cache, partial
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+
+WEIGHTINGS = {None, "linear", "quadratic"}
+
+
+def label_codes(values: np.ndarray, labels: Sequence) -> np.ndarray:
+    """
+    :return: the position of each value in `labels`, or -1 for missing values and values that are not labels
+    """
+    try:
+        values = np.asarray(values, dtype=float)
+        labels = np.asarray(labels, dtype=float)
+    except (TypeError, ValueError):
+        # non-numeric labels (e.g. strings) are looked up one value at a time
+        positions = {label: position for position, label in enumerate(labels)}
+        return np.vectorize(lambda value: positions.get(value, -1), otypes=[int])(values)
+    order = np.argsort(labels, kind="stable")
+    positions = np.clip(np.searchsorted(labels[order], values), 0, len(labels) - 1)
+    found = labels[order][positions] == values
+    return np.where(found, order[positions], -1)
+
+
+def _safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    out = np.full(np.shape(numerator), np.nan)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def cohen_kappa(first: np.ndarray, second: np.ndarray, labels: Sequence, weighting: Optional[str] = None,
+                weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Cohen's kappa between each row of `first` and the corresponding row of `second`
+
+    Items where either value is missing (NaN) or not one of the labels are not counted.
+    :param first: array of shape (n_pairs, n_items)
+    :param second: array of shape (n_pairs, n_items)
+    :param weighting: None, "linear" or "quadratic" disagreement weights between label positions (as in sklearn)
+    :param weights: optional array of shape (n_pairs, n_items) with the number of times each item is counted
+    :return: array of shape (n_pairs,); NaN where no disagreement is expected
+    """
+    assert weighting in WEIGHTINGS, f"weighting must be one of {WEIGHTINGS}"
+    first_codes = label_codes(np.atleast_2d(first), labels)
+    second_codes = label_codes(np.atleast_2d(second), labels)
+    counted = (first_codes >= 0) & (second_codes >= 0)
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), counted.shape)
+        counted &= weights > 0
+
+    n_pairs, n_labels = len(first_codes), len(labels)
+    pair_idx = np.broadcast_to(np.arange(n_pairs)[:, np.newaxis], counted.shape)[counted]
+    flat_idx = (pair_idx * n_labels + first_codes[counted]) * n_labels + second_codes[counted]
+    confusion = np.bincount(flat_idx, weights=None if weights is None else weights[counted],
+                            minlength=n_pairs * n_labels * n_labels).reshape(n_pairs, n_labels, n_labels)
+    return kappa_from_confusion(confusion, weighting)
+
+
+def kappa_from_confusion(confusion: np.ndarray, weighting: Optional[str] = None) -> np.ndarray:
+    """
+    Cohen's kappa of each pair from its confusion matrix
+    :param confusion: array of shape (n_pairs, n_labels, n_labels), counts of (first label, second label)
+    """
+    n_labels = confusion.shape[1]
+    first_marginals = confusion.sum(axis=2)
+    second_marginals = confusion.sum(axis=1)
+    totals = first_marginals.sum(axis=1)
+    expected = _safe_divide(first_marginals[:, :, np.newaxis] * second_marginals[:, np.newaxis, :],
+                            totals[:, np.newaxis, np.newaxis])
+
+    positions = np.arange(n_labels)
+    if weighting is None:
+        disagreement = 1 - np.eye(n_labels)
+    elif weighting == "linear":
+        disagreement = np.abs(positions[:, np.newaxis] - positions[np.newaxis, :])
+    else:
+        disagreement = (positions[:, np.newaxis] - positions[np.newaxis, :]) ** 2
+    return 1 - _safe_divide((disagreement * confusion).sum(axis=(1, 2)), (disagreement * expected).sum(axis=(1, 2)))
+
+
+def fleiss_kappa(values: np.ndarray, labels: Sequence) -> np.ndarray:
+    """
+    Fleiss' kappa of each group of raters
+
+    :param values: array of shape (n_groups, n_raters, n_items), or (n_raters, n_items) for a single group. Every
+        rater must have rated every item with one of the labels.
+    :return: array of shape (n_groups,) (a float for a single group); NaN where no disagreement is expected
+    """
+    values = np.asarray(values)
+    single = values.ndim == 2
+    codes = label_codes(values[np.newaxis] if single else values, labels)
+    assert (codes >= 0).all(), "reliability matrix must be fully ranked (with labels only) for Fleiss Kappa"
+
+    n_groups, n_raters, n_items = codes.shape
+    n_labels = len(labels)
+    # item x label counts of each group
+    item_idx = np.broadcast_to(np.arange(n_items), codes.shape)
+    group_idx = np.broadcast_to(np.arange(n_groups)[:, np.newaxis, np.newaxis], codes.shape)
+    table = np.bincount(((group_idx * n_items + item_idx) * n_labels + codes).ravel(),
+                        minlength=n_groups * n_items * n_labels).reshape(n_groups, n_items, n_labels).astype(float)
+
+    label_proportions = table.sum(axis=1) / (n_items * n_raters)
+    item_agreement = ((table ** 2).sum(axis=2) - n_raters) / (n_raters * (n_raters - 1.))
+    observed = item_agreement.mean(axis=1)
+    expected = (label_proportions ** 2).sum(axis=1)
+    kappas = _safe_divide(observed - expected, 1 - expected)
+    return float(kappas[0]) if single else kappas
+
+
+class BatchedCohenKappa:
+    """
+    Cohen's kappa for many pairs of rows at once, with the same interface as BatchedAlpha (src/agreement/alpha.py)
+    """
+
+    def __init__(self, labels: Sequence, weighting: Optional[str] = None):
+        self.labels = list(labels)
+        self.weighting = weighting
+
+    @staticmethod
+    def from_agreement_fn(agreement_fn: Callable) -> Optional["BatchedCohenKappa"]:
+        """
+        Create a batched kernel from a partial of cohen_kappa_reliability_matrix (src/agreement/agreement_utils.py)
+        with its labels, or None for other agreement functions
+        """
+        # imported here, as agreement_utils builds on this module
+        from src.agreement.agreement_utils import cohen_kappa_reliability_matrix
+
+        if not isinstance(agreement_fn, partial) or agreement_fn.func is not cohen_kappa_reliability_matrix or \
+                len(agreement_fn.args) != 1 or set(agreement_fn.keywords) - {"weighting"}:
+            return None
+        return BatchedCohenKappa._cached(tuple(agreement_fn.args[0]), agreement_fn.keywords.get("weighting"))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _cached(labels: tuple, weighting: Optional[str]) -> "BatchedCohenKappa":
+        # keyed by the parameters of the kernel rather than by the partial (see BatchedAlpha._cached)
+        return BatchedCohenKappa(labels, weighting)
+
+    def __call__(self, first: np.ndarray, second: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        return cohen_kappa(first, second, self.labels, self.weighting, weights)
+
+
+def batched_kernel(agreement_fn: Callable) -> Optional[Callable]:
+    """
+    A kernel computing agreement_fn for many pairs of rows at once (BatchedAlpha or BatchedCohenKappa), or None
+    if the agreement function has no batched implementation
+    """
+    # imported here, so that kappa users do not need krippendorff
+    from src.agreement.alpha import BatchedAlpha
+
+    kernel = BatchedAlpha.from_agreement_fn(agreement_fn)
+    return kernel if kernel is not None else BatchedCohenKappa.from_agreement_fn(agreement_fn)
@@ -0,0 +1,178 @@
+"""
+Leave-one-out aggregates for computing agreement with aggregate
+
+Rather than re-aggregating the reliability matrix for every annotator, per-item statistics are
+computed once per demographic group. The "everyone but me" and "my group but me" aggregates are
+then obtained by subtracting the held-out annotator's own annotations from those statistics.
+
+* mean: the statistics are item sums and counts
+* median/mode: the statistics are per-item label count histograms, so no re-sorting is needed
+Statistics are accumulated from the annotations only (see src/util/sparse_matrix.py), so sparse reliability
+matrices are never densified.
+"""
+from typing import Callable, Dict, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from src.util.sparse_matrix import SparseReliabilityMatrix, as_sparse
+
+
+def mode_aggregation(x):
+    # scipy.stats is slow to import and only needed when the mode is not computed by LeaveOneOutAggregator
+    from scipy.stats import mode
+    return mode(x).mode[0]
+
+
+def _safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    # items with no annotations left after holding out an annotator are NaN, as with the mean of an empty column
+    out = np.full(numerator.shape, np.nan)
+    np.divide(numerator, denominator, out=out, where=denominator > 0)
+    return out
+
+
+def _mean_from_sums(stats: np.ndarray, value_domain: np.ndarray) -> np.ndarray:
+    return _safe_divide(stats[0], stats[1])
+
+
+def _median_from_histogram(stats: np.ndarray, value_domain: np.ndarray) -> np.ndarray:
+    # same as np.nanmedian: the mean of the two middle values when an item has an even number of annotations
+    counts = stats.sum(axis=0)
+    cumulative = stats.cumsum(axis=0)
+    lower = (cumulative <= (counts - 1) // 2).sum(axis=0)
+    upper = (cumulative <= counts // 2).sum(axis=0)
+    median = (value_domain[np.minimum(lower, len(value_domain) - 1)] +
+              value_domain[np.minimum(upper, len(value_domain) - 1)]) / 2
+    return np.where(counts > 0, median, np.nan)
+
+
+def _mode_from_histogram(stats: np.ndarray, value_domain: np.ndarray) -> np.ndarray:
+    # argmax returns the first maximum, so ties go to the smallest label (as with scipy.stats.mode)
+    return np.where(stats.sum(axis=0) > 0, value_domain[stats.argmax(axis=0)], np.nan)
+
+
+# aggregation function -> (uses label histograms, function to compute the aggregate from group statistics)
+LEAVE_ONE_OUT_AGGREGATIONS = {
+    np.mean: (False, _mean_from_sums),
+    np.nanmedian: (True, _median_from_histogram),
+    mode_aggregation: (True, _mode_from_histogram),
+}
+
+
+class LeaveOneOutAggregator:
+    """
+    Computes aggregates of a reliability matrix with one annotator held out
+
+    For an annotator in demographic group `dem`, three aggregates are produced (one value per item):
+    * the aggregate of all other annotators in the reliability matrix
+    * the aggregate of the other annotators in `dem`
+    * the aggregate of the annotators in all groups other than `dem`
+    """
+
+    def __init__(self, values: Union[np.ndarray, SparseReliabilityMatrix], group_rows: Dict[str, Sequence[int]],
+                 aggregation: Callable = np.mean):
+        """
+        :param values: values of the reliability matrix (annotators x items), NaN where not annotated, or a
+            SparseReliabilityMatrix
+        :param group_rows: demographic group -> rows of the annotators in that group
+        :param aggregation: an aggregation function in LEAVE_ONE_OUT_AGGREGATIONS
+        """
+        self.matrix = as_sparse(values)
+        self.n_items = self.matrix.shape[1]
+
+        self.use_histograms, self._finalize = LEAVE_ONE_OUT_AGGREGATIONS[aggregation]
+        self.value_domain = np.unique(self.matrix.labels)
+        self.codes = np.searchsorted(self.value_domain, self.matrix.labels) if self.use_histograms else None
+
+        self.total_stats = self.stats(np.arange(self.matrix.shape[0]))
+        self.group_stats = {dem: self.stats(rows) for dem, rows in group_rows.items()}
+
+        # the aggregate of the other groups does not depend on which annotator is held out
+        self.out_group_aggregate = {
+            dem: self.aggregate(sum((s for d, s in self.group_stats.items() if d != dem), 
+                                    np.zeros_like(self.total_stats)))
+            for dem in self.group_stats
+        }
+
+    @property
+    def n_stats(self) -> int:
+        return len(self.value_domain) if self.use_histograms else 2
+
+    def _stat_entries(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # (flat index into the statistics of shape (n_statistics, n_items), value) of the given annotations
+        items = self.matrix.item_codes[positions]
+        if self.use_histograms:
+            return self.codes[positions] * self.n_items + items, np.ones(len(positions), dtype=np.int64)
+        return np.concatenate((items, self.n_items + items)), \
+            np.concatenate((self.matrix.labels[positions], np.ones(len(positions))))
+
+    def stats(self, rows) -> np.ndarray:
+        """
+        Per-item statistics of the given rows of the reliability matrix, which can be added and subtracted
+        * sums and counts: shape (2, n_items)
+        * label histograms: shape (n_labels, n_items)
+        """
+        positions = self.matrix.positions(rows)
+        if self.use_histograms:
+            flat_idx, _ = self._stat_entries(positions)
+            return np.bincount(flat_idx, minlength=self.n_stats * self.n_items).reshape(self.n_stats, self.n_items)
+        items = self.matrix.item_codes[positions]
+        return np.stack((np.bincount(items, weights=self.matrix.labels[positions], minlength=self.n_items),
+                         np.bincount(items, minlength=self.n_items)))
+
+    def row_stats(self, rows) -> csr_matrix:
+        """
+        Statistics of each of the given rows, as a sparse matrix of shape (n_rows, n_statistics * n_items),
+        e.g., to sum the statistics of many groups of rows with a single matrix product
+        """
+        rows = np.asarray(rows, dtype=int).reshape(-1)
+        positions = self.matrix.positions(rows)
+        row_idx = np.repeat(np.arange(len(rows)), self.matrix.row_lengths()[rows])
+        flat_idx, values = self._stat_entries(positions)
+        return csr_matrix((values, (np.tile(row_idx, len(flat_idx) // max(len(row_idx), 1)), flat_idx)),
+                          shape=(len(rows), self.n_stats * self.n_items))
+
+    def padded_stats(self, rows) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Annotations of the given rows at the items they annotated, padded to the row with the most annotations
+        (see SparseReliabilityMatrix.padded)
+        :return: (item codes, annotations, statistics), where statistics has shape (n_rows, n_statistics, width)
+        """
+        items, annotations = self.matrix.padded(rows)
+        annotated = ~np.isnan(annotations)
+        stats = np.zeros((len(items), self.n_stats, items.shape[1]), dtype=np.int64 if self.use_histograms else float)
+        row_idx, position_idx = np.nonzero(annotated)
+        if self.use_histograms:
+            stats[row_idx, np.searchsorted(self.value_domain, annotations[annotated]), position_idx] = 1
+        else:
+            stats[row_idx, 0, position_idx] = annotations[annotated]
+            stats[row_idx, 1, position_idx] = 1
+        return items, annotations, stats
+
+    def aggregate(self, stats: np.ndarray) -> np.ndarray:
+        """
+        Aggregates from statistics of shape (n_statistics, ..., n_items), e.g. from stats()
+        """
+        return self._finalize(stats, self.value_domain)
+
+    def annotations(self, row: int) -> np.ndarray:
+        """
+        The (dense) row of the reliability matrix
+        """
+        annotations = np.full(self.n_items, np.nan)
+        items, labels = self.matrix.row(row)
+        annotations[items] = labels
+        return annotations
+
+    def aggregates(self, row: int, dem: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param row: the row of the annotator to hold out
+        :param dem: the demographic group of the annotator
+        :return: (all other annotators, other annotators in dem, annotators in other groups) aggregates
+        """
+        user_stats = self.stats([row])
+        return (
+            self.aggregate(self.total_stats - user_stats),
+            self.aggregate(self.group_stats[dem] - user_stats),
+            self.out_group_aggregate[dem],
+        )
@@ -0,0 +1,220 @@
+"""
+Agreement between all pairs of annotators
+
+Calling the agreement function on every pair of rows of the reliability matrix is O(annotators^2) Python calls.
+PairwiseAgreement instead computes the agreements of two blocks of annotators at once, from tallies that are matrix
+products over the items annotated in either block:
+* categorical metrics (nominal/ordinal alpha, Cohen's kappa): with one-hot label encodings X (labels x annotators x
+  items), X[u] @ X[v].T counts the items each pair labeled (u, v), which gives the coincidence (alpha) or confusion
+  (kappa) matrices of all pairs of the two blocks
+* interval alpha: products of the pairable masks, values and squared values give the sums alpha reduces to
+The metrics are those of BatchedAlpha and BatchedCohenKappa, so the results are the same as the agreement function
+of PAIRWISE_AGREEMENT_FN_MAP (src/config/agreement.py) on each pair of rows.
+
+The annotator x annotator matrix is tiled into blocks, which can be spread over the processes of a pool; it is stored
+as float32, with NaN on the diagonal and for pairs without agreement (e.g., no items in common).
+summarize_pairwise_agreement then summarizes it for each pair of demographic groups (e.g., within-gender vs
+cross-gender agreement).
+"""
+from contextlib import ExitStack
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from src.agreement.alpha import BatchedAlpha
+from src.agreement.kappa import BatchedCohenKappa, batched_kernel, kappa_from_confusion, label_codes
+from src.util.shared_matrix import SharedHandle, SharedReliabilityMatrix, attach, detach
+from src.util.sparse_matrix import ReliabilityMatrix, as_sparse, matrix_values
+
+
+DEFAULT_BLOCK_ROWS = 128
+
+
+def _one_hot(codes: np.ndarray, n_values: int) -> np.ndarray:
+    """
+    :param codes: array of shape (n_rows, n_items), with -1 where there is no (countable) value
+    :return: float32 array of shape (n_values * n_rows, n_items): the indicator rows of each value, value by value
+    """
+    return (codes[np.newaxis] == np.arange(n_values)[:, np.newaxis, np.newaxis]).astype(np.float32).reshape(
+        n_values * len(codes), codes.shape[1])
+
+
+def cooccurrences(first_codes: np.ndarray, second_codes: np.ndarray, n_values: int) -> np.ndarray:
+    """
+    :param first_codes: codes (0..n_values - 1, or -1 if not counted) of shape (n_first, n_items)
+    :param second_codes: codes of shape (n_second, n_items)
+    :return: array of shape (n_first, n_second, n_values, n_values) with the number of items for which a row of
+        first has value u and a row of second has value v
+    """
+    counts = _one_hot(first_codes, n_values) @ _one_hot(second_codes, n_values).T
+    return counts.reshape(n_values, len(first_codes), n_values, len(second_codes)).transpose(1, 3, 0, 2)
+
+
+class PairwiseAgreement:
+    """
+    Agreement between the annotators of two blocks of rows of a reliability matrix
+    """
+
+    def __init__(self, values: Union[np.ndarray, ReliabilityMatrix], agreement_fn: Callable):
+        """
+        :param values: values of the reliability matrix (annotators x items), NaN where not annotated, or a
+            sparse/coded reliability matrix
+        :param agreement_fn: a partial of krippendorff.alpha supported by BatchedAlpha, or of
+            cohen_kappa_reliability_matrix (src/agreement/kappa.py)
+        """
+        self.kernel = batched_kernel(agreement_fn)
+        if self.kernel is None:
+            raise ValueError(f"Agreement function not supported by pairwise agreement: {agreement_fn}")
+        self.matrix = as_sparse(values)
+        if isinstance(self.kernel, BatchedCohenKappa):
+            self.value_domain = self.kernel.labels
+        elif self.kernel.value_domain is not None:
+            self.value_domain = self.kernel.value_domain
+        else:
+            # alpha is the same over all values of the matrix as over the values of each pair
+            self.value_domain = np.unique(self.matrix.labels)
+
+    @property
+    def n_rows(self) -> int:
+        return self.matrix.shape[0]
+
+    def _dense(self, rows: np.ndarray, items: np.ndarray) -> np.ndarray:
+        # values of the rows for the (sorted) items, NaN where not annotated
+        block = self.matrix.take(rows)
+        values = np.full((len(rows), len(items)), np.nan)
+        values[block.row_codes(), np.searchsorted(items, block.item_codes)] = block.labels
+        return values
+
+    def _codes(self, values: np.ndarray) -> np.ndarray:
+        if isinstance(self.kernel, BatchedCohenKappa):
+            return label_codes(values, self.value_domain)
+        positions = np.clip(np.searchsorted(self.value_domain, values), 0, len(self.value_domain) - 1)
+        return np.where(self.value_domain[positions] == values, positions, -1)
+
+    def block(self, first_rows: Sequence[int], second_rows: Sequence[int]) -> np.ndarray:
+        """
+        :return: float32 array of shape (len(first_rows), len(second_rows)) with the agreement of each pair
+        """
+        first_rows = np.asarray(first_rows, dtype=int)
+        second_rows = np.asarray(second_rows, dtype=int)
+        # only the items annotated in either block are tallied
+        items = np.union1d(self.matrix.item_codes[self.matrix.positions(first_rows)],
+                           self.matrix.item_codes[self.matrix.positions(second_rows)])
+        first = self._dense(first_rows, items)
+        second = self._dense(second_rows, items)
+        shape = (len(first_rows), len(second_rows))
+
+        if isinstance(self.kernel, BatchedAlpha) and self.kernel.level_of_measurement == "interval":
+            agreements = self._interval_alpha(first, second)
+        else:
+            first_codes, second_codes = self._codes(first), self._codes(second)
+            counts = cooccurrences(first_codes, second_codes, len(self.value_domain)).astype(float)
+            counts = counts.reshape(shape[0] * shape[1], len(self.value_domain), len(self.value_domain))
+            if isinstance(self.kernel, BatchedCohenKappa):
+                agreements = kappa_from_confusion(counts, self.kernel.weighting)
+            else:
+                # every pairable unit adds (a, b) and (b, a) to the coincidence matrix
+                agreements = self.kernel.alpha_from_coincidences(counts + counts.transpose(0, 2, 1))
+        return agreements.reshape(shape).astype(np.float32)
+
+    def _interval_alpha(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        if self.kernel.value_domain is not None:
+            # values outside of the domain are not counted
+            first = np.where(np.isin(first, self.kernel.value_domain), first, np.nan)
+            second = np.where(np.isin(second, self.kernel.value_domain), second, np.nan)
+        first_mask, second_mask = ~np.isnan(first), ~np.isnan(second)
+        first, second = np.nan_to_num(first), np.nan_to_num(second)
+        first_mask, second_mask = first_mask.astype(float), second_mask.astype(float)
+        # sums over the items annotated by both annotators of each pair
+        pairable = first_mask @ second_mask.T
+        first_sum, second_sum = first @ second_mask.T, first_mask @ second.T
+        first_sq, second_sq = first ** 2 @ second_mask.T, first_mask @ (second ** 2).T
+        products = first @ second.T
+        return BatchedAlpha.alpha_from_sums(2 * pairable, first_sum + second_sum, first_sq + second_sq,
+                                            2 * (first_sq + second_sq - 2 * products)).ravel()
+
+    def tiles(self, block_rows: int = DEFAULT_BLOCK_ROWS) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        The blocks of rows of the upper triangle of the matrix (agreement is symmetric)
+        """
+        blocks = [np.arange(start, min(start + block_rows, self.n_rows))
+                  for start in range(0, self.n_rows, block_rows)]
+        return [(blocks[i], blocks[j]) for i in range(len(blocks)) for j in range(i, len(blocks))]
+
+
+class _SharedPairwiseJob(NamedTuple):
+    matrix: SharedHandle
+    agreement_fn: Callable
+
+
+# the engine built by a worker process for the most recent job
+_worker_engine: Dict[str, Any] = {}
+
+
+def _shared_pairwise_worker(job: _SharedPairwiseJob, first_rows: np.ndarray,
+                            second_rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    key = (job.matrix.name, job.agreement_fn)
+    if _worker_engine.get("key") != key:
+        # release the previous matrix before attaching to a new one
+        previous = _worker_engine.pop("job", None)
+        _worker_engine.clear()
+        if previous is not None and previous.matrix.name != job.matrix.name:
+            detach(previous.matrix)
+        _worker_engine.update(key=key, job=job, engine=PairwiseAgreement(attach(job.matrix), job.agreement_fn))
+    return first_rows, second_rows, _worker_engine["engine"].block(first_rows, second_rows)
+
+
+def pairwise_agreement(reliability_matrix: ReliabilityMatrix, agreement_fn: Callable,
+                       mp_pool: Optional[Pool] = None, shared_matrix: Optional[SharedReliabilityMatrix] = None,
+                       block_rows: int = DEFAULT_BLOCK_ROWS) -> pd.DataFrame:
+    """
+    Agreement between every pair of annotators (rows) of a reliability matrix
+
+    When using a pool, the reliability matrix is published to shared memory (unless an already published
+    `shared_matrix` is passed) and workers receive tiles of `block_rows` x `block_rows` annotators.
+    :return: float32 DataFrame (annotators x annotators), NaN on the diagonal and where agreement is undefined
+    """
+    engine = PairwiseAgreement(matrix_values(reliability_matrix), agreement_fn)
+    tiles = engine.tiles(block_rows)
+    agreements = np.full((engine.n_rows, engine.n_rows), np.nan, dtype=np.float32)
+
+    with ExitStack() as stack:
+        if mp_pool is None:
+            results = (rows + (engine.block(*rows),) for rows in tiles)
+        else:
+            # workers attach to a single shared copy of the matrix and only receive the rows of their tiles
+            if shared_matrix is None:
+                shared_matrix = stack.enter_context(SharedReliabilityMatrix(reliability_matrix))
+            job = _SharedPairwiseJob(shared_matrix.handle, agreement_fn)
+            results = mp_pool.starmap(_shared_pairwise_worker, [(job,) + rows for rows in tiles])
+        for first_rows, second_rows, block in tqdm(results, total=len(tiles), desc="Pairwise tiles"):
+            agreements[np.ix_(first_rows, second_rows)] = block
+            agreements[np.ix_(second_rows, first_rows)] = block.T
+
+    np.fill_diagonal(agreements, np.nan)
+    return pd.DataFrame(agreements, index=reliability_matrix.index, columns=reliability_matrix.index)
+
+
+def summarize_pairwise_agreement(agreements: pd.DataFrame, demographics: Dict[str, List[str]]) -> pd.DataFrame:
+    """
+    Summary of the agreements between the annotators of each pair of demographic groups (e.g., F-F, F-M, M-M)
+
+    Each pair of annotators is counted once; pairs with undefined agreement are skipped.
+    :return: DataFrame indexed by "{group1}-{group2}", with the number of pairs and the mean, std and median agreement
+    """
+    groups = list(demographics)
+    positions = {dem: agreements.index.get_indexer(users) for dem, users in demographics.items()}
+    summary = []
+    for i, dem1 in enumerate(groups):
+        for dem2 in groups[i:]:
+            block = agreements.to_numpy()[np.ix_(positions[dem1], positions[dem2])]
+            if dem1 == dem2:
+                block = block[np.triu_indices(len(block), k=1)]
+            values = block[~np.isnan(block)].astype(float)
+            summary.append((f"{dem1}-{dem2}", len(values), np.mean(values) if len(values) else np.nan,
+                            np.std(values) if len(values) else np.nan,
+                            np.median(values) if len(values) else np.nan))
+    return pd.DataFrame(summary, columns=["groups", "n_pairs", "mean", "std", "median"]).set_index("groups")
@@ -0,0 +1,254 @@
+"""
+Permutation test for differences between demographic groups in agreement with aggregates
+
+The demographic labels of the annotators are shuffled, and the statistics of agreement_with_aggregate
+(F-ALL, F-ALLF, F-ALLM, M-ALL, M-ALLM, M-ALLF) are recomputed for every relabeling without re-aggregating
+the reliability matrix:
+* agreement with the aggregate of all other annotators does not depend on the labels, so it is computed once
+* per-annotator statistics (sums and counts, or label histograms; see src/agreement/leave_one_out.py) are kept,
+  so the statistics of the relabeled groups are an indicator matrix product, and the leave-one-out
+  aggregates are obtained by subtracting an annotator's own statistics
+* the agreements of all annotators over a block of relabelings are computed with a single batched kernel call
+  (BatchedAlpha, or BatchedCohenKappa for Cohen's kappa)
+
+Each comparison in COMPARISONS is tested with the t statistic of scipy.stats.ttest_ind, as in
+src/scripts/agreement/significance_table.py. Relabelings are drawn from the seeded chunks of
+src/distribution/permutation_test.py (all splits are enumerated for small groups).
+"""
+from contextlib import ExitStack
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from src.agreement.kappa import batched_kernel
+from src.agreement.demographic_agreement import aggregate_keys
+from src.agreement.leave_one_out import LeaveOneOutAggregator
+from src.distribution.permutation_test import PermutationChunk, chunk_indicators, seeded_chunks
+from src.util.shared_matrix import SharedHandle, SharedReliabilityMatrix, attach, detach
+from src.util.sparse_matrix import ReliabilityMatrix, SparseReliabilityMatrix, matrix_values
+
+
+# (first statistic, second statistic, alternative hypothesis)
+COMPARISONS = [
+    ("F-ALL", "M-ALL", "two-sided"),
+    ("F-ALLF", "F-ALLM", "greater"),
+    ("M-ALLM", "M-ALLF", "greater"),
+]
+# maximum number of statistics (annotators x statistics x annotated items) held per relabeling in a block
+DEFAULT_BLOCK_ELEMENTS = 2 ** 22
+
+
+def t_statistics(values1: np.ndarray, mask1: np.ndarray, values2: np.ndarray, mask2: np.ndarray) -> np.ndarray:
+    """
+    Student's t statistic (as scipy.stats.ttest_ind) between the masked values of each row of values1 and values2
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n1, n2 = mask1.sum(axis=1), mask2.sum(axis=1)
+        mean1 = np.where(mask1, values1, 0).sum(axis=1) / n1
+        mean2 = np.where(mask2, values2, 0).sum(axis=1) / n2
+        squares1 = np.where(mask1, (values1 - mean1[:, np.newaxis]) ** 2, 0).sum(axis=1)
+        squares2 = np.where(mask2, (values2 - mean2[:, np.newaxis]) ** 2, 0).sum(axis=1)
+        pooled_variance = (squares1 + squares2) / (n1 + n2 - 2)
+        return (mean1 - mean2) / np.sqrt(pooled_variance * (1 / n1 + 1 / n2))
+
+
+class AgreementPermutationTest:
+    """
+    The t statistics of COMPARISONS for relabelings of the annotators in `group_rows`
+    """
+
+    def __init__(self, values: Union[np.ndarray, SparseReliabilityMatrix], group_rows: Dict[str, Sequence[int]],
+                 agreement_fn: Callable, aggregation: Callable = np.mean,
+                 block_elements: int = DEFAULT_BLOCK_ELEMENTS):
+        """
+        :param values: values of the reliability matrix (annotators x items), NaN where not annotated, or a
+            SparseReliabilityMatrix
+        :param group_rows: demographic group -> rows of the annotators in that group
+        :param agreement_fn: a partial of krippendorff.alpha supported by BatchedAlpha, or of
+            cohen_kappa_reliability_matrix (src/agreement/kappa.py)
+        :param aggregation: an aggregation function in LEAVE_ONE_OUT_AGGREGATIONS
+        """
+        self.kernel = batched_kernel(agreement_fn)
+        if self.kernel is None:
+            raise ValueError(f"Agreement function not supported by the permutation test: {agreement_fn}")
+        self.aggregator = LeaveOneOutAggregator(values, group_rows, aggregation)
+        self.integer_aggregate = aggregation != np.mean
+
+        self.groups = list(group_rows)
+        # the annotators whose labels are shuffled (in the order of the groups) and their actual labels
+        self.rows = np.concatenate([np.asarray(group_rows[dem], dtype=int) for dem in self.groups])
+        self.labels = np.repeat(np.arange(len(self.groups)), [len(group_rows[dem]) for dem in self.groups])
+        # sparse (annotators x statistics * items), so that memory scales with the number of annotations
+        self.annotator_stats = self.aggregator.row_stats(self.rows)
+        self.group_total = self.aggregator.stats(self.rows)
+
+        # only the items annotated by an annotator count towards its agreement, so aggregates are only computed
+        # for those (padded with NaN annotations to the annotator with the most items)
+        self.items, self.item_annotations, self.item_stats = self.aggregator.padded_stats(self.rows)
+        self.item_group_total = np.moveaxis(self.group_total[:, self.items], 1, 0)
+        self.block_size = max(1, block_elements // max(self.item_stats.size, len(self.groups) * self.group_total.size))
+
+        # agreement with everyone but the annotator does not depend on the labels
+        item_total = np.moveaxis(self.aggregator.total_stats[:, self.items], 1, 0)
+        self.all_alphas = self._alphas(self._aggregate(item_total - self.item_stats), self.item_annotations)
+
+    def _alphas(self, aggregates: np.ndarray, annotations: np.ndarray,
+                weights: Optional[np.ndarray] = None) -> np.ndarray:
+        if self.integer_aggregate:
+            # as in agreement_with_aggregate: mean of agreement with rounded up/down aggregates
+            return (self.kernel(np.ceil(aggregates), annotations, weights) +
+                    self.kernel(np.floor(aggregates), annotations, weights)) / 2
+        return self.kernel(aggregates, annotations, weights)
+
+    def _group_stats(self, memberships: np.ndarray) -> np.ndarray:
+        """
+        :param memberships: array of shape (n_relabelings, n_groups, n_annotators) with the number of times each
+            annotator counts towards each group
+        :return: array of shape (n_relabelings, n_groups, n_statistics, n_items)
+        """
+        flat = memberships.reshape(-1, memberships.shape[-1]).astype(self.annotator_stats.dtype)
+        return (self.annotator_stats.T @ flat.T).T.reshape(*memberships.shape[:2], *self.group_total.shape)
+
+    def _aggregate(self, stats: np.ndarray) -> np.ndarray:
+        # stats of shape (..., n_statistics, n_items) -> aggregates of shape (..., n_items)
+        return self.aggregator.aggregate(np.moveaxis(stats, -2, 0))
+
+    def statistics(self, labels: np.ndarray) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        :param labels: array of shape (n_relabelings, n_annotators) with the group (index into self.groups) of
+            each annotator in self.rows
+        :return: statistic (e.g., F-ALLM) -> (values, mask of the values in the statistic), of shape
+            (n_relabelings, n_annotators)
+        """
+        n_relabelings, n_annotators = labels.shape
+        one_hot = (labels[:, np.newaxis, :] == np.arange(len(self.groups))[np.newaxis, :, np.newaxis])
+        group_stats = self._group_stats(one_hot)
+        # statistics of each annotator's own group at the annotator's items: (relabelings, annotators, stats, items)
+        own_group_stats = group_stats[np.arange(n_relabelings)[:, np.newaxis, np.newaxis, np.newaxis],
+                                      labels[:, :, np.newaxis, np.newaxis],
+                                      np.arange(group_stats.shape[2])[np.newaxis, np.newaxis, :, np.newaxis],
+                                      self.items[np.newaxis, :, np.newaxis, :]]
+        same = self._aggregate(own_group_stats - self.item_stats)
+        other = self._aggregate(self.item_group_total - own_group_stats)
+
+        width = self.items.shape[1]
+        annotations = np.broadcast_to(self.item_annotations, same.shape).reshape(-1, width)
+        alphas = (
+            np.broadcast_to(self.all_alphas, labels.shape),
+            self._alphas(same.reshape(-1, width), annotations).reshape(labels.shape),
+            self._alphas(other.reshape(-1, width), annotations).reshape(labels.shape),
+        )
+        statistics = {}
+        for group, dem in enumerate(self.groups):
+            in_group = labels == group
+            for key, values in zip(aggregate_keys(dem), alphas):
+                # NaNs are dropped, as in agreement_with_aggregate
+                statistics[key] = (values, in_group & ~np.isnan(values))
+        return statistics
+
+    def t_statistics(self, labels: np.ndarray) -> np.ndarray:
+        """
+        :return: array of shape (n_relabelings, len(COMPARISONS))
+        """
+        t_values = []
+        for start in range(0, len(labels), self.block_size):
+            statistics = self.statistics(labels[start:start + self.block_size])
+            t_values.append(np.stack([t_statistics(*statistics[first], *statistics[second])
+                                      for first, second, _ in COMPARISONS], axis=1))
+        return np.concatenate(t_values) if t_values else np.empty((0, len(COMPARISONS)))
+
+    def observed(self) -> np.ndarray:
+        return self.t_statistics(self.labels[np.newaxis])[0]
+
+    def labels_of(self, indicators: np.ndarray) -> np.ndarray:
+        """
+        Labels of relabelings of two groups, given the membership of the first group
+        """
+        assert len(self.groups) == 2, "relabelings are only supported for two groups"
+        return np.where(indicators, 0, 1)
+
+    def count_at_least(self, observed: np.ndarray, label_blocks: Iterable[np.ndarray]) -> Tuple[np.ndarray, int]:
+        """
+        :return: (number of relabelings at least as extreme as observed for each comparison, number of relabelings)
+        """
+        two_sided = np.array([alternative == "two-sided" for _, _, alternative in COMPARISONS])
+        observed = np.where(two_sided, np.abs(observed), observed)
+        counts, n_relabelings = np.zeros(len(COMPARISONS), dtype=int), 0
+        for labels in label_blocks:
+            t_values = self.t_statistics(labels)
+            counts += (np.where(two_sided, np.abs(t_values), t_values) >= observed).sum(axis=0)
+            n_relabelings += len(labels)
+        return counts, n_relabelings
+
+    def count_chunk(self, observed: np.ndarray, chunk: PermutationChunk) -> Tuple[np.ndarray, int]:
+        return self.count_at_least(observed, map(self.labels_of, chunk_indicators(chunk)))
+
+
+class _SharedPermutationJob(NamedTuple):
+    matrix: SharedHandle
+    group_rows: Dict[str, np.ndarray]
+    agreement_fn: Callable
+    aggregation: Callable
+    observed: np.ndarray
+
+
+# the permutation test built by a worker process for the most recent job
+_worker_test: Dict[str, Any] = {}
+
+
+def _shared_permutation_worker(job: _SharedPermutationJob, chunk: PermutationChunk) -> Tuple[np.ndarray, int]:
+    key = (job.matrix.name, job.aggregation, tuple((dem, rows.tobytes()) for dem, rows in job.group_rows.items()))
+    if _worker_test.get("key") != key:
+        # release the previous matrix before attaching to a new one
+        previous = _worker_test.pop("job", None)
+        _worker_test.clear()
+        if previous is not None and previous.matrix.name != job.matrix.name:
+            detach(previous.matrix)
+        _worker_test.update(key=key, job=job, test=AgreementPermutationTest(
+            attach(job.matrix), job.group_rows, job.agreement_fn, job.aggregation))
+    return _worker_test["test"].count_chunk(job.observed, chunk)
+
+
+def agreement_permutation_test(reliability_matrix: ReliabilityMatrix, demographics: Dict[str, List[str]],
+                               agreement_fn: Callable, aggregation: Callable = np.mean,
+                               max_permutations: int = 10000, seed: int = 123, mp_pool: Optional[Pool] = None,
+                               shared_matrix: Optional[SharedReliabilityMatrix] = None) -> pd.DataFrame:
+    """
+    Permutation test of COMPARISONS for agreement_with_aggregate, shuffling the labels of the two demographic groups
+
+    When using a pool, the reliability matrix is published to shared memory (unless an already published
+    `shared_matrix` is passed) and workers receive chunks of relabelings. Results do not depend on the pool.
+    :return: DataFrame with the observed t statistic and p-value of each comparison
+    """
+    user_to_row = {user: i for i, user in enumerate(reliability_matrix.index)}
+    # rows are sorted, so that seeded results do not depend on the order of the annotators in `demographics`
+    group_rows = {dem: np.sort(np.array([user_to_row[user] for user in users], dtype=int))
+                  for dem, users in demographics.items()}
+    test = AgreementPermutationTest(matrix_values(reliability_matrix), group_rows, agreement_fn, aggregation)
+    observed = test.observed()
+
+    sizes = [len(rows) for rows in group_rows.values()]
+    chunks = seeded_chunks(sum(sizes), sizes[0], sum(sizes[1:]), max_permutations, seed)
+    with ExitStack() as stack:
+        if mp_pool is not None:
+            if shared_matrix is None:
+                shared_matrix = stack.enter_context(SharedReliabilityMatrix(reliability_matrix))
+            job = _SharedPermutationJob(shared_matrix.handle, group_rows, agreement_fn, aggregation, observed)
+            chunk_results = mp_pool.starmap(_shared_permutation_worker, [(job, chunk) for chunk in chunks])
+        else:
+            chunk_results = [test.count_chunk(observed, chunk) for chunk in tqdm(chunks, desc="Permutation chunks",
+                                                                                  leave=False)]
+    counts = np.sum([counts for counts, _ in chunk_results], axis=0)
+    n_relabelings = sum(n for _, n in chunk_results)
+
+    return pd.DataFrame({
+        "dist1": [first for first, _, _ in COMPARISONS],
+        "dist2": [second for _, second, _ in COMPARISONS],
+        "alternative": [alternative for _, _, alternative in COMPARISONS],
+        "tval": observed,
+        "pval": counts / n_relabelings,
+        "permutations": n_relabelings,
+    })
@@ -1,40 +1,93 @@
 """
 This file configures functions that should be used to load data for each task.
-To add a new task, you must add a function to the following maps:
+To add a new task, add it to TASK_REGISTRY (src/config/tasks.py) and you must add a function to the following maps:
 * DEMOGRAPHICS_FN_MATRIX_MAP: a function to call to get a map of demographic (e.g. M = male) -> a list of annotator IDs
 * REALIABILITY_FN_MATRIX_MAP: a function to call to get a reliability matrix. Columns are items in the dataset and rows are annotator IDs
                               if an annotator didn't annotate and item, fill with np.nan
+Functions are given as LazyFunction (src/util/lazy.py), so a task's loaders are only imported when its data is built
+Optionally, add a function to SPARSE_RELIABILITY_FN_MATRIX_MAP that builds the same reliability matrix as a
+SparseReliabilityMatrix (src/util/sparse_matrix.py) without materializing the dense matrix (the dense matrix is
+converted otherwise)
+DATASETS memoizes the outputs of these maps for each task, along with the matrix as an integer-coded
+CodedReliabilityMatrix (src/util/coded_matrix.py) built from the sparse matrix
+Optionally, add a function that releases the in-process caches of the task's loaders to _CLEAR_CACHE_FNS, so that
+DATASETS can bound the memory held in multi-task runs
+If the task shares its underlying dataset (and configuration file) with other tasks, set its dataset in TASK_REGISTRY
 """
-from functools import partial
+from typing import Callable, Dict
 
-from src.tasks.commitmentbank.demographics import create_demographics_map as create_cb_demographics_map
-from src.tasks.commitmentbank.reliability_matrix import create_reliability_matrix as create_cb_reliability_matrix
+from src.config.tasks import TASK_REGISTRY
 from src.tasks.affectivetext.config import SUBTASKS as AFFECTIVE_TEXT_SUBTASKS
-from src.tasks.affectivetext.demographics import create_demographics_map as create_at_demographics_map
-from src.tasks.affectivetext.reliability_matrix import create_reliability_matrix as create_at_reliability_matrix
-from src.tasks.sentiment.demographics import create_demographics_map as create_sentiment_demographics_map
-from src.tasks.sentiment.reliability_matrix import create_reliability_matrix as create_sentiment_reliability_matrix
-from src.tasks.wordsim.demographics import create_demographics_map as create_wordsim_demographics_map
-from src.tasks.wordsim.reliability_matrix import create_wordsim_reliability_matrix_rel, create_wordsim_reliability_matrix_sim
-
-
-DEMOGRAPHICS_FN_MATRIX_MAP = {
-    "wordsim_rel": create_wordsim_demographics_map,
-    "wordsim_sim": create_wordsim_demographics_map,
-    "sentiment": create_sentiment_demographics_map,
-    "commitmentbank": create_cb_demographics_map,
+from src.util.dataset import Dataset, DatasetRegistry
+from src.util.lazy import LazyFunction
+from src.util.reliability_cache import DEMOGRAPHICS, MATRIX, SPARSE_MATRIX, cached_map
+from src.util.sparse_matrix import SparseReliabilityMatrix
+
+
+# tasks built from the same underlying dataset, which is only loaded once when they are run together
+# the dataset name is also used to find the configuration file (config/{dataset}.json)
+TASK_DATASETS = {task: conf.dataset for task, conf in TASK_REGISTRY.items() if conf.dataset != task}
+
+
+# builders are wrapped with an on-disk cache (see src/util/reliability_cache.py)
+DEMOGRAPHICS_FN_MATRIX_MAP = cached_map({
+    "wordsim_rel": LazyFunction("src.tasks.wordsim.demographics", "create_demographics_map"),
+    "wordsim_sim": LazyFunction("src.tasks.wordsim.demographics", "create_demographics_map"),
+    "sentiment": LazyFunction("src.tasks.sentiment.demographics", "create_demographics_map"),
+    "commitmentbank": LazyFunction("src.tasks.commitmentbank.demographics", "create_demographics_map"),
 } | {
-    f"affectivetext_{subtask}": create_at_demographics_map
+    f"affectivetext_{subtask}": LazyFunction("src.tasks.affectivetext.demographics", "create_demographics_map")
     for subtask in AFFECTIVE_TEXT_SUBTASKS
-}
+}, TASK_DATASETS, DEMOGRAPHICS)
+
+
+REALIABILITY_FN_MATRIX_MAP = cached_map({
+    "wordsim_rel": LazyFunction("src.tasks.wordsim.reliability_matrix", "create_wordsim_reliability_matrix_rel"),
+    "wordsim_sim": LazyFunction("src.tasks.wordsim.reliability_matrix", "create_wordsim_reliability_matrix_sim"),
+    "sentiment": LazyFunction("src.tasks.sentiment.reliability_matrix", "create_reliability_matrix"),
+    "commitmentbank": LazyFunction("src.tasks.commitmentbank.reliability_matrix", "create_reliability_matrix"),
+} | {
+    f"affectivetext_{subtask}": LazyFunction("src.tasks.affectivetext.reliability_matrix",
+                                             "create_reliability_matrix", subtask)
+    for subtask in AFFECTIVE_TEXT_SUBTASKS
+}, TASK_DATASETS, MATRIX)
 
 
-REALIABILITY_FN_MATRIX_MAP = {
-    "wordsim_rel": create_wordsim_reliability_matrix_rel,
-    "wordsim_sim": create_wordsim_reliability_matrix_sim,
-    "sentiment": create_sentiment_reliability_matrix,
-    "commitmentbank": create_cb_reliability_matrix,
+def _sparse_from_dense(dense_builder: Callable) -> Callable:
+    return lambda: SparseReliabilityMatrix.from_dense(dense_builder())
+
+
+_SPARSE_BUILDERS: Dict[str, Callable] = {
+    "wordsim_rel": LazyFunction("src.tasks.wordsim.reliability_matrix", "create_wordsim_sparse_reliability_matrix_rel"),
+    "wordsim_sim": LazyFunction("src.tasks.wordsim.reliability_matrix", "create_wordsim_sparse_reliability_matrix_sim"),
+    "sentiment": LazyFunction("src.tasks.sentiment.reliability_matrix", "create_sparse_reliability_matrix"),
+    "commitmentbank": LazyFunction("src.tasks.commitmentbank.reliability_matrix", "create_sparse_reliability_matrix"),
 } | {
-    f"affectivetext_{subtask}": partial(create_at_reliability_matrix, subtask)
+    f"affectivetext_{subtask}": LazyFunction("src.tasks.affectivetext.reliability_matrix",
+                                             "create_sparse_reliability_matrix", subtask)
     for subtask in AFFECTIVE_TEXT_SUBTASKS
 }
+
+
+# the same matrices as REALIABILITY_FN_MATRIX_MAP, as SparseReliabilityMatrix
+SPARSE_RELIABILITY_FN_MATRIX_MAP = cached_map({
+    task: _SPARSE_BUILDERS.get(task, _sparse_from_dense(builder))
+    for task, builder in REALIABILITY_FN_MATRIX_MAP.items()
+}, TASK_DATASETS, SPARSE_MATRIX)
+
+
+# by dataset (see TASK_DATASETS)
+_CLEAR_CACHE_FNS: Dict[str, Callable] = {
+    "wordsim": LazyFunction("src.tasks.wordsim.reliability_matrix", "clear_cache"),
+    "sentiment": LazyFunction("src.tasks.sentiment.load_data", "clear_cache"),
+    "commitmentbank": LazyFunction("src.tasks.commitmentbank.load_data", "clear_cache"),
+    "affectivetext": LazyFunction("src.tasks.affectivetext.load_data", "clear_cache"),
+}
+
+
+# memoized reliability matrices, demographics, counts and histograms of each task (see src/util/dataset.py)
+DATASETS = DatasetRegistry({
+    task: Dataset(task, REALIABILITY_FN_MATRIX_MAP[task], SPARSE_RELIABILITY_FN_MATRIX_MAP[task],
+                  DEMOGRAPHICS_FN_MATRIX_MAP[task], _CLEAR_CACHE_FNS.get(TASK_DATASETS.get(task, task)))
+    for task in REALIABILITY_FN_MATRIX_MAP
+})
@@ -0,0 +1,61 @@
+"""
+Registry of all tasks
+
+Records what is known about each task without importing its loaders, its agreement function or any scientific
+library, so that listing tasks and parsing command line arguments stay fast:
+* name: the display name (TASK_ID_TO_NAME in src/config/task_names.py)
+* dataset: the underlying dataset, for tasks that share one (config/{dataset}.json)
+* agreement: the function for pairwise agreement between two annotators, imported on first use
+* aggregate_agreement: the function for agreement with an aggregate, if it differs from `agreement` (OPTIONAL)
+* distribution: the task's entry in DISTRIBUTION_CONFIG (src/config/distribution.py), if any
+Loaders are registered in src/config/data.py and are also only imported when a task's data is built.
+
+Notes on agreement metrics:
+Agreement functions are always called on a reliability matrix
+To use Cohen/Fleiss, use the functions in src.agreement.agreement_utils - the first argument is a list of labels
+So on a binary dataset, the agreement of a task could be one of the following:
+* LazyFunction("src.agreement.agreement_utils", "cohen_kappa_reliability_matrix", [True, False])
+* LazyFunction("src.agreement.agreement_utils", "fleiss_kappa_reliability_matrix", [True, False])
+Cohen's kappa (optionally with weighting="linear" or "quadratic") is computed in batches like alpha (src/agreement/kappa.py)
+"""
+from typing import Any, Dict, NamedTuple, Optional
+
+from src.config.distribution import DISTRIBUTION_CONFIG
+from src.config.task_names import TASK_ID_TO_NAME
+from src.tasks.affectivetext.config import SUBTASKS as AFFECTIVE_TEXT_SUBTASKS
+from src.util.lazy import LazyFunction
+
+
+class TaskConfig(NamedTuple):
+    name: str
+    dataset: str
+    agreement: LazyFunction
+    aggregate_agreement: Optional[LazyFunction]
+    distribution: Optional[Dict[str, Any]]
+
+
+def alpha(level_of_measurement: str, value_domain: Optional[list] = None) -> LazyFunction:
+    """
+    Krippendorff's alpha (src/agreement/alpha.py computes it in batches for these functions)
+    """
+    if value_domain is None:
+        return LazyFunction("krippendorff", "alpha", level_of_measurement=level_of_measurement)
+    return LazyFunction("krippendorff", "alpha", level_of_measurement=level_of_measurement, value_domain=value_domain)
+
+
+def _task(task: str, agreement: LazyFunction, aggregate_agreement: Optional[LazyFunction] = None,
+          dataset: Optional[str] = None) -> TaskConfig:
+    return TaskConfig(TASK_ID_TO_NAME.get(task, task), dataset or task, agreement, aggregate_agreement,
+                      DISTRIBUTION_CONFIG.get(task))
+
+
+# when aggregated with the mean, ordinal labels become interval data
+TASK_REGISTRY = {
+    "wordsim_rel": _task("wordsim_rel", alpha("ordinal", list(range(-2, 3))), alpha("interval"), "wordsim"),
+    "wordsim_sim": _task("wordsim_sim", alpha("ordinal", list(range(-2, 3))), alpha("interval"), "wordsim"),
+    "sentiment": _task("sentiment", alpha("ordinal", list(range(0, 5))), alpha("interval")),
+    "commitmentbank": _task("commitmentbank", alpha("ordinal", list(range(-3, 4))), alpha("interval")),
+} | {
+    f"affectivetext_{subtask}": _task(f"affectivetext_{subtask}", alpha("interval"), dataset="affectivetext")
+    for subtask in AFFECTIVE_TEXT_SUBTASKS
+}
@@ -0,0 +1,291 @@
+"""
+Vectorized permutation test for the difference between the label distributions of two groups of annotators
+
+The labels of each annotator are counted once into a histogram. The histograms of the two groups for a
+block of permutations are then one (permutations x annotators) indicator matrix product, and the difference
+metric of every permutation in the block is computed with array operations.
+
+The metrics are the same as comparing pandas value_counts of the two groups:
+* ordinal: the L1 distance between the label proportions at the positions compare_cols of the union of the
+  labels of both groups (the labels of the first group, then the labels only seen in the second group).
+  Labels that only one of the groups used do not contribute.
+* interval: the L1 distance between the CDFs of the label proportions over the integers min_val..max_val
+
+Permutations can be drawn in two ways:
+* legacy: one stream from np.random.seed, as in the original serial implementation
+* seeded: fixed-size chunks, each drawn from its own stream spawned from a np.random.SeedSequence. Chunks are
+  independent, so they can be run on any number of processes with the same (bit-identical) results.
+When there are few enough splits of the annotators, all of them are enumerated instead (an exact test). Splits are
+streamed in revolving-door order, which updates the group histograms with one annotator moving per split.
+"""
+from itertools import islice
+from math import comb
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from src.distribution.revolving_door import revolving_door_sums
+from src.util.coded_matrix import CodedReliabilityMatrix
+from src.util.sparse_matrix import SparseReliabilityMatrix, as_sparse
+
+
+DEFAULT_BLOCK_SIZE = 1000
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_EXACT_CHUNK_SIZE = 100000
+
+
+class DistributionPermutationTest:
+    """
+    Difference metric between two groups of rows of a reliability matrix, for many groupings at once
+    """
+
+    def __init__(self, values: Union[np.ndarray, SparseReliabilityMatrix, CodedReliabilityMatrix],
+                 task_conf: Dict[str, Any]):
+        """
+        :param values: values of the reliability matrix (annotators x items), NaN where not annotated, or a
+            SparseReliabilityMatrix or CodedReliabilityMatrix
+        :param task_conf: the task's entry in DISTRIBUTION_CONFIG
+        """
+        if isinstance(values, CodedReliabilityMatrix):
+            # counted from the integer codes; labels of the domain that no annotator used are dropped
+            histograms = values.histograms()
+            used = histograms.sum(axis=0) > 0
+            self.value_domain = values.value_domain[used]
+            self.histograms = histograms[:, used]
+        else:
+            matrix = as_sparse(values)
+            n_rows = matrix.shape[0]
+            self.value_domain = np.unique(matrix.labels)
+            n_values = len(self.value_domain)
+            codes = np.searchsorted(self.value_domain, matrix.labels)
+            self.histograms = np.bincount(matrix.row_codes() * n_values + codes,
+                                          minlength=n_rows * n_values).reshape(n_rows, n_values)
+        self.total = self.histograms.sum(axis=0)
+
+        self.annotation_type = task_conf["annotation_type"]
+        if self.annotation_type == "ordinal":
+            self.compare_cols = list(task_conf["compare_cols"])
+        else:
+            range_values = np.arange(task_conf["min_val"], task_conf["max_val"] + 1)
+            # labels outside of the range (or between integers) are not part of the CDFs
+            self.in_range = np.isin(self.value_domain, range_values)
+            self.range_positions = np.searchsorted(range_values, self.value_domain[self.in_range])
+            self.n_range_values = len(range_values)
+
+    def group_histograms(self, indicators: np.ndarray) -> np.ndarray:
+        """
+        :param indicators: array of shape (n_groupings, n_annotators), 1 where an annotator is in the group
+        :return: array of shape (n_groupings, n_labels) with the label counts of each group
+        """
+        return indicators.astype(np.int64) @ self.histograms
+
+    def metric(self, histograms1: np.ndarray, histograms2: np.ndarray) -> np.ndarray:
+        """
+        :param histograms1: label counts of the first group, shape (n_groupings, n_labels)
+        :param histograms2: label counts of the second group, shape (n_groupings, n_labels)
+        :return: array of shape (n_groupings,) with the difference metric of each grouping
+        """
+        proportions1 = histograms1 / histograms1.sum(axis=1, keepdims=True)
+        proportions2 = histograms2 / histograms2.sum(axis=1, keepdims=True)
+        if self.annotation_type == "ordinal":
+            return self._ordinal_metric(histograms1 > 0, histograms2 > 0, proportions1, proportions2)
+        return self._interval_metric(proportions1, proportions2)
+
+    def _ordinal_metric(self, present1: np.ndarray, present2: np.ndarray, proportions1: np.ndarray,
+                        proportions2: np.ndarray) -> np.ndarray:
+        n_union = (present1 | present2).sum(axis=1)
+        if len(n_union) > 0 and max(self.compare_cols) >= n_union.min():
+            raise IndexError("compare_cols are out of bounds for the labels of the groups")
+        differences = np.where(present1 & present2, np.abs(proportions1 - proportions2), 0)
+        # only the first group's labels can be present in both, and they come first in the union (in sorted order)
+        union_positions = np.cumsum(present1, axis=1) - 1
+        terms = np.stack([(differences * (present1 & (union_positions == col))).sum(axis=1)
+                          for col in self.compare_cols], axis=1)
+        return terms.sum(axis=1)
+
+    def _interval_metric(self, proportions1: np.ndarray, proportions2: np.ndarray) -> np.ndarray:
+        cdfs = []
+        for proportions in (proportions1, proportions2):
+            range_proportions = np.zeros((len(proportions), self.n_range_values))
+            range_proportions[:, self.range_positions] = proportions[:, self.in_range]
+            cdfs.append(range_proportions.cumsum(axis=1))
+        return np.abs(cdfs[0] - cdfs[1]).sum(axis=1)
+
+    def observed(self, rows1: Sequence[int], rows2: Sequence[int]) -> float:
+        indicators = np.zeros((2, len(self.histograms)), dtype=np.int64)
+        np.add.at(indicators, (0, np.asarray(rows1, dtype=int)), 1)
+        np.add.at(indicators, (1, np.asarray(rows2, dtype=int)), 1)
+        histograms = self.group_histograms(indicators)
+        return float(self.metric(histograms[:1], histograms[1:])[0])
+
+    def permuted(self, histograms1: np.ndarray) -> np.ndarray:
+        """
+        :param histograms1: label counts of the first group of each permutation, shape (n_permutations, n_labels)
+            (all other annotators form the second group)
+        :return: array of shape (n_permutations,) with the difference metric of each permutation
+        """
+        return self.metric(histograms1, self.total - histograms1)
+
+    def exact_histograms(self, size_1: int, fixed: Tuple[int, ...] = (),
+                         block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[np.ndarray]:
+        """
+        Label counts of the first group for every split of the annotators with size_1 annotators in the first group,
+        in blocks. With `fixed`, only the splits whose largest rows in the first group are `fixed` are enumerated.
+        """
+        n_free = min(fixed, default=len(self.histograms))
+        fixed_histogram = self.histograms[list(fixed)].sum(axis=0)
+        for block in revolving_door_sums(self.histograms[:n_free], size_1 - len(fixed), block_size):
+            yield fixed_histogram + block
+
+    def count_at_least(self, observed: float, blocks: Iterable[np.ndarray]) -> Tuple[int, int]:
+        """
+        :param blocks: blocks of label counts of the first group of each permutation
+        :return: (number of permutations with a metric >= observed, number of permutations)
+        """
+        count_gt, n_permutations = 0, 0
+        for histograms1 in blocks:
+            count_gt += int((self.permuted(histograms1) >= observed).sum())
+            n_permutations += len(histograms1)
+        return count_gt, n_permutations
+
+
+def rows_of(index: pd.Index, labels: Sequence) -> np.ndarray:
+    rows = index.get_indexer(labels)
+    if (rows < 0).any():
+        raise KeyError(f"{[l for l, r in zip(labels, rows) if r < 0]} not in index")
+    return rows
+
+
+def _indicator_block(groups: Sequence[Sequence[int]], n: int) -> np.ndarray:
+    indicators = np.zeros((len(groups), n), dtype=bool)
+    for i, group in enumerate(groups):
+        indicators[i, list(group)] = True
+    return indicators
+
+
+def legacy_permutations(n: int, size_1: int, n_permutations: int, seed: int, block_size: int = DEFAULT_BLOCK_SIZE,
+                        rng_state: Optional[tuple] = None) -> Iterator[np.ndarray]:
+    """
+    Random permutations drawn with np.random.seed(seed) and np.random.permutation, in blocks of indicators
+    (the first size_1 annotators of each permutation form the first group)
+    :param rng_state: continue from this state of np.random (np.random.get_state() after a block) instead of seeding
+    """
+    if rng_state is None:
+        np.random.seed(seed)
+    else:
+        np.random.set_state(rng_state)
+    for start in range(0, n_permutations, block_size):
+        yield _indicator_block([np.random.permutation(n)[:size_1]
+                                for _ in range(min(block_size, n_permutations - start))], n)
+
+
+def use_exact_test(n_splits: int, max_permutations: int, max_exact_splits: Optional[int] = None) -> bool:
+    """
+    All splits are enumerated if there are fewer than max_permutations (or at most max_exact_splits)
+    """
+    return max_permutations > n_splits or (max_exact_splits is not None and n_splits <= max_exact_splits)
+
+
+def permutation_histograms(permutation_test: DistributionPermutationTest, size_1: int, size_2: int,
+                           max_permutations: int, seed: int, max_exact_splits: Optional[int] = None,
+                           block_size: int = DEFAULT_BLOCK_SIZE, skip_blocks: int = 0,
+                           rng_state: Optional[tuple] = None) -> Iterator[np.ndarray]:
+    """
+    Label counts of the first group for all splits (exact test) or max_permutations legacy random permutations
+    To resume an interrupted test, the first skip_blocks blocks are skipped; random permutations then continue from
+    rng_state, the state of np.random after the last block that was used.
+    """
+    n = len(permutation_test.histograms)
+    assert n == size_1 + size_2
+    if use_exact_test(comb(n, size_2), max_permutations, max_exact_splits):
+        return islice(permutation_test.exact_histograms(size_1, block_size=block_size), skip_blocks, None)
+    if skip_blocks > 0:
+        assert rng_state is not None, "the state of np.random is needed to resume random permutations"
+    return map(permutation_test.group_histograms,
+               legacy_permutations(n, size_1, max(max_permutations - skip_blocks * block_size, 0), seed, block_size,
+                                   rng_state if skip_blocks > 0 else None))
+
+
+class PermutationChunk(NamedTuple):
+    n: int
+    size_1: int
+    n_permutations: int
+    # stream to draw random permutations from, or None to enumerate the splits whose largest rows in the first
+    # group are `fixed`
+    seed: Optional[np.random.SeedSequence]
+    fixed: Tuple[int, ...] = ()
+
+
+def _exact_chunks(n: int, size_1: int, fixed: Tuple[int, ...], chunk_size: int) -> Iterator[PermutationChunk]:
+    # split on the largest free row in the first group until chunks have at most chunk_size splits
+    n_free, t_free = min(fixed, default=n), size_1 - len(fixed)
+    n_splits = comb(n_free, t_free)
+    if n_splits <= chunk_size or t_free == 0:
+        yield PermutationChunk(n, size_1, n_splits, None, fixed)
+        return
+    for largest in range(t_free - 1, n_free):
+        yield from _exact_chunks(n, size_1, fixed + (largest,), chunk_size)
+
+
+def seeded_chunks(n: int, size_1: int, size_2: int, max_permutations: int, seed: int,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE, max_exact_splits: Optional[int] = None,
+                  exact_chunk_size: int = DEFAULT_EXACT_CHUNK_SIZE) -> List[PermutationChunk]:
+    """
+    Same choice between enumerating all splits and random permutations as permutation_histograms,
+    but split into independent chunks
+    """
+    assert n == size_1 + size_2
+    if use_exact_test(comb(n, size_2), max_permutations, max_exact_splits):
+        return list(_exact_chunks(n, size_1, (), exact_chunk_size))
+    sizes = [min(chunk_size, max_permutations - start) for start in range(0, max_permutations, chunk_size)]
+    return [PermutationChunk(n, size_1, size, chunk_seed)
+            for size, chunk_seed in zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes)))]
+
+
+def _random_indicators(chunk: PermutationChunk) -> np.ndarray:
+    rng = np.random.default_rng(chunk.seed)
+    orders = rng.permuted(np.tile(np.arange(chunk.n), (chunk.n_permutations, 1)), axis=1)
+    indicators = np.zeros((chunk.n_permutations, chunk.n), dtype=bool)
+    np.put_along_axis(indicators, orders[:, :chunk.size_1], True, axis=1)
+    return indicators
+
+
+def chunk_indicators(chunk: PermutationChunk, block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    """
+    Membership of the first group for each permutation of the chunk, in blocks of shape (n_permutations, n)
+    """
+    if chunk.seed is None:
+        # the sum of the rows of the identity matrix over a combination is its indicator
+        identity = np.eye(chunk.n, dtype=np.int64)
+        fixed = identity[list(chunk.fixed)].sum(axis=0)
+        for block in revolving_door_sums(identity[:min(chunk.fixed, default=chunk.n)],
+                                         chunk.size_1 - len(chunk.fixed), block_size):
+            yield (fixed + block).astype(bool)
+        return
+    yield _random_indicators(chunk)
+
+
+def chunk_histograms(permutation_test: DistributionPermutationTest, chunk: PermutationChunk,
+                     block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    """
+    Label counts of the first group for each permutation of the chunk, in blocks
+    """
+    if chunk.seed is None:
+        yield from permutation_test.exact_histograms(chunk.size_1, chunk.fixed, block_size)
+        return
+    yield permutation_test.group_histograms(_random_indicators(chunk))
+
+
+def count_chunk(permutation_test: DistributionPermutationTest, observed: float,
+                chunk: PermutationChunk) -> Tuple[int, int]:
+    return permutation_test.count_at_least(observed, chunk_histograms(permutation_test, chunk))
+
+
+def chunk_exceedances(permutation_test: DistributionPermutationTest, observed: float,
+                      chunk: PermutationChunk) -> np.ndarray:
+    """
+    :return: for each permutation of the chunk (in order), whether its metric is >= observed
+    """
+    return np.concatenate([permutation_test.permuted(histograms1) >= observed
+                           for histograms1 in chunk_histograms(permutation_test, chunk)])
@@ -0,0 +1,82 @@
+"""
+Revolving-door (Gray code) enumeration of combinations
+
+Consecutive combinations differ by swapping a single element, so statistics that are sums over the
+elements of a combination (e.g., label histograms of a group of annotators) can be updated with one
+addition and one subtraction per combination instead of being recomputed.
+"""
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+
+def revolving_door_swaps(n: int, t: int) -> Iterator[Tuple[int, int]]:
+    """
+    Knuth's Algorithm R (TAOCP 7.2.1.3): visits every t-combination of range(n), starting from range(t)
+    :return: (element removed, element added) for each combination after the first
+    """
+    if t <= 0 or t >= n:
+        return
+    if t == 1:
+        # Algorithm R assumes t > 1
+        yield from ((i, i + 1) for i in range(n - 1))
+        return
+    # c[1..t] is the current combination in increasing order, c[t + 1] = n is a sentinel
+    c = [-1] + list(range(t)) + [n]
+    while True:
+        # R3: easy case
+        if t % 2 == 1:
+            if c[1] + 1 < c[2]:
+                yield c[1], c[1] + 1
+                c[1] += 1
+                continue
+            j, decrease = 2, True
+        else:
+            if c[1] > 0:
+                yield c[1], c[1] - 1
+                c[1] -= 1
+                continue
+            j, decrease = 2, False
+
+        while True:
+            if decrease:
+                # R4: try to decrease c[j] (c[j] == c[j - 1] + 1)
+                if c[j] >= j:
+                    yield c[j], j - 2
+                    c[j], c[j - 1] = c[j - 1], j - 2
+                    break
+                j += 1
+                if j > t:
+                    return
+            # R5: try to increase c[j] (c[j - 1] == j - 2)
+            if c[j] + 1 < c[j + 1]:
+                yield c[j - 1], c[j] + 1
+                c[j - 1], c[j] = c[j], c[j] + 1
+                break
+            j += 1
+            if j > t:
+                return
+            decrease = True
+
+
+def revolving_door_sums(values: np.ndarray, t: int, block_size: int) -> Iterator[np.ndarray]:
+    """
+    Sums of the rows of `values` over every t-combination of its rows, in blocks of at most block_size combinations
+    (in revolving-door order)
+    """
+    current = values[:t].sum(axis=0)
+    yield current[np.newaxis]
+    swaps = revolving_door_swaps(len(values), t)
+    while True:
+        removed: List[int] = []
+        added: List[int] = []
+        for out, into in swaps:
+            removed.append(out)
+            added.append(into)
+            if len(removed) == block_size:
+                break
+        if not removed:
+            return
+        block = current + np.cumsum(values[added] - values[removed], axis=0)
+        current = block[-1]
+        yield block
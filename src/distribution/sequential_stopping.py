@@ -0,0 +1,99 @@
+"""
+Sequential Monte Carlo stopping for permutation p-values
+
+Permutations are consumed in order and the test stops as soon as either
+* count_gt (permutations with a statistic at least as extreme as observed) reaches stop_count. Following
+  Besag & Clifford (1991), the p-value is then stop_count / (number of permutations used).
+* a Clopper-Pearson confidence interval of the p-value lies entirely below or above alpha, i.e., more
+  permutations would not change the decision at level alpha (checked at the end of each chunk)
+* max_permutations permutations have been used; the p-value is then count_gt / max_permutations
+Large p-values are decided after a few dozen permutations, so the permutation cap can be raised for
+borderline tasks without paying for it on the others.
+"""
+from typing import Any, Dict, NamedTuple
+
+import numpy as np
+
+
+DEFAULT_STOP_COUNT = 50
+DEFAULT_CONFIDENCE = 0.99
+
+
+class SequentialResult(NamedTuple):
+    p_value: float
+    count_gt: int
+    n_permutations: int
+    # standard error of the p-value estimate due to sampling permutations
+    mc_error: float
+    stopped_early: bool
+
+
+def clopper_pearson(count: int, n: int, confidence: float):
+    # scipy.stats is slow to import and only needed with --adaptive
+    from scipy.stats import beta
+    tail = (1 - confidence) / 2
+    lower = beta.ppf(tail, count, n - count + 1) if count > 0 else 0.
+    upper = beta.ppf(1 - tail, count + 1, n - count) if count < n else 1.
+    return lower, upper
+
+
+class SequentialStopping:
+    """
+    Consumes the exceedances of a stream of permutations (in a fixed order) until the test can stop
+    """
+
+    def __init__(self, alpha: float, max_permutations: int, stop_count: int = DEFAULT_STOP_COUNT,
+                 confidence: float = DEFAULT_CONFIDENCE, stop_early: bool = True):
+        """
+        :param stop_early: if False, all max_permutations permutations are used (e.g., when enumerating all splits)
+        """
+        self.alpha = alpha
+        self.max_permutations = max_permutations
+        self.stop_count = stop_count
+        self.confidence = confidence
+        self.stop_early = stop_early
+        self.count_gt = 0
+        self.n_permutations = 0
+        self.done = False
+
+    def update(self, exceeds: np.ndarray) -> bool:
+        """
+        :param exceeds: for each of the next permutations, whether its statistic is at least the observed one
+        :return: whether the test is done (later permutations are ignored)
+        """
+        if self.done:
+            return True
+        exceeds = np.asarray(exceeds, dtype=bool)[:self.max_permutations - self.n_permutations]
+        cumulative = self.count_gt + np.cumsum(exceeds)
+        if self.stop_early and len(exceeds) > 0 and cumulative[-1] >= self.stop_count:
+            # stop at the permutation where count_gt reaches stop_count
+            self.n_permutations += int(np.argmax(cumulative >= self.stop_count)) + 1
+            self.count_gt = self.stop_count
+            self.done = True
+            return True
+
+        if len(exceeds) > 0:
+            self.count_gt = int(cumulative[-1])
+            self.n_permutations += len(exceeds)
+        self.done = self.n_permutations >= self.max_permutations
+        if self.stop_early and not self.done and self.n_permutations > 0:
+            lower, upper = clopper_pearson(self.count_gt, self.n_permutations, self.confidence)
+            self.done = upper < self.alpha or lower > self.alpha
+        return self.done
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        The progress of the test (e.g., for checkpoints)
+        """
+        return dict(count_gt=self.count_gt, n_permutations=self.n_permutations, done=self.done)
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        self.count_gt = state["count_gt"]
+        self.n_permutations = state["n_permutations"]
+        self.done = state["done"]
+
+    def result(self) -> SequentialResult:
+        p_value = self.count_gt / self.n_permutations
+        return SequentialResult(p_value, self.count_gt, self.n_permutations,
+                                float(np.sqrt(p_value * (1 - p_value) / self.n_permutations)),
+                                self.n_permutations < self.max_permutations)
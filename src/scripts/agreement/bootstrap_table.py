@@ -0,0 +1,90 @@
+"""
+Bootstrap confidence intervals for the mean agreement of each group with each aggregate
+(see src/agreement/bootstrap.py)
+
+Resamples of all tasks are run on a single pool of --n_processes processes; results only depend on SEED.
+"""
+import argparse
+import os
+from contextlib import ExitStack
+from multiprocessing import Pool
+
+import pandas as pd
+from tqdm import tqdm
+
+from src.agreement.bootstrap import RESAMPLING, agreement_bootstrap
+from src.config.data import DATASETS
+from src.config.task_names import TASK_ID_TO_NAME
+from src.scripts.agreement.util import AGGREGATION_STR_TO_FN, TASKS, aggregate_agreement_fn, default_aggregation
+from src.util.shared_matrix import SharedReliabilityMatrix
+
+
+N_RESAMPLES = 2000
+CONFIDENCE = 0.95
+SEED = 123
+SAVE_FILE = "output/agreement/combo/bootstrap_{resampling}.txt"
+TASK_SAVE_FILE = "output/agreement/{task}/agreement_with_aggregate/bootstrap_{aggregation}_{resampling}.csv"
+# same order as the agreement plot
+LABEL_ORDER = ["F-ALL", "F-ALLF", "F-ALLM", "M-ALL", "M-ALLM", "M-ALLF"]
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_resamples",
+                        type=int,
+                        default=N_RESAMPLES,
+                        help="The number of bootstrap resamples per task.")
+    parser.add_argument("--resampling",
+                        choices=RESAMPLING,
+                        default="both",
+                        help="Resample items, annotators (within each gender) or both.")
+    parser.add_argument("--confidence",
+                        type=float,
+                        default=CONFIDENCE,
+                        help="The confidence level of the intervals.")
+    parser.add_argument("--n_processes",
+                        type=int,
+                        default=1,
+                        help="The number of processes to run.")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    results = {}
+    # a single pool is shared by all tasks
+    with ExitStack() as stack:
+        pool = stack.enter_context(Pool(args.n_processes)) if args.n_processes > 1 else None
+        for task in tqdm(TASKS, desc="Task loop"):
+            reliability_matrix = DATASETS[task].sparse_reliability_matrix().sort_index()
+            aggregation = default_aggregation(task)
+            with ExitStack() as task_stack:
+                shared_matrix = task_stack.enter_context(SharedReliabilityMatrix(reliability_matrix)) \
+                    if pool is not None else None
+                intervals = agreement_bootstrap(
+                    reliability_matrix, DATASETS[task].demographics(), aggregate_agreement_fn(task, aggregation),
+                    AGGREGATION_STR_TO_FN[aggregation], args.n_resamples, args.resampling, args.confidence, SEED,
+                    pool, shared_matrix)
+
+            task_file = TASK_SAVE_FILE.format(task=task, aggregation=aggregation, resampling=args.resampling)
+            os.makedirs(os.path.split(task_file)[0], exist_ok=True)
+            intervals.to_csv(task_file)
+            results[TASK_ID_TO_NAME.get(task, task)] = [
+                f"{r['mean']:.2f} [{r['lower']:.2f}, {r['upper']:.2f}]" for _, r in intervals.loc[LABEL_ORDER].iterrows()]
+
+    # format as LaTeX table
+    resampled = "items and annotators" if args.resampling == "both" else args.resampling
+    latex = pd.DataFrame.from_dict(results, orient="index", columns=LABEL_ORDER).to_latex(
+        caption=f"Mean agreement with aggregates and {100 * args.confidence:g}\\% bootstrap confidence intervals "
+                f"({args.n_resamples} resamples of {resampled}).",
+        label="tab:agreement_bootstrap",
+        escape=False
+    )
+    save_file = SAVE_FILE.format(resampling=args.resampling)
+    os.makedirs(os.path.split(save_file)[0], exist_ok=True)
+    with open(save_file, "w") as f:
+        f.write(latex)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,37 +4,49 @@ A script for computing various agreement metrics for a given task
 * How do individuals compare to aggregated annotations from different demographic groups?
   --> output: raw JSON results, PDF of boxplots, ttest results
   --> location: output/agreement/{task}/agreement_with_aggregate
+* How do individuals agree with each other, within and across demographic groups? (--pairwise)
+  --> output: annotator x annotator agreement matrix (float32 .npy, with the annotators in JSON), summary per pair
+      of demographic groups
+  --> location: output/agreement/{task}/pairwise
 
-TO ADD NEW TASKS: add to the dictionaries in src/config/agreement.py
+Several tasks (or --all) can be run in a single process; datasets shared by tasks are loaded once
+With --checkpoint, per-annotator results are saved as they complete (src/util/checkpoint.py), and a restarted run
+resumes where it left off
+
+TO ADD NEW TASKS: add to TASK_REGISTRY in src/config/tasks.py
 """
 import argparse
 import json
 import os
+from contextlib import ExitStack
 from multiprocessing import Pool
+from typing import List, Optional
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.stats import mode, ttest_ind
+from tqdm import tqdm
 
-from src.config.agreement import PAIRWISE_AGGREGATE_AGREEMENT_FN_MAP, PAIRWISE_AGREEMENT_FN_MAP
-from src.config.data import DEMOGRAPHICS_FN_MATRIX_MAP, REALIABILITY_FN_MATRIX_MAP
+from src.config.agreement import PAIRWISE_AGREEMENT_FN_MAP
+from src.config.data import DATASETS
+from src.config.tasks import TASK_REGISTRY
 from src.agreement.demographic_agreement import agreement_with_aggregate
+from src.agreement.pairwise import pairwise_agreement, summarize_pairwise_agreement
+from src.scripts.agreement.util import AGGREGATION_STR_TO_FN, TASKS, aggregate_agreement_fn, default_aggregation
+from src.util.checkpoint import describe_demographics, describe_function, matrix_fingerprint, open_checkpoint, run_key
+from src.util.shared_matrix import SharedReliabilityMatrix
 
 
-AGGREGATION_STR_TO_FN = {
-    "mean": np.mean,
-    "median": np.nanmedian,
-    "mode": lambda x: mode(x).mode[0]
-}
-
-CONFIG_MAPS = [DEMOGRAPHICS_FN_MATRIX_MAP, PAIRWISE_AGREEMENT_FN_MAP, REALIABILITY_FN_MATRIX_MAP]
+CONFIG_MAPS = [DATASETS, PAIRWISE_AGREEMENT_FN_MAP]
 
 
 def _output_distribution_results(raw_data, output_dir, boxplot_title, boxplot_figname, ttest_pairs):
     """
     Output results where there is a range of values - such that we can perform t-tests and output boxplots
     """
+    # imported here, so that --help and argument errors do not pay for matplotlib and scipy
+    import matplotlib.pyplot as plt
+    from scipy.stats import ttest_ind
+
     # save raw results
     with open(os.path.join(output_dir, f"raw_results_{boxplot_figname}.json"), "w") as f:
         json.dump(raw_data, f)
@@ -63,42 +75,87 @@ def _create_dir(output_path: str) -> str:
 class AgreementComputer:
     OUTPUT_DIR = "output/agreement"
 
-    def __init__(self, task, n_processes):
+    def __init__(self, task, pool: Optional[Pool] = None, checkpoint: bool = False):
         self.task = task
-        self.reliability_matrix = REALIABILITY_FN_MATRIX_MAP[task]()
-        self.reliability_matrix.sort_index(inplace=True)
-        self.demographics = DEMOGRAPHICS_FN_MATRIX_MAP[task]()
-        self.pairwise_agreement_fn = PAIRWISE_AGREEMENT_FN_MAP[task]
-        # pairwise aggregate fn only needs to be defined if it differs from the typical pairwise fn
-        self.pairwise_agreement_aggregate_fn = PAIRWISE_AGGREGATE_AGREEMENT_FN_MAP.get(task, self.pairwise_agreement_fn)
+        self.checkpoint = checkpoint
+        dataset = DATASETS[task]
+        self.reliability_matrix = dataset.sparse_reliability_matrix().sort_index()
+        self.demographics = dataset.demographics()
+
+        # the pool is owned by the caller so that it can be reused; the matrix is published to it only once
+        self.pool = pool
+        self.shared_matrix = SharedReliabilityMatrix(self.reliability_matrix) if pool is not None else None
+
+    def close(self):
+        if self.shared_matrix is not None:
+            self.shared_matrix.close()
+
+    def __enter__(self):
+        return self
 
-        self.pool = Pool(n_processes) if n_processes > 1 else None
+    def __exit__(self, *exc):
+        self.close()
 
     def agreement_with_aggregate(self, aggregation):
-        # if not using mean, shouldn't use pairwise_agreement_aggregate_fn (that switches to interval measure)
-        agreement_fn = self.pairwise_agreement_aggregate_fn \
-            if aggregation == "mean" else self.pairwise_agreement_fn
+        agreement_fn = aggregate_agreement_fn(self.task, aggregation)
+        checkpoint = open_checkpoint(
+            f"agreement_{self.task}_{aggregation}",
+            run_key(describe_function(agreement_fn), matrix_fingerprint(self.reliability_matrix),
+                    describe_demographics(self.demographics)),
+            self.checkpoint)
 
         # compute agreement scores
         agreement_data = agreement_with_aggregate(
             self.reliability_matrix, self.demographics, aggregation=AGGREGATION_STR_TO_FN[aggregation], 
-            agreement_fn=agreement_fn, mp_pool=self.pool)
+            agreement_fn=agreement_fn, mp_pool=self.pool, shared_matrix=self.shared_matrix, checkpoint=checkpoint)
 
         out_dir = _create_dir(os.path.join(self.OUTPUT_DIR, self.task, "agreement_with_aggregate"))
         _output_distribution_results(agreement_data, out_dir, f"Agreement with {aggregation}",
             f"agreement_{aggregation}", [("M-ALLM", "M-ALLF"), ("F-ALLF", "F-ALLM"), ("F-ALL", "M-ALL")])
+        if checkpoint is not None:
+            checkpoint.remove()
+
+
+    def pairwise_agreement(self):
+        agreements = pairwise_agreement(self.reliability_matrix, PAIRWISE_AGREEMENT_FN_MAP[self.task],
+                                        mp_pool=self.pool, shared_matrix=self.shared_matrix)
+
+        out_dir = _create_dir(os.path.join(self.OUTPUT_DIR, self.task, "pairwise"))
+        np.save(os.path.join(out_dir, "pairwise_agreement.npy"), agreements.to_numpy())
+        with open(os.path.join(out_dir, "annotators.json"), "w") as f:
+            json.dump(agreements.index.tolist(), f)
+        summarize_pairwise_agreement(agreements, self.demographics).to_csv(
+            os.path.join(out_dir, "pairwise_summary.csv"))
+
+
+def _order_by_dataset(tasks: List[str]) -> List[str]:
+    # run tasks that share a dataset one after another, so that the cached dataset is reused
+    datasets = list(dict.fromkeys(TASK_REGISTRY[task].dataset for task in tasks))
+    return sorted(dict.fromkeys(tasks), key=lambda task: datasets.index(TASK_REGISTRY[task].dataset))
 
 
 def _parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--task", 
-                        choices=set.intersection(*[set(x.keys()) for x in CONFIG_MAPS]), 
-                        required=True,
-                        help="The task to run on. Must provide demographics function and reliability function in config files.")
+    task_group = parser.add_mutually_exclusive_group(required=True)
+    task_group.add_argument("--task", 
+                            nargs="+",
+                            choices=set.intersection(*[set(x.keys()) for x in CONFIG_MAPS]), 
+                            help="The task(s) to run on. Must provide demographics function and reliability function in config files.")
+    task_group.add_argument("--all",
+                            action="store_true",
+                            help="Run on all tasks from the paper (TASKS in src/scripts/agreement/util.py).")
     parser.add_argument("--aggregation",
+                        nargs="+",
                         choices=AGGREGATION_STR_TO_FN.keys(),
-                        required=True,
-                        help="The way to aggregate individual annotator's annotations.")
+                        help="The way(s) to aggregate individual annotator's annotations. "
+                             "Defaults to the aggregation used in the paper for each task.")
+    parser.add_argument("--pairwise",
+                        action="store_true",
+                        help="Also compute the agreement between all pairs of annotators.")
+    parser.add_argument("--checkpoint",
+                        action="store_true",
+                        help="Save per-annotator results as they complete, and resume from them if the run is "
+                             "restarted.")
     parser.add_argument("--n_processes",
                         type=int,
                         default=1,
@@ -108,8 +165,16 @@ def _parse_args():
 
 def main():
     args = _parse_args()
-    ac = AgreementComputer(args.task, args.n_processes)
-    ac.agreement_with_aggregate(args.aggregation)
+    tasks = TASKS if args.all else args.task
+    # a single pool is shared by all tasks and aggregations
+    with ExitStack() as stack:
+        pool = stack.enter_context(Pool(args.n_processes)) if args.n_processes > 1 else None
+        for task in tqdm(_order_by_dataset(tasks), desc="Task loop"):
+            with AgreementComputer(task, pool, args.checkpoint) as ac:
+                for aggregation in args.aggregation or [default_aggregation(task)]:
+                    ac.agreement_with_aggregate(aggregation)
+                if args.pairwise:
+                    ac.pairwise_agreement()
 
 
 if __name__ == "__main__":
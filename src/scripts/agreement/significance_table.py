@@ -2,21 +2,38 @@
 # F-ALL vs M-ALL (2-sided t-test)
 # F-ALLF vs F-ALLM (1-sided t-test)
 # M-ALLM vs M-ALLF (1-sided t-test)
+# by default, p-values come from t-tests on the saved agreement data. With --permutation, they come from
+# permutation tests that shuffle annotator gender labels (see src/agreement/permutation_test.py)
 
+import argparse
+import os
 from collections import defaultdict
+from contextlib import ExitStack
+from multiprocessing import Pool
 
 import pandas as pd
-from scipy.stats import ttest_ind
+from tqdm import tqdm
 
+from src.agreement.permutation_test import agreement_permutation_test
+from src.config.data import DATASETS
 from src.config.task_names import TASK_ID_TO_NAME
-from src.scripts.agreement.util import load_data, TASKS
+from src.scripts.agreement.util import AGGREGATION_STR_TO_FN, aggregate_agreement_fn, default_aggregation, \
+    load_data, TASKS
 from src.util.fdr import fdr_correction
+from src.util.shared_matrix import SharedReliabilityMatrix
 
 
 ALPHA = 0.05
 SAVE_FILE = "output/agreement/combo/significance.txt"
+PERMUTATION_SAVE_FILE = "output/agreement/combo/significance_permutation.txt"
+MAX_PERMUTATIONS = 10000
+SEED = 123
+COLUMNS = ["F-ALL vs. M-ALL", "F-ALLF vs. F-ALLM", "M-ALLM vs. M-ALLF"]
 
 def build_significance_table():
+    # imported here, so that --help does not pay for scipy
+    from scipy.stats import ttest_ind
+
     results = defaultdict(list)
     for task in TASKS:
         task_name = TASK_ID_TO_NAME.get(task, task)
@@ -32,7 +49,28 @@ def build_significance_table():
         results[task_name].extend(tuple(ttest_ind(raw_data["M-ALLM"], raw_data["M-ALLF"], alternative="greater")))
 
     index = pd.MultiIndex.from_product(
-        [["F-ALL vs. M-ALL", "F-ALLF vs. F-ALLM", "M-ALLM vs. M-ALLF"], ["tval", "pval"]], 
+        [COLUMNS, ["tval", "pval"]], 
+        names=["groups", "value"])
+    return pd.DataFrame.from_dict(results, orient="index", columns=index)
+
+def build_permutation_table(n_processes: int = 1, max_permutations: int = MAX_PERMUTATIONS):
+    results = {}
+    # a single pool is shared by all tasks
+    with ExitStack() as stack:
+        pool = stack.enter_context(Pool(n_processes)) if n_processes > 1 else None
+        for task in tqdm(TASKS, desc="Task loop"):
+            reliability_matrix = DATASETS[task].sparse_reliability_matrix().sort_index()
+            aggregation = default_aggregation(task)
+            with ExitStack() as task_stack:
+                shared_matrix = task_stack.enter_context(SharedReliabilityMatrix(reliability_matrix)) \
+                    if pool is not None else None
+                task_results = agreement_permutation_test(
+                    reliability_matrix, DATASETS[task].demographics(), aggregate_agreement_fn(task, aggregation),
+                    AGGREGATION_STR_TO_FN[aggregation], max_permutations, SEED, pool, shared_matrix)
+            results[TASK_ID_TO_NAME.get(task, task)] = task_results[["tval", "pval"]].to_numpy().ravel()
+
+    index = pd.MultiIndex.from_product(
+        [COLUMNS, ["tval", "pval"]], 
         names=["groups", "value"])
     return pd.DataFrame.from_dict(results, orient="index", columns=index)
 
@@ -51,8 +89,32 @@ def _correct_table_fdr(sig_table: pd.DataFrame) -> pd.DataFrame:
     return copied_table
 
 
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--permutation",
+                        action="store_true",
+                        help="Compute p-values with permutation tests of annotator gender labels instead of t-tests "
+                             f"(saved to {PERMUTATION_SAVE_FILE}).")
+    parser.add_argument("--n_processes",
+                        type=int,
+                        default=1,
+                        help="The number of processes to run (with --permutation).")
+    parser.add_argument("--max_permutations",
+                        type=int,
+                        default=MAX_PERMUTATIONS,
+                        help="The maximum number of permutations per task. If a task has fewer splits of the "
+                             "annotators, all of them are used.")
+    return parser.parse_args()
+
+
 def main():
-    sig_table = build_significance_table()
+    args = _parse_args()
+    if args.permutation:
+        sig_table = build_permutation_table(args.n_processes, args.max_permutations)
+        save_file = PERMUTATION_SAVE_FILE
+    else:
+        sig_table = build_significance_table()
+        save_file = SAVE_FILE
     sig_table = _correct_table_fdr(sig_table)
 
     # format as LaTeX table
@@ -64,7 +126,8 @@ def main():
         escape=False,
         float_format="%.2f"
     )
-    with open(SAVE_FILE, "w") as f:
+    os.makedirs(os.path.split(save_file)[0], exist_ok=True)
+    with open(save_file, "w") as f:
         f.write(latex)
 
 if __name__ == "__main__":
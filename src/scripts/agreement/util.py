@@ -1,16 +1,45 @@
 import json
+from typing import Callable
 
+import numpy as np
+
+from src.agreement.leave_one_out import mode_aggregation
+from src.config.agreement import PAIRWISE_AGGREGATE_AGREEMENT_FN_MAP, PAIRWISE_AGREEMENT_FN_MAP
 from src.tasks.affectivetext.config import SUBTASKS as EMOTION_SUBTASKS
 
 DATA_FILES = "output/agreement/{task}/agreement_with_aggregate/raw_results_agreement_{aggregation}.json"
 MEDIAN_COMPUTED_TASKS = ["wordsim_sim", "wordsim_rel", "sentiment", "commitmentbank"]
 TASKS = MEDIAN_COMPUTED_TASKS + [f"affectivetext_{task}" for task in EMOTION_SUBTASKS]
 
+AGGREGATION_STR_TO_FN = {
+    "mean": np.mean,
+    "median": np.nanmedian,
+    "mode": mode_aggregation
+}
+
+
+def default_aggregation(task):
+    """
+    The aggregation used for a task in the paper
+    """
+    return "median" if task in MEDIAN_COMPUTED_TASKS else "mean"
+
+
+def aggregate_agreement_fn(task, aggregation) -> Callable:
+    """
+    The function for agreement between an annotator and an aggregate
+    """
+    # if not using mean, shouldn't use the pairwise aggregate fn (that switches to interval measure)
+    # the pairwise aggregate fn only needs to be defined if it differs from the typical pairwise fn
+    if aggregation == "mean":
+        return PAIRWISE_AGGREGATE_AGREEMENT_FN_MAP.get(task, PAIRWISE_AGREEMENT_FN_MAP[task])
+    return PAIRWISE_AGREEMENT_FN_MAP[task]
+
 
 def load_data(task):
     """
     Load saved annotator agreement data
     """
-    aggregation = "median" if task in MEDIAN_COMPUTED_TASKS else "mean"
+    aggregation = default_aggregation(task)
     with open(DATA_FILES.format(task=task, aggregation=aggregation)) as f:
         return json.load(f)
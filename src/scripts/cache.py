@@ -0,0 +1,66 @@
+"""
+Inspect and evict cached reliability matrices and demographics maps (see src/util/reliability_cache.py)
+
+PYTHONPATH=. python src/scripts/cache.py list [--task TASK]
+PYTHONPATH=. python src/scripts/cache.py evict [--task TASK] [--stale]
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from src.config.data import DEMOGRAPHICS_FN_MATRIX_MAP, REALIABILITY_FN_MATRIX_MAP, SPARSE_RELIABILITY_FN_MATRIX_MAP, \
+    TASK_DATASETS
+from src.util.reliability_cache import DEMOGRAPHICS, MATRIX, SPARSE_MATRIX, current_key, evict, list_entries
+
+
+KIND_TO_FN_MAP = {
+    MATRIX: REALIABILITY_FN_MATRIX_MAP,
+    SPARSE_MATRIX: SPARSE_RELIABILITY_FN_MATRIX_MAP,
+    DEMOGRAPHICS: DEMOGRAPHICS_FN_MATRIX_MAP,
+}
+
+
+def _status(entry, current_keys) -> str:
+    key = current_keys.get((entry.task, entry.kind))
+    if key is None:
+        return "unknown"
+    return "current" if key == entry.key else "stale"
+
+
+def _current_keys():
+    # keys that would be used if the builders were called now (None when the data is not available)
+    return {(task, kind): current_key(TASK_DATASETS.get(task, task), fn.__wrapped__)
+            for kind, fn_map in KIND_TO_FN_MAP.items() for task, fn in fn_map.items()}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=["list", "evict"])
+    parser.add_argument("--task",
+                        help="Only list/evict entries for this task.")
+    parser.add_argument("--stale",
+                        action="store_true",
+                        help="When evicting, only evict entries that no longer match the config, data or code.")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    current_keys = _current_keys()
+    entries = list(list_entries(args.task))
+
+    if args.action == "list":
+        rows = [(e.task, e.kind, e.key, e.size / 2 ** 20, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e.modified)),
+                 _status(e, current_keys)) for e in entries]
+        df = pd.DataFrame(rows, columns=["task", "kind", "key", "size (MB)", "modified", "status"])
+        print(df.to_string(index=False, float_format="%.2f") if len(df) > 0 else "Cache is empty")
+    else:
+        if args.stale:
+            entries = [e for e in entries if _status(e, current_keys) == "stale"]
+        evict(entries)
+        print(f"Evicted {len(entries)} cache entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,13 @@
 import os
 from typing import Dict, List
 
-import numpy as np
 import pandas as pd
 import seaborn as sns
 from matplotlib import pyplot as plt
 from matplotlib.gridspec import GridSpec
 from matplotlib.patches import Patch
 
-from src.config.data import DEMOGRAPHICS_FN_MATRIX_MAP, \
-    REALIABILITY_FN_MATRIX_MAP
+from src.config.data import DATASETS
 from src.config.distribution import DISTRIBUTION_CONFIG
 from src.config.plotting import COLORS
 from src.config.task_names import TASK_ID_TO_NAME
@@ -47,13 +45,12 @@ def plot_kde(raw_data: Dict[str, List[int]], ax: plt.axis, task: str,
 
 
 def load_data(task) -> Dict[str, List[float]]:
-    reliability_matrix = REALIABILITY_FN_MATRIX_MAP[task]()
-    demographics = DEMOGRAPHICS_FN_MATRIX_MAP[task]()
+    dataset = DATASETS[task]
+    reliability_matrix = dataset.coded_reliability_matrix()
+    demographics = dataset.demographics()
     results = {}
     for dem, users in demographics.items():
-        data = reliability_matrix.loc[users]
-        array = data.to_numpy().flatten()
-        results[dem] = array[~np.isnan(array)].tolist()
+        results[dem] = reliability_matrix.labels(reliability_matrix.index.get_indexer(users)).tolist()
     return results
 
 def plot_all_bar():
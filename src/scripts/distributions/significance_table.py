@@ -1,64 +1,47 @@
-import itertools
-from math import comb
+"""
+Permutation tests for differences between the label distributions of male and female annotators (Table 2)
+
+By default, permutations are drawn serially from np.random.seed(SEED), as in the paper. With --seeded, they are
+drawn in independently seeded chunks, and the chunks of all tasks are run concurrently on --n_processes processes;
+results only depend on SEED, not on the number of processes. With --adaptive, seeded permutations are used
+until the p-value is decided (see src/distribution/sequential_stopping.py), and the table also reports the
+number of permutations used and the Monte Carlo error of each p-value.
+
+With --checkpoint, the counts of completed permutations (and the state of np.random for the serial permutations)
+are saved periodically (src/util/checkpoint.py); a restarted run resumes from them, with the same results.
+
+The (uncorrected) results of each task are also saved to TASK_RESULT_FILE. The tests of different tasks are
+independent, so tasks can be run separately with --task (e.g., by src/scripts/pipeline.py), and their results
+combined into the table (with FDR correction across tasks) with --from_task_results.
+"""
+import argparse
+import json
 import os
-from typing import Any
+from contextlib import ExitStack
+from multiprocessing import Pool
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from src.config.data import DEMOGRAPHICS_FN_MATRIX_MAP, \
-    REALIABILITY_FN_MATRIX_MAP
+from src.config.data import DATASETS
 from src.config.distribution import DISTRIBUTION_CONFIG
 from src.config.task_names import TASK_ID_TO_NAME
+from src.distribution.permutation_test import DistributionPermutationTest, PermutationChunk, chunk_exceedances, \
+    count_chunk, permutation_histograms, rows_of, seeded_chunks
+from src.distribution.sequential_stopping import SequentialResult, SequentialStopping
+from src.util.checkpoint import Checkpoint, describe_demographics, matrix_fingerprint, open_checkpoint, \
+    rng_state_from_json, rng_state_to_json, run_key
 from src.util.fdr import fdr_correction
 
 MAX_PERMUTATIONS = 10000
 SAVE_FILE = "output/distribution/combo/significance.txt"
+TASK_RESULT_FILE = "output/distribution/{task}/permutation_test.json"
 SEED = 123
 ALPHA = 0.05
 
 
-def _count_helper(annotations: pd.DataFrame) -> pd.Series:
-    return pd.Series(annotations.to_numpy().flatten()).value_counts(
-        normalize=True).sort_index()
-
-
-def compute_difference_metric(annotations1: pd.DataFrame, 
-    annotations2: pd.DataFrame, task):
-    counts1 = _count_helper(annotations1)
-    counts2 = _count_helper(annotations2)
-    difference_df = pd.concat(
-            (counts1, counts2), axis=1)
-
-    task_conf = DISTRIBUTION_CONFIG[task]
-    if DISTRIBUTION_CONFIG[task]["annotation_type"] == "ordinal":
-        df = difference_df.iloc[task_conf["compare_cols"], ]
-        return (df[0]-df[1]).abs().sum()
-    else:
-        index = pd.RangeIndex(start=task_conf["min_val"], stop=task_conf["max_val"] + 1, step=1)
-        counts1 = counts1.reindex(index, fill_value=0)
-        counts2 = counts2.reindex(index, fill_value=0)
-        difference_df = pd.concat(
-            (counts1.cumsum(), counts2.cumsum()), axis=1)
-        return((difference_df[0] - difference_df[1]).abs().sum())
-
-def create_permutations(data: pd.DataFrame, size_M: int, size_F: int):
-    permutations = []
-    if MAX_PERMUTATIONS > comb(len(data.index), size_F):
-        for m_combo in itertools.combinations(data.index, size_M):
-            f_combo = [x for x in data.index if x not in m_combo]
-            assert len(f_combo) == size_F
-            permutations.append((list(m_combo), f_combo))
-    else:
-        np.random.seed(SEED)
-        assert len(data.index) == size_M + size_F
-        for _ in range(MAX_PERMUTATIONS):
-            permutation = np.random.permutation(data.index)
-            permutations.append((permutation[:size_M], permutation[size_M:]))
-    return permutations
-
-
 def _latex_bold(val: Any, bold: bool = False):
     val = str(val)
     if bold:
@@ -66,49 +49,252 @@ def _latex_bold(val: Any, bold: bool = False):
     return val
 
 
-def main():
-    os.makedirs(os.path.split(SAVE_FILE)[0], exist_ok=True)
+class TaskTest(NamedTuple):
+    permutation_test: DistributionPermutationTest
+    observed: float
+    size_M: int
+    size_F: int
+    # identifies the data of the test in checkpoints
+    fingerprint: str
 
-    results = {}
-    for task, conf in tqdm(DISTRIBUTION_CONFIG.items(), desc="Task loop"):
+
+def _load_task_test(task: str, conf: Dict[str, Any]) -> TaskTest:
+    dataset = DATASETS[task]
+    data = dataset.coded_reliability_matrix().sort_index()
+    demographics = dataset.demographics()
+    permutation_test = DistributionPermutationTest(data, conf)
+    observed = permutation_test.observed(rows_of(data.index, demographics["M"]),
+        rows_of(data.index, demographics["F"]))
+    return TaskTest(permutation_test, observed, len(demographics["M"]), len(demographics["F"]),
+                    run_key(conf, matrix_fingerprint(data), describe_demographics(demographics)))
+
+
+def _tested_tasks() -> List[str]:
+    tasks = []
+    for task, conf in DISTRIBUTION_CONFIG.items():
         # ignore tasks that are ordinal and haven't specified columns
         if conf["annotation_type"] == "ordinal" and "compare_cols" not in conf:
             print(f"Skipping {task} (compare_cols not specified)")
             continue
+        tasks.append(task)
+    return tasks
+
+
+def _legacy_p_values(task_tests: Dict[str, TaskTest], max_permutations: int, max_exact_splits: Optional[int],
+                     checkpoint: Optional[Checkpoint] = None) -> Dict[str, float]:
+    results = {}
+    for task, t in tqdm(task_tests.items(), desc="Task loop"):
+        if checkpoint is None:
+            blocks = permutation_histograms(t.permutation_test, t.size_M, t.size_F, max_permutations, SEED,
+                                            max_exact_splits)
+            count_gt, n_permutations = t.permutation_test.count_at_least(t.observed, tqdm(blocks, 
+                desc=f"Processing {task} permutation blocks", leave=False))
+            results[task] = count_gt / n_permutations
+            continue
+
+        # blocks are counted one at a time, so that the state of np.random after each block can be saved
+        progress = checkpoint.state.setdefault(task, dict(count_gt=0, n_permutations=0, blocks=0, rng_state=None,
+                                                          done=False))
+        if not progress["done"]:
+            blocks = permutation_histograms(
+                t.permutation_test, t.size_M, t.size_F, max_permutations, SEED, max_exact_splits,
+                skip_blocks=progress["blocks"],
+                rng_state=rng_state_from_json(progress["rng_state"]) if progress["rng_state"] else None)
+            for histograms1 in tqdm(blocks, desc=f"Processing {task} permutation blocks", leave=False):
+                count_gt, n_permutations = t.permutation_test.count_at_least(t.observed, [histograms1])
+                progress.update(count_gt=progress["count_gt"] + count_gt, blocks=progress["blocks"] + 1,
+                                n_permutations=progress["n_permutations"] + n_permutations,
+                                rng_state=rng_state_to_json(np.random.get_state()))
+                checkpoint.maybe_save()
+            progress["done"] = True
+            checkpoint.save()
+        results[task] = progress["count_gt"] / progress["n_permutations"]
+    return results
 
-        data = REALIABILITY_FN_MATRIX_MAP[task]()
-        data.sort_index(inplace=True)
-        demographics = DEMOGRAPHICS_FN_MATRIX_MAP[task]()
 
-        observed = compute_difference_metric(data.loc[demographics["M"]], 
-            data.loc[demographics["F"]], task)
+def _count_task_chunk(job: Tuple[str, TaskTest, int, PermutationChunk]) -> Tuple[str, int, int, int]:
+    task, t, i, chunk = job
+    return (task, i, *count_chunk(t.permutation_test, t.observed, chunk))
 
-        size_M = len(demographics["M"])
-        size_F = len(demographics["F"])
 
-        permutations = create_permutations(data, size_M, size_F)
+def _seeded_chunks(t: TaskTest, max_permutations: int, max_exact_splits: Optional[int]) -> List[PermutationChunk]:
+    return seeded_chunks(t.size_M + t.size_F, t.size_M, t.size_F, max_permutations, SEED,
+                         max_exact_splits=max_exact_splits)
 
-        permuted_metrics = []
-        count_gt = 0
-        for s1, s2 in tqdm(permutations, desc=f"Processing {task} permutations", 
-            leave=False):
-            permuted_metrics.append(compute_difference_metric(data.loc[s1], 
-                data.loc[s2], task))
-            if permuted_metrics[-1] >= observed:
-                count_gt += 1
 
-        p_val = count_gt / len(permutations)
-        results[task] = p_val 
+def _seeded_p_values(task_tests: Dict[str, TaskTest], n_processes: int, max_permutations: int,
+                     max_exact_splits: Optional[int], checkpoint: Optional[Checkpoint] = None) -> Dict[str, float]:
+    # (count_gt, n_permutations) of the completed chunks of each task, by chunk index (as a string in checkpoints)
+    chunk_counts = checkpoint.state.setdefault("chunks", {}) if checkpoint is not None else {}
+    for task in task_tests:
+        chunk_counts.setdefault(task, {})
+    # chunks of all tasks go to one pool, so that tasks run concurrently; chunks are independent, so those completed
+    # before a restart are skipped
+    jobs = [(task, t, i, chunk) for task, t in task_tests.items()
+            for i, chunk in enumerate(_seeded_chunks(t, max_permutations, max_exact_splits))
+            if str(i) not in chunk_counts[task]]
+    with ExitStack() as stack:
+        pool = stack.enter_context(Pool(n_processes)) if n_processes > 1 else None
+        chunk_results = pool.imap_unordered(_count_task_chunk, jobs) if pool is not None else \
+            map(_count_task_chunk, jobs)
+        for task, i, count_gt, n_permutations in tqdm(chunk_results, total=len(jobs), desc="Permutation chunks"):
+            chunk_counts[task][str(i)] = [count_gt, n_permutations]
+            if checkpoint is not None:
+                checkpoint.maybe_save()
+    return {task: sum(count_gt for count_gt, _ in chunk_counts[task].values()) /
+            sum(n_permutations for _, n_permutations in chunk_counts[task].values()) for task in task_tests}
 
+
+def _task_chunk_exceedances(job: Tuple[str, TaskTest, PermutationChunk]) -> np.ndarray:
+    _, t, chunk = job
+    return chunk_exceedances(t.permutation_test, t.observed, chunk)
+
+
+def _adaptive_results(task_tests: Dict[str, TaskTest], n_processes: int, max_permutations: int,
+                      max_exact_splits: Optional[int],
+                      checkpoint: Optional[Checkpoint] = None) -> Dict[str, SequentialResult]:
+    chunks = {task: _seeded_chunks(t, max_permutations, max_exact_splits) for task, t in task_tests.items()}
+    # enumerating all splits is an exact test, so it is never stopped early
+    exact = {task for task, task_chunks in chunks.items() if task_chunks[0].seed is None}
+    stopping = {task: SequentialStopping(ALPHA, sum(c.n_permutations for c in chunks[task]),
+                                         stop_early=task not in exact) for task in task_tests}
+    next_chunk = {task: 0 for task in task_tests}
+    if checkpoint is not None:
+        # the tests consume chunks in order, so their progress is the number of chunks used and their counts
+        for task, progress in checkpoint.state.items():
+            next_chunk[task] = progress["next_chunk"]
+            stopping[task].load_state_dict(progress["stopping"])
+
+    with ExitStack() as stack:
+        pool = stack.enter_context(Pool(n_processes)) if n_processes > 1 else None
+        progress = stack.enter_context(tqdm(desc="Permutation chunks"))
+        while not all(s.done for s in stopping.values()):
+            # every undecided task gets the next chunk for each process; the chunks are consumed in order,
+            # so the results do not depend on the number of processes
+            jobs = [(task, task_tests[task], chunk) for task in task_tests if not stopping[task].done
+                    for chunk in chunks[task][next_chunk[task]:next_chunk[task] + n_processes]]
+            exceedances = pool.map(_task_chunk_exceedances, jobs) if pool is not None else \
+                list(map(_task_chunk_exceedances, jobs))
+            for (task, _, _), exceeds in zip(jobs, exceedances):
+                stopping[task].update(exceeds)
+                next_chunk[task] += 1
+            progress.update(len(jobs))
+            if checkpoint is not None:
+                checkpoint.state.update({task: dict(next_chunk=next_chunk[task], stopping=stopping[task].state_dict())
+                                         for task in task_tests})
+                checkpoint.maybe_save()
+
+    results = {task: s.result() for task, s in stopping.items()}
+    return {task: r._replace(mc_error=0.) if task in exact else r for task, r in results.items()}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeded",
+                        action="store_true",
+                        help="Draw permutations in independently seeded chunks, which can run in parallel. "
+                             "By default, permutations are drawn serially as in the paper.")
+    parser.add_argument("--n_processes",
+                        type=int,
+                        default=1,
+                        help="The number of processes to run (with --seeded or --adaptive).")
+    parser.add_argument("--adaptive",
+                        action="store_true",
+                        help="Draw seeded permutations until the p-value is decided at level ALPHA "
+                             "(sequential stopping), up to --max_permutations per task.")
+    parser.add_argument("--max_permutations",
+                        type=int,
+                        default=MAX_PERMUTATIONS,
+                        help="The maximum number of permutations per task. If a task has fewer splits of the "
+                             "annotators, all of them are used.")
+    parser.add_argument("--max_exact_splits",
+                        type=int,
+                        help="Run an exact test (enumerating all splits of the annotators) on tasks with at most "
+                             "this many splits, even if they have more than --max_permutations.")
+    parser.add_argument("--checkpoint",
+                        action="store_true",
+                        help="Save the progress of the permutation tests periodically, and resume from it if the "
+                             "run is restarted.")
+    task_group = parser.add_mutually_exclusive_group()
+    task_group.add_argument("--task",
+                            nargs="+",
+                            choices=DISTRIBUTION_CONFIG.keys(),
+                            help="Only test these tasks, and save their results (to TASK_RESULT_FILE) without "
+                                 "building the table.")
+    task_group.add_argument("--from_task_results",
+                            action="store_true",
+                            help="Build the table from the saved results of each task (see --task) instead of "
+                                 "running the tests.")
+    return parser.parse_args()
+
+
+def _compute_results(args, tasks: List[str]) -> Tuple[Dict[str, float], Dict[str, SequentialResult]]:
+    task_tests = {task: _load_task_test(task, DISTRIBUTION_CONFIG[task]) for task in tasks}
+    mode = "adaptive" if args.adaptive else "seeded" if args.seeded else "legacy"
+    checkpoint = open_checkpoint(
+        f"significance_{mode}",
+        run_key(SEED, ALPHA, args.max_permutations, args.max_exact_splits,
+                {task: t.fingerprint for task, t in task_tests.items()}),
+        args.checkpoint)
+
+    sequential_results = {}
+    if args.adaptive:
+        sequential_results = _adaptive_results(task_tests, args.n_processes, args.max_permutations,
+                                               args.max_exact_splits, checkpoint)
+        results = {task: r.p_value for task, r in sequential_results.items()}
+        for task, r in sequential_results.items():
+            print(f"{task}: p={r.p_value:.4f} (MC error {r.mc_error:.4f}) after {r.n_permutations} permutations")
+    elif args.seeded:
+        results = _seeded_p_values(task_tests, args.n_processes, args.max_permutations, args.max_exact_splits,
+                                   checkpoint)
+    else:
+        results = _legacy_p_values(task_tests, args.max_permutations, args.max_exact_splits, checkpoint)
+
+    for task, p_value in results.items():
+        task_file = TASK_RESULT_FILE.format(task=task)
+        os.makedirs(os.path.dirname(task_file), exist_ok=True)
+        with open(task_file, "w") as f:
+            json.dump(sequential_results[task]._asdict() if task in sequential_results else dict(p_value=p_value),
+                      f, default=lambda value: value.item())
+    if checkpoint is not None:
+        checkpoint.remove()
+    return results, sequential_results
+
+
+def _load_results(tasks: List[str]) -> Tuple[Dict[str, float], Dict[str, SequentialResult]]:
+    results, sequential_results = {}, {}
+    for task in tasks:
+        with open(TASK_RESULT_FILE.format(task=task)) as f:
+            task_results = json.load(f)
+        results[task] = task_results["p_value"]
+        if set(task_results) == set(SequentialResult._fields):
+            sequential_results[task] = SequentialResult(**task_results)
+    # the extra columns are only reported if every task was run with --adaptive
+    return results, sequential_results if len(sequential_results) == len(tasks) else {}
+
+
+def main():
+    args = _parse_args()
+    tasks = [task for task in _tested_tasks() if args.task is None or task in args.task]
+    if args.from_task_results:
+        results, sequential_results = _load_results(tasks)
+    else:
+        results, sequential_results = _compute_results(args, tasks)
+    if args.task is not None:
+        # p-values are corrected across all tasks when the table is built (--from_task_results)
+        return
+
+    columns = ["Task", "p-value"] + (["permutations", "MC error"] if sequential_results else [])
     # FDR correction
     results = fdr_correction(results)
     results_list = [
         (_latex_bold(TASK_ID_TO_NAME.get(t, t), p < ALPHA),
-         _latex_bold(p, p < ALPHA)) 
+         _latex_bold(p, p < ALPHA)) + 
+        ((sequential_results[t].n_permutations, f"{sequential_results[t].mc_error:.4f}") if sequential_results else ())
         for t, p in results.items()]
 
     # format as LaTeX table
-    latex = pd.DataFrame(results_list, columns=["Task", "p-value"]).to_latex(
+    latex = pd.DataFrame(results_list, columns=columns).to_latex(
         caption=f"Results of permutation tests. Results significant at the "\
             f"level $\\alpha={ALPHA}$ are demarcated in \\textbf{{bold}}. "\
             "FDR correction is performed for results across the table.",
@@ -116,6 +302,7 @@ def main():
         index=False,
         escape=False
     )
+    os.makedirs(os.path.split(SAVE_FILE)[0], exist_ok=True)
     with open(SAVE_FILE, "w") as f:
         f.write(latex)
 
@@ -1,14 +1,6 @@
-from functools import partial
-
 import pandas as pd
-from src.tasks.commitmentbank.demographics import create_demographics_map as create_cb_demographics_map
-from src.tasks.commitmentbank.reliability_matrix import create_reliability_matrix as create_cb_reliability_matrix
-from src.tasks.affectivetext.demographics import create_demographics_map as create_at_demographics_map
-from src.tasks.affectivetext.reliability_matrix import create_reliability_matrix as create_at_reliability_matrix
-from src.tasks.wordsim.demographics import create_demographics_map as create_wordsim_demographics_map
-from src.tasks.wordsim.reliability_matrix import create_wordsim_reliability_matrix_sim
-from src.tasks.sentiment.demographics import create_demographics_map as create_sentiment_demographics_map
-from src.tasks.sentiment.reliability_matrix import create_reliability_matrix as create_sentiment_reliability_matrix
+
+from src.config.data import DATASETS
 
 
 TASKS = {
@@ -19,19 +11,12 @@ TASKS = {
 }
 
 
-DEMOGRAPHICS_MAP_FNS = {
-    "affectivetext": create_at_demographics_map,
-    "wordsim": create_wordsim_demographics_map,
-    "sentiment": create_sentiment_demographics_map,
-    "commitmentbank": create_cb_demographics_map,
-}
-
-
-REL_MATRIX_FNS = {
-    "affectivetext": partial(create_at_reliability_matrix, "anger"),
-    "wordsim": create_wordsim_reliability_matrix_sim,
-    "sentiment": create_sentiment_reliability_matrix,
-    "commitmentbank": create_cb_reliability_matrix,
+# the task from each dataset that is summarized (datasets from src/config/data.py, so they use the on-disk cache)
+SUMMARY_TASKS = {
+    "affectivetext": "affectivetext_anger",
+    "wordsim": "wordsim_sim",
+    "sentiment": "sentiment",
+    "commitmentbank": "commitmentbank",
 }
 
 
@@ -42,12 +27,12 @@ OUTPUT_COLS = ["Dataset", "# Male Annotators", "# Female Annotators",
 def main():
     out_data = []
     for task, task_name in TASKS.items():
-        dem_map = DEMOGRAPHICS_MAP_FNS[task]()
+        dataset = DATASETS[SUMMARY_TASKS[task]]
+        dem_map = dataset.demographics()
         n_male = len(dem_map["M"])
         n_female = len(dem_map["F"])
-        rel_matrix = REL_MATRIX_FNS[task]()
-        n_datapoints = len(rel_matrix.columns)
-        avg_annotations_per_datapoint = rel_matrix.count().sum() / n_datapoints
+        n_datapoints = len(dataset.sparse_reliability_matrix().columns)
+        avg_annotations_per_datapoint = dataset.annotation_counts().sum() / n_datapoints
         out_data.append((
             task_name,
             n_male,
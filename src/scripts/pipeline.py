@@ -0,0 +1,155 @@
+"""
+Build the paper's tables and figures incrementally, re-running only the stages whose inputs changed
+
+Stages:
+* agreement/{task}: agreement with aggregates (src/scripts/agreement/compute_agreements.py --task {task})
+* distribution/{task}: permutation test of the label distributions (src/scripts/distributions/significance_table.py
+  --task {task})
+* agreement/table, agreement/plot, distribution/table, distribution/plot: the multi-task tables and figures, built
+  from the per-task results (or, for distribution/plot, from the data of all tasks)
+The inputs of a task's stages are its configuration file and data files (through the keys of the on-disk data cache,
+see src/util/reliability_cache.py), its agreement function or distribution configuration, and the code that computes
+its results; changing one task's configuration only re-runs the stages of that task and the tables and figures
+(see src/util/pipeline.py for how stages are keyed).
+
+PYTHONPATH=. python src/scripts/pipeline.py [targets ...] [--jobs N] [--force] [--dry_run]
+Targets are stage names or patterns (e.g., "agreement/*" or "*/wordsim_sim"); by default, all stages are built.
+Logs of each stage are written to cache/pipeline/logs.
+"""
+import argparse
+import glob
+import os
+import sys
+from typing import List
+
+from src.config.data import DEMOGRAPHICS_FN_MATRIX_MAP, SPARSE_RELIABILITY_FN_MATRIX_MAP, TASK_DATASETS
+from src.config.distribution import DISTRIBUTION_CONFIG
+from src.scripts.agreement.compute_agreements import AgreementComputer
+from src.scripts.agreement.significance_table import SAVE_FILE as AGREEMENT_SAVE_FILE
+from src.scripts.agreement.util import DATA_FILES, TASKS, aggregate_agreement_fn, default_aggregation
+from src.scripts.distributions.significance_table import SAVE_FILE as DISTRIBUTION_SAVE_FILE, TASK_RESULT_FILE, \
+    _tested_tasks
+from src.util.checkpoint import describe_function
+from src.util.pipeline import RAN, UP_TO_DATE, Pipeline, Stage
+from src.util.reliability_cache import current_key
+
+
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def _sources(*patterns: str) -> List[str]:
+    # code read by a stage; the runner itself is not an input
+    paths = [path for pattern in patterns for path in sorted(glob.glob(os.path.join(SRC_DIR, pattern)))]
+    return [path for path in paths if os.path.basename(path) != "pipeline.py"]
+
+
+def _script(path: str) -> List[str]:
+    return [sys.executable, os.path.join(SRC_DIR, path)]
+
+
+def _data_keys(task: str) -> List[str]:
+    # cover the task's configuration file, its data files and its loading code
+    dataset = TASK_DATASETS.get(task, task)
+    return [current_key(dataset, fn_map[task].__wrapped__)
+            for fn_map in (SPARSE_RELIABILITY_FN_MATRIX_MAP, DEMOGRAPHICS_FN_MATRIX_MAP)]
+
+
+AGREEMENT_SOURCES = _sources("agreement/*.py", "util/*.py", "scripts/agreement/compute_agreements.py",
+                             "scripts/agreement/util.py")
+DISTRIBUTION_SOURCES = _sources("distribution/*.py", "util/*.py", "scripts/distributions/significance_table.py")
+TABLE_SOURCES = _sources("util/fdr.py", "config/task_names.py")
+PLOT_SOURCES = _sources("config/plotting.py", "config/task_names.py")
+
+
+def _agreement_stages() -> List[Stage]:
+    stages = []
+    for task in TASKS:
+        aggregation = default_aggregation(task)
+        out_dir = os.path.join(AgreementComputer.OUTPUT_DIR, task, "agreement_with_aggregate")
+        stages.append(Stage(
+            f"agreement/{task}",
+            _script("scripts/agreement/compute_agreements.py") + ["--task", task],
+            outputs=[os.path.join(out_dir, f"{prefix}agreement_{aggregation}{ext}")
+                     for prefix, ext in [("raw_results_", ".json"), ("", ".pdf"), ("ttest_", ".csv")]],
+            inputs=AGREEMENT_SOURCES,
+            fingerprint=[_data_keys(task), aggregation, describe_function(aggregate_agreement_fn(task, aggregation))]))
+
+    results = [DATA_FILES.format(task=task, aggregation=default_aggregation(task)) for task in TASKS]
+    deps = [f"agreement/{task}" for task in TASKS]
+    stages.append(Stage(
+        "agreement/table",
+        _script("scripts/agreement/significance_table.py"),
+        outputs=[AGREEMENT_SAVE_FILE],
+        inputs=results + TABLE_SOURCES + _sources("scripts/agreement/significance_table.py",
+                                                  "scripts/agreement/util.py"),
+        deps=deps))
+    stages.append(Stage(
+        "agreement/plot",
+        _script("scripts/agreement/agreement_plot.py") + ["--use_median"],
+        outputs=["output/agreement/combo/agreement_plot_with_medians.pdf"],
+        inputs=results + PLOT_SOURCES + _sources("scripts/agreement/agreement_plot.py", "scripts/agreement/util.py"),
+        deps=deps))
+    return stages
+
+
+def _distribution_stages() -> List[Stage]:
+    tasks = _tested_tasks()
+    stages = [Stage(
+        f"distribution/{task}",
+        _script("scripts/distributions/significance_table.py") + ["--task", task],
+        outputs=[TASK_RESULT_FILE.format(task=task)],
+        inputs=DISTRIBUTION_SOURCES,
+        fingerprint=[_data_keys(task), DISTRIBUTION_CONFIG[task]]) for task in tasks]
+
+    stages.append(Stage(
+        "distribution/table",
+        _script("scripts/distributions/significance_table.py") + ["--from_task_results"],
+        outputs=[DISTRIBUTION_SAVE_FILE],
+        inputs=[TASK_RESULT_FILE.format(task=task) for task in tasks] + TABLE_SOURCES +
+               _sources("scripts/distributions/significance_table.py"),
+        deps=[f"distribution/{task}" for task in tasks]))
+    # the figures are plotted from the data of all tasks
+    stages.append(Stage(
+        "distribution/plot",
+        _script("scripts/distributions/distribution_plot.py"),
+        outputs=["output/distribution/combo/bar_distribution.pdf", "output/distribution/combo/kde_distribution.pdf"],
+        inputs=PLOT_SOURCES + _sources("scripts/distributions/distribution_plot.py"),
+        fingerprint={task: [_data_keys(task), conf] for task, conf in DISTRIBUTION_CONFIG.items()}))
+    return stages
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets",
+                        nargs="*",
+                        help="The stages to build (with the stages they depend on), as names or patterns "
+                             "(e.g. 'agreement/*'). Defaults to all stages.")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="The number of stages to run at once.")
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="Run the selected stages even if they are up to date.")
+    parser.add_argument("--dry_run",
+                        action="store_true",
+                        help="Only report which stages are stale.")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    pipeline = Pipeline(_agreement_stages() + _distribution_stages())
+    names = pipeline.select(args.targets)
+    if not names:
+        sys.exit(f"No stages match {args.targets}")
+
+    status = pipeline.status(names) if args.dry_run else pipeline.run(names, args.jobs, args.force)
+    for name, stage_status in status.items():
+        print(f"{name}: {stage_status}")
+    if not args.dry_run and any(s not in {RAN, UP_TO_DATE} for s in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""
+List the registered tasks (see src/config/tasks.py)
+
+PYTHONPATH=. python src/scripts/tasks.py
+
+Only the registry is imported, so no data, loader or scientific library is loaded.
+"""
+from src.config.tasks import TASK_REGISTRY
+
+
+COLUMNS = ["task", "name", "dataset", "agreement", "aggregate agreement", "distribution"]
+
+
+def main():
+    rows = [COLUMNS] + [
+        [task, conf.name, conf.dataset, repr(conf.agreement), repr(conf.aggregate_agreement or conf.agreement),
+         conf.distribution["annotation_type"] if conf.distribution else "-"]
+        for task, conf in TASK_REGISTRY.items()]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+if __name__ == "__main__":
+    main()
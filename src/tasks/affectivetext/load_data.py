@@ -1,15 +1,35 @@
 # coding: utf-8
+import io
 import json
 import os
+import re
+from functools import lru_cache
+from typing import NamedTuple, Tuple
 
+import numpy as np
 import pandas as pd
 
 from src.config.data_columns import ANNOTATOR_ID_COL, GENDER_COL, ITEM_ID_COL, ITEM_TEXT_COL, LABEL_COL
 
 EMOTION_COLS = ["anger", "disgust", "fear", "joy", "sadness", "surprise", "valence"]
 ALL_COLS = [ITEM_ID_COL] + EMOTION_COLS
+# lines on which splitting on runs of whitespace differs from splitting on single whitespace characters
+IRREGULAR_WHITESPACE = re.compile(r"\s\s|^\s|\s$")
 
 
+def _read_annotator_file(path: str) -> pd.DataFrame:
+    with open(path) as f:
+        text = f.read()
+    # fields are separated by single whitespace characters, which the C engine parses (sep=r"\s+") much faster than
+    # the python engine; files with runs of whitespace or leading/trailing whitespace, where the two differ (e.g.,
+    # empty fields), are parsed with the original single-character separator
+    if any(IRREGULAR_WHITESPACE.search(line) for line in text.splitlines()):
+        return pd.read_csv(io.StringIO(text), names=ALL_COLS, sep=r"\s", engine="python")
+    return pd.read_csv(io.StringIO(text), names=ALL_COLS, sep=r"\s+")
+
+
+# cached so that the dataset is only loaded once per process; callers must not modify the result
+@lru_cache(maxsize=1)
 def load_full_df():
     with open("config/affectivetext.json") as f:
         data_paths = json.load(f)["data_paths"]
@@ -18,29 +38,61 @@ def load_full_df():
 
     all_annotator_df = []
     for annotator_txt in os.listdir(annotations_dir): # loop through all annotator txt files in path
-        annotator_data = pd.read_csv(os.path.join(annotations_dir, annotator_txt), names=ALL_COLS, sep="\s", engine='python') # each emotion score in a separate column
+        annotator_data = _read_annotator_file(os.path.join(annotations_dir, annotator_txt)) # each emotion score in a separate column
         annotator_name = annotator_txt.split(".")[0]
         annotator_data[ANNOTATOR_ID_COL] = annotator_name # gets the name of the annotator
         annotator_data[GENDER_COL] = annotator_name[0]
         all_annotator_df.append(annotator_data) # list of dfs with annotator id, gender col, emotion cols with each emotion
     annotation_df = pd.concat(all_annotator_df)
     text_df = pd.read_xml(affective_text_path, parser="etree", names=[ITEM_ID_COL, ITEM_TEXT_COL])
-    annotation_df.join(text_df, on=ITEM_ID_COL, rsuffix="_drop")
     return annotation_df.merge(text_df, on=ITEM_ID_COL)
 
 
+class EmotionTensor(NamedTuple):
+    annotators: pd.Index
+    items: pd.Index
+    values: np.ndarray  # annotators x items x emotions (in the order of EMOTION_COLS), NaN where not annotated
+    # whether each emotion's labels were parsed as integers (pivot_table keeps such labels as integers)
+    integer_labels: Tuple[bool, ...]
+
+
+# cached so that all emotions share one tensor; callers must not modify the result
+@lru_cache(maxsize=1)
+def load_emotion_tensor() -> EmotionTensor:
+    annotation_df = load_full_df()
+    annotator_codes, annotators = pd.factorize(annotation_df[ANNOTATOR_ID_COL], sort=True)
+    item_codes, items = pd.factorize(annotation_df[ITEM_ID_COL], sort=True)
+
+    # repeated annotations of an item are averaged, as with pivot_table
+    labels = annotation_df[EMOTION_COLS].to_numpy(dtype=float)
+    annotated = ~np.isnan(labels)
+    shape = (len(annotators), len(items), len(EMOTION_COLS))
+    sums, counts = np.zeros(shape), np.zeros(shape)
+    np.add.at(sums, (annotator_codes, item_codes), np.where(annotated, labels, 0))
+    np.add.at(counts, (annotator_codes, item_codes), annotated)
+    values = np.full(shape, np.nan)
+    np.divide(sums, counts, out=values, where=counts > 0)
+
+    integer_labels = tuple(pd.api.types.is_integer_dtype(annotation_df[emotion]) for emotion in EMOTION_COLS)
+    return EmotionTensor(pd.Index(annotators, name=ANNOTATOR_ID_COL), pd.Index(items, name=ITEM_ID_COL), values,
+                         integer_labels)
+
+
+def emotion_index(emotion: str) -> int:
+    if emotion not in EMOTION_COLS:
+        raise Exception(f"Invalid emotion: {emotion}")
+    return EMOTION_COLS.index(emotion)
+
+
 def _build_emo_column_slice(emotion):
     return [ANNOTATOR_ID_COL, GENDER_COL, ITEM_ID_COL, ITEM_TEXT_COL, emotion]
 
 
 def load_emotion_data(emotion: str):
+    emotion_index(emotion)
     complete_annotator_df = load_full_df()
-    if emotion in EMOTION_COLS:
-        emotion_df = complete_annotator_df.loc[:, _build_emo_column_slice(emotion)]
-        emotion_df = emotion_df.rename(columns={emotion: LABEL_COL})
-    else:
-        raise Exception(f"Invalid emotion: {emotion}")
-    return emotion_df
+    emotion_df = complete_annotator_df.loc[:, _build_emo_column_slice(emotion)]
+    return emotion_df.rename(columns={emotion: LABEL_COL})
 
 
 def load_test(emotion: str):
@@ -49,3 +101,8 @@ def load_test(emotion: str):
 
 def load_train(emotion: str):
     return load_emotion_data(emotion).tail(4500)
+
+
+def clear_cache():
+    load_full_df.cache_clear()
+    load_emotion_tensor.cache_clear()
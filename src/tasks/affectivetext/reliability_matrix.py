@@ -1,8 +1,25 @@
-from src.config.data_columns import ANNOTATOR_ID_COL, ITEM_ID_COL, LABEL_COL
-from src.tasks.affectivetext.load_data import load_emotion_data
+import numpy as np
+import pandas as pd
+
+from src.tasks.affectivetext.load_data import emotion_index, load_emotion_tensor
+from src.util.sparse_matrix import SparseReliabilityMatrix
 
 
 def create_reliability_matrix(emotion: str):
-    annotation_df = load_emotion_data(emotion)
-    return annotation_df.pivot_table(
-        values=LABEL_COL, index=ANNOTATOR_ID_COL, columns=ITEM_ID_COL)
+    tensor = load_emotion_tensor()
+    index = emotion_index(emotion)
+    values = tensor.values[:, :, index]
+    # as with pivot_table, annotators and items without labels for this emotion are dropped
+    rows, columns = ~np.isnan(values).all(axis=1), ~np.isnan(values).all(axis=0)
+    if not rows.all() or not columns.all():
+        values = values[np.ix_(rows, columns)]
+    # and integer labels stay integers when every annotator labeled every item
+    if tensor.integer_labels[index] and not np.isnan(values).any() and np.array_equal(values, np.round(values)):
+        values = values.astype(np.int64)
+    # a view of the emotion's slice of the shared tensor unless rows, columns or the dtype changed, so callers must
+    # not modify it
+    return pd.DataFrame(values, index=tensor.annotators[rows], columns=tensor.items[columns], copy=False)
+
+
+def create_sparse_reliability_matrix(emotion: str) -> SparseReliabilityMatrix:
+    return SparseReliabilityMatrix.from_dense(create_reliability_matrix(emotion))
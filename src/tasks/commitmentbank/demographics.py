@@ -4,4 +4,4 @@ from src.tasks.commitmentbank.load_data import load_commitmentbank_data
 
 def create_demographics_map():
     df = load_commitmentbank_data()
-    return df.groupby(GENDER_COL).agg(set)[ANNOTATOR_ID_COL].to_dict()
+    return {gender: sorted(set(users)) for gender, users in df.groupby(GENDER_COL)[ANNOTATOR_ID_COL]}
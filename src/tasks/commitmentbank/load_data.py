@@ -1,10 +1,12 @@
 import json
+from functools import lru_cache
 
 import pandas as pd
 
 from src.config.data_columns import ANNOTATOR_ID_COL, GENDER_COL, ITEM_ID_COL, \
     LABEL_COL
 from src.util import remove_inconsistent_gender_annotators
+from src.util.streaming import read_csv_chunked
 
 COL_MAPPING = {
     "uID": ITEM_ID_COL, 
@@ -12,6 +14,8 @@ COL_MAPPING = {
     "AnonymizedWorkerID": ANNOTATOR_ID_COL, 
     "Answer": LABEL_COL
 }
+# explicit dtypes, so that every chunk parses a column the same way
+COL_DTYPES = {"uID": str, "gender": str, "AnonymizedWorkerID": str, "Answer": float}
 
 # NOTE: genders not covered: genderless, non-binary, one spam entry
 GENDER_MAPPING = {
@@ -31,19 +35,28 @@ def _cleanup_gender(gender_col: pd.Series) -> pd.Series:
     return gender_col
 
 
+def _clean_chunk(cb_df: pd.DataFrame) -> pd.DataFrame:
+    cb_df = cb_df[COL_MAPPING.values()].copy()
+    cb_df[GENDER_COL] = _cleanup_gender(cb_df[GENDER_COL])
+
+    # keep M/F (other classes are too small)
+    return cb_df[cb_df[GENDER_COL].isin({"M", "F"})]
+
+
+# cached so that the dataset is only loaded once per process; callers must not modify the result
+@lru_cache(maxsize=1)
 def load_commitmentbank_data() -> pd.DataFrame:
     with open("config/commitmentbank.json") as f:
         data_path = json.load(f)["data_paths"]["data"]
 
-    cb_df = pd.read_csv(data_path)
-    cb_df.rename(columns=COL_MAPPING, inplace=True)
-    cb_df = cb_df[COL_MAPPING.values()]
-    cb_df[GENDER_COL] = _cleanup_gender(cb_df[GENDER_COL])
-
-    # keep M/F (other classes are too small)
-    cb_df = cb_df[cb_df[GENDER_COL].isin({"M", "F"})]
+    # only the mapped columns are read, and genders are cleaned up chunk by chunk
+    cb_df = read_csv_chunked(data_path, COL_MAPPING, _clean_chunk, dtype=COL_DTYPES)
 
-    # remove annotators who reported inconsistent gender (1 annotator)
+    # remove annotators who reported inconsistent gender (1 annotator); this needs all of the data
     cb_df = remove_inconsistent_gender_annotators(cb_df)
 
     return cb_df
+
+
+def clear_cache():
+    load_commitmentbank_data.cache_clear()
@@ -1,8 +1,22 @@
+import pandas as pd
+
 from src.config.data_columns import ANNOTATOR_ID_COL, ITEM_ID_COL, LABEL_COL
 from src.tasks.commitmentbank.load_data import load_commitmentbank_data
+from src.util.sparse_matrix import SparseReliabilityMatrix
 
 
 def create_reliability_matrix():
     annotation_df = load_commitmentbank_data()
     return annotation_df.pivot_table(
         values=LABEL_COL, index=ANNOTATOR_ID_COL, columns=ITEM_ID_COL)
+
+
+def create_sparse_reliability_matrix() -> SparseReliabilityMatrix:
+    annotation_df = load_commitmentbank_data()
+    # repeated annotations of an item are averaged, as with pivot_table
+    labels = annotation_df.groupby([ANNOTATOR_ID_COL, ITEM_ID_COL])[LABEL_COL].mean().dropna()
+    annotator_codes, annotators = pd.factorize(labels.index.get_level_values(ANNOTATOR_ID_COL), sort=True)
+    item_codes, items = pd.factorize(labels.index.get_level_values(ITEM_ID_COL), sort=True)
+    return SparseReliabilityMatrix.from_long(annotator_codes, item_codes, labels.to_numpy(dtype=float),
+                                             pd.Index(annotators, name=ANNOTATOR_ID_COL),
+                                             pd.Index(items, name=ITEM_ID_COL))
@@ -1,8 +1,11 @@
 import json
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
 
 from src.config.data_columns import ANNOTATOR_ID_COL, GENDER_COL, ITEM_ID_COL, ITEM_TEXT_COL, LABEL_COL
+from src.util.streaming import read_csv_chunked
 
 
 CONFIG_FILE = "config/sentiment.json"
@@ -17,6 +20,15 @@ COL_MAPPING = {
     "unit_text": ITEM_TEXT_COL,
 }
 
+# explicit dtypes, so that every chunk parses a column the same way (respondent IDs are integers, as in the
+# demographics file they are merged with)
+COL_DTYPES = {
+    "annotation": str,
+    "respondent_id": "int64",
+    "unit_id": "int64",
+    "unit_text": str,
+}
+
 RESPONSE_MAP = {
     "Very positive": 4,
     "Somewhat positive": 3,
@@ -26,8 +38,11 @@ RESPONSE_MAP = {
 }
 
 
-def _map_response(response: str) -> int:
-    return RESPONSE_MAP[response]
+def _map_responses(responses: pd.Series) -> np.ndarray:
+    codes = pd.Categorical(responses, categories=list(RESPONSE_MAP)).codes
+    if (codes < 0).any():
+        raise KeyError(responses[codes < 0].iloc[0])
+    return np.array(list(RESPONSE_MAP.values()))[codes]
 
 
 def _get_data_path(path_name: str) -> str:
@@ -35,28 +50,56 @@ def _get_data_path(path_name: str) -> str:
         return json.load(f)["data_paths"][path_name]
 
 
-def _merge_demographics(sentiment_data: pd.DataFrame) -> pd.DataFrame:
-    # add gender column to data
+# cached so that the demographics file is only read once for both splits
+@lru_cache(maxsize=1)
+def _load_demographics() -> pd.DataFrame:
     demographics_data = pd.read_csv(_get_data_path("demographics"), usecols=["respondent_id", CSV_GENDER_COL])
     demographics_data.rename(columns=COL_MAPPING, inplace=True)
     demographics_data[GENDER_COL] = demographics_data[GENDER_COL].str[:1]
-    merged_demographics = pd.merge(sentiment_data, demographics_data, on=ANNOTATOR_ID_COL)
+    return demographics_data
+
+
+def _merge_demographics(sentiment_data: pd.DataFrame) -> pd.DataFrame:
+    # add gender column to data
+    merged_demographics = pd.merge(sentiment_data, _load_demographics(), on=ANNOTATOR_ID_COL)
     
     # there is only one nonbinary annotator who cannot be modeled - reduce to M/F
     merged_demographics = merged_demographics[merged_demographics[GENDER_COL].isin({"M", "F"})]
     return merged_demographics
 
 
-def _load_sentiment(train_or_test: str) -> pd.DataFrame:
-    sentiment_data = pd.read_csv(_get_data_path(train_or_test), encoding="ISO-8859-1")
-    sentiment_data["annotation"] = sentiment_data["annotation"].apply(_map_response)
-    sentiment_data.rename(columns=COL_MAPPING, inplace=True)
+def _map_chunk_responses(sentiment_data: pd.DataFrame) -> pd.DataFrame:
+    sentiment_data[LABEL_COL] = _map_responses(sentiment_data[LABEL_COL])
     return sentiment_data
 
 
+def _load_sentiment(train_or_test: str) -> pd.DataFrame:
+    # only the mapped columns are read, and responses are mapped chunk by chunk
+    return read_csv_chunked(_get_data_path(train_or_test), COL_MAPPING, _map_chunk_responses, encoding="ISO-8859-1",
+                            dtype=COL_DTYPES)
+
+
+# cached so that the dataset is only loaded once per process; callers must not modify the result
+@lru_cache(maxsize=1)
 def load_train():
     return _merge_demographics(_load_sentiment("train"))[COL_MAPPING.values()]
 
 
+# cached so that the dataset is only loaded once per process; callers must not modify the result
+@lru_cache(maxsize=1)
 def load_test():
     return _merge_demographics(_load_sentiment("test"))[COL_MAPPING.values()]
+
+
+# cached so that the dataset is only loaded once per process; callers must not modify the result
+@lru_cache(maxsize=1)
+def load_data():
+    """
+    Train and test data concatenated, shared by the reliability matrix and demographics map
+    """
+    return pd.concat((load_train(), load_test()))
+
+
+def clear_cache():
+    for cached_fn in (_load_demographics, load_train, load_test, load_data):
+        cached_fn.cache_clear()
@@ -1,25 +1,18 @@
-from collections import defaultdict
-
-import numpy as np
 import pandas as pd
 
 from src.config.data_columns import ANNOTATOR_ID_COL, ITEM_ID_COL, LABEL_COL
-from src.tasks.sentiment.load_data import load_test, load_train
-
+from src.tasks.sentiment.load_data import load_data
+from src.util.sparse_matrix import SparseReliabilityMatrix
 
-def create_reliability_matrix():
-    data = pd.concat((load_train(), load_test()))
-    unit_ids = sorted(data[ITEM_ID_COL].unique())
 
-    def init_nan():
-        array = np.empty(len(unit_ids))
-        array[:] = np.NaN
-        return array
+def create_sparse_reliability_matrix() -> SparseReliabilityMatrix:
+    data = load_data()
+    # annotators in order of appearance, items sorted by id
+    annotator_codes, annotators = pd.factorize(data[ANNOTATOR_ID_COL])
+    item_codes, items = pd.factorize(data[ITEM_ID_COL], sort=True)
+    return SparseReliabilityMatrix.from_long(annotator_codes, item_codes, data[LABEL_COL].to_numpy(dtype=float),
+                                             pd.Index(annotators), pd.Index(items))
 
-    unit_id_to_idx = {unit_id: idx for idx, unit_id in enumerate(unit_ids)}
 
-    worker_annotations = defaultdict(init_nan)
-    for _, row in data.iterrows():
-        worker_annotations[row[ANNOTATOR_ID_COL]][unit_id_to_idx[row[ITEM_ID_COL]]] = row[LABEL_COL]
-
-    return pd.DataFrame.from_dict(worker_annotations, orient="index", columns=unit_ids)
+def create_reliability_matrix():
+    return create_sparse_reliability_matrix().to_dense()
@@ -2,15 +2,25 @@
 Functions to load data for wordsim dataset
 """
 import json
+from functools import lru_cache
 
 import pandas as pd
 
 from src.config.data_columns import ANNOTATOR_ID_COL, GENDER_COL
 from src.util import remove_inconsistent_gender_annotators
 from src.tasks.wordsim.load_data_helpers import time_spent
+from src.util.streaming import read_csv_chunked
 
 CONFIG_FILE = "config/wordsim.json"
 APPROVAL_COLUMN = "ApprovalTime"
+TIME_COLUMNS = ["AcceptTime", "SubmitTime"]
+
+# columns of the word pairs of a HIT and of their ratings (one rating column per measure)
+N_PAIRS_PER_HIT = 25
+INPUT_A_FMT = "Input.Act_{}A"
+INPUT_B_FMT = "Input.Act_{}B"
+SIM_REL_FMT = "Answer.{}_{}"
+MEASURES = ("rel", "sim")
 
 
 COLUMN_MAPPING = {
@@ -19,12 +29,27 @@ COLUMN_MAPPING = {
 }
 
 
+def column_group(fmt: str, *args) -> list:
+    return [fmt.format(*args, i) for i in range(1, N_PAIRS_PER_HIT + 1)]
+
+
+WORD_COLUMNS = column_group(INPUT_A_FMT) + column_group(INPUT_B_FMT)
+RATING_COLUMNS = [column for measure in MEASURES for column in column_group(SIM_REL_FMT, measure)]
+
+# only these columns of the HITs are parsed (others, e.g. free text answers, are not); COLUMN_MAPPING renames some
+USED_COLUMNS = {column: column for column in [APPROVAL_COLUMN] + TIME_COLUMNS + WORD_COLUMNS + RATING_COLUMNS} | \
+    COLUMN_MAPPING
+# explicit dtypes, so that every chunk parses a column the same way
+COLUMN_DTYPES = {"WorkerId": str, "Answer.gender": str} | {column: str for column in WORD_COLUMNS} | \
+    {column: float for column in RATING_COLUMNS}
+
+
 def _load_country(country_code, **kwargs):
     with open(CONFIG_FILE) as f:
         us_path = json.load(f)["data_paths"][country_code]
-    df = pd.read_csv(us_path)
-    df = df[~df[APPROVAL_COLUMN].isna()]
-    df.rename(columns=COLUMN_MAPPING, inplace=True)
+    # HITs that were not approved are dropped chunk by chunk
+    df = read_csv_chunked(us_path, USED_COLUMNS, lambda chunk: chunk[~chunk[APPROVAL_COLUMN].isna()],
+                          dtype=COLUMN_DTYPES)
     if kwargs.get("time_spent"):
         df["TimeSpent"] = time_spent(df)
     return df
@@ -59,8 +84,14 @@ def load_female(**kwargs):
     return _load_gender("F", **kwargs)
 
 
+# cached so that the dataset is only loaded once per process; callers must not modify the result
+@lru_cache(maxsize=2)
 def load_data(time_spent=False):
     df = pd.concat((load_male(time_spent=time_spent), 
         load_female(time_spent=time_spent)))
     df = remove_inconsistent_gender_annotators(df)
     return df.reset_index(drop=True)
+
+
+def clear_cache():
+    load_data.cache_clear()
@@ -15,9 +15,17 @@ def parse_time(time_string) -> datetime:
     return datetime.strptime(removed_timezone, "%a %b %d %H:%M:%S %Y")
 
 
+def parse_times(time_strings: pd.Series) -> pd.Series:
+    """
+    Vectorized version of parse_time for a series of time strings
+    """
+    normalized = time_strings.str.strip().str.replace(r"\s+", " ", regex=True)
+    removed_timezone = normalized.str.replace(r" \S+ (\S+)$", r" \1", regex=True)
+    return pd.to_datetime(removed_timezone, format="%a %b %d %H:%M:%S %Y")
+
+
 def time_spent(df) -> pd.Series:
     """
     Create a pandas series representing the time spent by the annotator
     """
-    return (df["SubmitTime"].apply(parse_time) - df["AcceptTime"].apply(parse_time)).apply(
-        lambda x: x.total_seconds())
+    return (parse_times(df["SubmitTime"]) - parse_times(df["AcceptTime"])).dt.total_seconds()
@@ -1,45 +1,68 @@
-from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, Iterable
 
 import numpy as np
 import pandas as pd
 
 from src.config.data_columns import ANNOTATOR_ID_COL
-from src.tasks.wordsim.load_data import load_data
+from src.tasks.wordsim.load_data import INPUT_A_FMT, INPUT_B_FMT, MEASURES, N_PAIRS_PER_HIT, SIM_REL_FMT, \
+    clear_cache as clear_data_cache, column_group, load_data
+from src.util.sparse_matrix import SparseReliabilityMatrix
+
+
+def create_sparse_reliability_matrices(df: pd.DataFrame,
+                                       measures: Iterable[str] = MEASURES) -> Dict[str, SparseReliabilityMatrix]:
+    """
+    Create reliability matrices for several measures from a dataframe of HITs (one row per HIT, 25 word pairs each)
+    Rows and columns are ordered by first appearance of the annotator/word pair. If an annotator rated the same
+    pair more than once, the last rating is kept.
+    """
+    # wide to long: one entry per (HIT, pair), in row-major order
+    words_a = df[column_group(INPUT_A_FMT)].to_numpy().ravel()
+    words_b = df[column_group(INPUT_B_FMT)].to_numpy().ravel()
+    pair_codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([words_a, words_b]))
+    worker_codes, workers = pd.factorize(df[ANNOTATOR_ID_COL])
+    worker_codes = np.repeat(worker_codes, N_PAIRS_PER_HIT)
+
+    columns = pd.Index(pairs.tolist(), tupleize_cols=False)
+    return {
+        measure: SparseReliabilityMatrix.from_long(
+            worker_codes, pair_codes, df[column_group(SIM_REL_FMT, measure)].to_numpy(dtype=float).ravel(),
+            pd.Index(workers), columns)
+        for measure in measures
+    }
+
+
+def create_reliability_matrices(df: pd.DataFrame, measures: Iterable[str] = MEASURES) -> Dict[str, pd.DataFrame]:
+    return {measure: matrix.to_dense() for measure, matrix in create_sparse_reliability_matrices(df, measures).items()}
 
 
 def create_reliability_matrix(df: pd.DataFrame, measure: str):
-    input_a_fmt = "Input.Act_{}A"
-    input_b_fmt = "Input.Act_{}B"
-    sim_rel_fmt = "Answer.{}_{}"
-    pair_to_idx = {}
-    for _, row in df.iterrows():
-        for i in range(1, 26):
-            pair = (row[input_a_fmt.format(i)], row[input_b_fmt.format(i)])
-            if pair not in pair_to_idx:
-                pair_to_idx[pair] = len(pair_to_idx)
-    
-    def init_nan():
-        array = np.empty(len(pair_to_idx))
-        array[:] = np.NaN
-        return array
-
-    worker_annotations = defaultdict(init_nan)
-    
-    for _, row in df.iterrows():
-        for i in range(1, 26):
-            pair = (row[input_a_fmt.format(i)], row[input_b_fmt.format(i)])
-            if pair not in pair_to_idx:
-                pair_to_idx[pair] = len(pair_to_idx)
-            worker_annotations[row[ANNOTATOR_ID_COL]][pair_to_idx[pair]] = row[sim_rel_fmt.format(measure, i)]
-            
-    columns = [x[0] for x in sorted(pair_to_idx.items(), key=lambda x: x[1])]
-    return pd.DataFrame.from_dict(worker_annotations, orient="index", columns=columns)
+    return create_reliability_matrices(df, [measure])[measure]
+
+
+# both matrices are built from a single load of the data; callers must not modify the sparse matrices
+@lru_cache(maxsize=1)
+def _create_wordsim_sparse_reliability_matrices() -> Dict[str, SparseReliabilityMatrix]:
+    return create_sparse_reliability_matrices(load_data())
+
 
 def create_wordsim_reliability_matrix_rel():
-    data = load_data(time_spent=True)
-    return create_reliability_matrix(data, "rel")
+    return _create_wordsim_sparse_reliability_matrices()["rel"].to_dense()
 
 
 def create_wordsim_reliability_matrix_sim():
-    data = load_data(time_spent=True)
-    return create_reliability_matrix(data, "sim")
+    return _create_wordsim_sparse_reliability_matrices()["sim"].to_dense()
+
+
+def create_wordsim_sparse_reliability_matrix_rel() -> SparseReliabilityMatrix:
+    return _create_wordsim_sparse_reliability_matrices()["rel"]
+
+
+def create_wordsim_sparse_reliability_matrix_sim() -> SparseReliabilityMatrix:
+    return _create_wordsim_sparse_reliability_matrices()["sim"]
+
+
+def clear_cache():
+    _create_wordsim_sparse_reliability_matrices.cache_clear()
+    clear_data_cache()
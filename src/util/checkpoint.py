@@ -0,0 +1,125 @@
+"""
+Checkpoints of long runs, to resume them after a crash or preemption
+
+A Checkpoint holds the completed work of one run (e.g., per-annotator agreements, or permutation counts and RNG
+states) as a JSON-serializable dict. It is written to CHECKPOINT_DIR at most every save_interval seconds (and when
+the run is done with a part of its work), atomically, so that a crash while saving keeps the previous checkpoint.
+Checkpoints are keyed by a hash of everything that determines the results of the run (inputs, parameters, seeds):
+a restarted run with the same key resumes from the saved state, and skips the work already done, so its results
+are the same as those of an uninterrupted run. The checkpoint is removed when the run completes.
+"""
+import hashlib
+import json
+import os
+import time
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.util.sparse_matrix import ReliabilityMatrix, as_sparse
+
+
+CHECKPOINT_DIR = "cache/checkpoints"
+DEFAULT_SAVE_INTERVAL = 60.
+
+
+def run_key(*components: Any) -> str:
+    """
+    Hash of the components that determine the results of a run (JSON-serializable, or described by their str)
+    """
+    return hashlib.sha256(json.dumps(components, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def describe_demographics(demographics: Dict[str, Iterable]) -> Dict[str, List[str]]:
+    """
+    A canonical form of a demographics map for run keys: groups may be sets, whose order depends on the hash seed,
+    or lists in any order (e.g., as loaded from the on-disk cache)
+    """
+    return {str(dem): sorted(map(str, users)) for dem, users in demographics.items()}
+
+
+def describe_function(fn: Callable) -> Any:
+    """
+    A description of a (partial) function for run keys, without the memory addresses of its repr
+    """
+    if isinstance(fn, partial):
+        return [describe_function(fn.func), list(fn.args), fn.keywords]
+    return f"{getattr(fn, '__module__', None)}.{getattr(fn, '__qualname__', repr(fn))}"
+
+
+def matrix_fingerprint(reliability_matrix: ReliabilityMatrix) -> str:
+    """
+    Hash of the annotations and the annotator/item labels of a reliability matrix
+    """
+    matrix = as_sparse(reliability_matrix)
+    digest = hashlib.sha256()
+    for array in (matrix.indptr, matrix.item_codes, matrix.labels):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps([matrix.index.tolist(), matrix.columns.tolist()], default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+def rng_state_to_json(state: tuple) -> list:
+    """
+    The state of the legacy np.random generator (np.random.get_state()) as JSON
+    """
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)]
+
+
+def rng_state_from_json(state: list) -> tuple:
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian
+
+
+class Checkpoint:
+    """
+    Saved state of a run, in CHECKPOINT_DIR/{name}-{key}.json
+    """
+
+    def __init__(self, name: str, key: str, save_interval: float = DEFAULT_SAVE_INTERVAL,
+                 checkpoint_dir: str = CHECKPOINT_DIR):
+        self.path = os.path.join(checkpoint_dir, f"{name}-{key}.json")
+        self.save_interval = save_interval
+        self.state: Dict[str, Any] = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+        self.resumed = bool(self.state)
+        self._last_save = time.monotonic()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
+
+    def maybe_save(self):
+        """
+        Save if save_interval seconds have passed since the last save
+        """
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def remove(self):
+        """
+        Remove the checkpoint once the run is complete
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.state = {}
+
+
+def open_checkpoint(name: str, key: str, enabled: bool = True) -> Optional[Checkpoint]:
+    """
+    :return: the checkpoint of the run (resumed if it was saved before), or None if checkpointing is disabled
+    """
+    if not enabled:
+        return None
+    checkpoint = Checkpoint(name, key)
+    if checkpoint.resumed:
+        print(f"Resuming {name} from {checkpoint.path}")
+    return checkpoint
@@ -0,0 +1,106 @@
+"""
+Integer-coded dense reliability matrices
+
+Ordinal tasks only have a handful of labels, but a float64 reliability matrix stores each of them in 8 bytes so
+that NaN can mark missing annotations. A CodedReliabilityMatrix stores the position of each label in
+`value_domain` as int8 (int16 for larger domains) with a separate boolean mask of the annotated cells, so a cell
+takes 2 bytes, and per-annotator label histograms are a bincount over contiguous integer codes.
+`index` and `columns` have the same meaning as for the dense DataFrame.
+"""
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from src.util.sparse_matrix import SparseReliabilityMatrix
+
+
+def code_dtype(n_values: int) -> np.dtype:
+    """
+    The smallest integer type that can hold codes for n_values labels
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_values <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+class CodedReliabilityMatrix:
+    """
+    The label of annotator `index[i]` for item `columns[j]` is value_domain[codes[i, j]] where mask[i, j] is True
+    (codes are 0 where mask is False)
+    """
+
+    def __init__(self, codes: np.ndarray, mask: np.ndarray, value_domain: np.ndarray, index: pd.Index,
+                 columns: pd.Index):
+        self.codes = codes
+        self.mask = mask
+        self.value_domain = value_domain
+        self.index = index
+        self.columns = columns
+
+    @staticmethod
+    def from_sparse(matrix: SparseReliabilityMatrix) -> "CodedReliabilityMatrix":
+        value_domain, codes = np.unique(matrix.labels, return_inverse=True)
+        dense_codes = np.zeros(matrix.shape, dtype=code_dtype(len(value_domain)))
+        mask = np.zeros(matrix.shape, dtype=bool)
+        rows = matrix.row_codes()
+        dense_codes[rows, matrix.item_codes] = codes
+        mask[rows, matrix.item_codes] = True
+        return CodedReliabilityMatrix(dense_codes, mask, value_domain, matrix.index, matrix.columns)
+
+    @staticmethod
+    def from_dense(reliability_matrix: Union[pd.DataFrame, np.ndarray]) -> "CodedReliabilityMatrix":
+        return CodedReliabilityMatrix.from_sparse(SparseReliabilityMatrix.from_dense(reliability_matrix))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.mask.nbytes
+
+    def take(self, rows: Sequence[int]) -> "CodedReliabilityMatrix":
+        """
+        The matrix with only the given rows (in the given order)
+        """
+        rows = np.asarray(rows, dtype=int).reshape(-1)
+        return CodedReliabilityMatrix(self.codes[rows], self.mask[rows], self.value_domain, self.index[rows],
+                                      self.columns)
+
+    def sort_index(self) -> "CodedReliabilityMatrix":
+        """
+        The matrix with rows sorted by annotator, as DataFrame.sort_index
+        """
+        return self.take(self.index.argsort(kind="stable"))
+
+    def labels(self, rows: Sequence[int] = None) -> np.ndarray:
+        """
+        Labels of the annotations of the given rows (all rows by default), row by row
+        """
+        if rows is None:
+            return self.value_domain[self.codes[self.mask]]
+        matrix = self.take(rows)
+        return matrix.value_domain[matrix.codes[matrix.mask]]
+
+    def histograms(self) -> np.ndarray:
+        """
+        :return: array of shape (n_rows, len(value_domain)) with the label counts of each row
+        """
+        n_rows, n_values = len(self.codes), len(self.value_domain)
+        rows = np.broadcast_to(np.arange(n_rows, dtype=np.int64)[:, np.newaxis], self.shape)[self.mask]
+        return np.bincount(rows * n_values + self.codes[self.mask], minlength=n_rows * n_values).reshape(
+            n_rows, n_values)
+
+    def to_sparse(self) -> SparseReliabilityMatrix:
+        # nonzero is in row-major order, which is the CSR order
+        _, item_codes = np.nonzero(self.mask)
+        indptr = np.concatenate(([0], np.cumsum(self.mask.sum(axis=1))))
+        return SparseReliabilityMatrix(indptr, item_codes, self.value_domain[self.codes[self.mask]], self.index,
+                                       self.columns)
+
+    def to_dense(self) -> pd.DataFrame:
+        values = np.where(self.mask, self.value_domain[self.codes], np.nan) if len(self.value_domain) > 0 else \
+            np.full(self.shape, np.nan)
+        return pd.DataFrame(values, index=self.index, columns=self.columns)
@@ -0,0 +1,148 @@
+"""
+Per-task datasets with in-memory memoization
+
+A Dataset gives access to everything derived from a task's data: the reliability matrix (dense, sparse or coded),
+the demographics map, annotation counts and label histograms. Each is built at most once per process (with the
+builders of src/config/data.py, so through the on-disk cache) and kept in memory, so scripts that need both the
+matrix and the demographics of a task do not load its data twice.
+
+DatasetRegistry bounds the memory held by all of its datasets: when the memoized objects take more than max_bytes,
+the least recently used datasets are released, along with the in-process caches of their loaders.
+Memoized objects are shared, so callers must not modify them.
+"""
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.util.coded_matrix import CodedReliabilityMatrix
+from src.util.sparse_matrix import SparseReliabilityMatrix
+
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def nbytes(value: Any) -> int:
+    """
+    Memory taken by the arrays of a memoized object (objects without arrays, e.g. demographics maps, are not counted)
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True)))
+    if isinstance(value, (np.ndarray, SparseReliabilityMatrix, CodedReliabilityMatrix)):
+        return value.nbytes
+    return 0
+
+
+class Dataset:
+    """
+    Memoized data of one task
+    """
+
+    def __init__(self, task: str, reliability_fn: Callable[[], pd.DataFrame],
+                 sparse_reliability_fn: Callable[[], SparseReliabilityMatrix],
+                 demographics_fn: Callable[[], Dict[str, List[Any]]], clear_cache_fn: Optional[Callable] = None):
+        """
+        :param clear_cache_fn: releases the in-process caches of the task's loaders (e.g. lru_cache of the raw data)
+        """
+        self.task = task
+        self._reliability_fn = reliability_fn
+        self._sparse_reliability_fn = sparse_reliability_fn
+        self._demographics_fn = demographics_fn
+        self._clear_cache_fn = clear_cache_fn
+        self._memo: Dict[str, Any] = {}
+        # called when an object is memoized (set by DatasetRegistry to enforce its memory bound)
+        self.on_update: Callable[["Dataset"], None] = lambda dataset: None
+
+    def _memoized(self, key: str, build: Callable[[], Any]) -> Any:
+        if key not in self._memo:
+            self._memo[key] = build()
+            self.on_update(self)
+        return self._memo[key]
+
+    def reliability_matrix(self) -> pd.DataFrame:
+        return self._memoized("reliability_matrix", self._reliability_fn)
+
+    def sparse_reliability_matrix(self) -> SparseReliabilityMatrix:
+        return self._memoized("sparse_reliability_matrix", self._sparse_reliability_fn)
+
+    def coded_reliability_matrix(self) -> CodedReliabilityMatrix:
+        return self._memoized("coded_reliability_matrix",
+                              lambda: CodedReliabilityMatrix.from_sparse(self.sparse_reliability_matrix()))
+
+    def demographics(self) -> Dict[str, List[Any]]:
+        return self._memoized("demographics", self._demographics_fn)
+
+    def annotation_counts(self) -> pd.Series:
+        """
+        The number of annotations of each annotator
+        """
+        def build():
+            matrix = self.sparse_reliability_matrix()
+            return pd.Series(matrix.row_lengths(), index=matrix.index)
+        return self._memoized("annotation_counts", build)
+
+    def label_histograms(self) -> pd.DataFrame:
+        """
+        The number of annotations of each annotator (rows) with each label (columns)
+        """
+        def build():
+            matrix = self.coded_reliability_matrix()
+            return pd.DataFrame(matrix.histograms(), index=matrix.index, columns=matrix.value_domain)
+        return self._memoized("label_histograms", build)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(nbytes(value) for value in self._memo.values())
+
+    def release(self):
+        """
+        Drop all memoized objects and the caches of the loaders
+        """
+        self._memo.clear()
+        if self._clear_cache_fn is not None:
+            self._clear_cache_fn()
+
+
+class DatasetRegistry(Mapping):
+    """
+    Datasets by task, released in least recently used order to keep their memory under max_bytes
+    """
+
+    def __init__(self, datasets: Dict[str, Dataset], max_bytes: int = DEFAULT_MAX_BYTES):
+        self._datasets = datasets
+        self.max_bytes = max_bytes
+        # tasks with memoized objects, least recently used first
+        self._recent: OrderedDict = OrderedDict()
+        for dataset in datasets.values():
+            dataset.on_update = self._update
+
+    def __getitem__(self, task: str) -> Dataset:
+        dataset = self._datasets[task]
+        if task in self._recent:
+            self._recent.move_to_end(task)
+        return dataset
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._datasets)
+
+    def __len__(self) -> int:
+        return len(self._datasets)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._datasets[task].nbytes for task in self._recent)
+
+    def _update(self, dataset: Dataset):
+        self._recent[dataset.task] = None
+        self._recent.move_to_end(dataset.task)
+        # the dataset being built is never released, even if it alone is over the limit
+        while self.nbytes > self.max_bytes and len(self._recent) > 1:
+            task, _ = self._recent.popitem(last=False)
+            self._datasets[task].release()
+
+    def release(self):
+        for task in self._recent:
+            self._datasets[task].release()
+        self._recent.clear()
@@ -2,8 +2,6 @@ from typing import Dict, Union
 
 import pandas as pd
 
-from statsmodels.stats.multitest import fdrcorrection
-
 
 def fdr_correction(pvalue_map: Union[Dict[str, float], pd.Series], alpha: float = 0.05) -> Union[Dict[str, float], pd.Series]:
     """
@@ -13,6 +11,9 @@ def fdr_correction(pvalue_map: Union[Dict[str, float], pd.Series], alpha: float
     :param alpha: the error rate to use with FDR. Default to 0.05, for consistency with everything else we are doing
     :return: corrected dictionary (or pandas series) of strings to p-values after false discovery rate correction
     """
+    # statsmodels is slow to import, so it is only imported when needed
+    from statsmodels.stats.multitest import fdrcorrection
+
     pvalue_map_dict = pvalue_map if type(pvalue_map) == dict else pvalue_map.to_dict()
     p_vals = list(pvalue_map_dict.values())
     _, corrected_pvals = fdrcorrection(p_vals, alpha)
@@ -0,0 +1,67 @@
+"""
+Lazily imported functions and lazily built maps
+
+The configuration maps (src/config/data.py, src/config/agreement.py) name a function for every task. Importing all of
+them up front imports every task's loaders and their dependencies, even to print --help. A LazyFunction only records
+where its function is defined and imports it on first call; a LazyMap only builds its values on first access.
+"""
+import importlib
+import importlib.util
+from collections.abc import Mapping
+from functools import partial
+from typing import Any, Callable, Dict, Iterator
+
+
+class LazyFunction:
+    """
+    The function `name` of `module`, with any leading args and keyword args bound as with functools.partial
+
+    Only the module and function names are pickled, so lazy functions can be sent to worker processes.
+    """
+
+    def __init__(self, module: str, name: str, *args, **kwargs):
+        self.module = module
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    def resolve(self) -> Callable:
+        """
+        Import the function (a partial if arguments are bound)
+        """
+        fn = getattr(importlib.import_module(self.module), self.name)
+        return partial(fn, *self.args, **self.kwargs) if self.args or self.kwargs else fn
+
+    def source_file(self) -> str:
+        """
+        The file defining the function, found without importing it
+        """
+        return importlib.util.find_spec(self.module).origin
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        bound = [repr(arg) for arg in self.args] + [f"{key}={value!r}" for key, value in self.kwargs.items()]
+        return f"{self.module}.{self.name}({', '.join(bound)})" if bound else f"{self.module}.{self.name}"
+
+
+class LazyMap(Mapping):
+    """
+    A mapping whose value for a key is built (once) by calling its factory on first access
+    """
+
+    def __init__(self, factories: Dict[str, Callable[[], Any]]):
+        self._factories = factories
+        self._values: Dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._values:
+            self._values[key] = self._factories[key]()
+        return self._values[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._factories)
+
+    def __len__(self) -> int:
+        return len(self._factories)
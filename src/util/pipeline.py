@@ -0,0 +1,172 @@
+"""
+Incremental runner for the stages of a pipeline
+
+A Stage is a command with declared inputs and outputs. Its key is a hash of the command and of its inputs:
+* files (code, configuration files, outputs of upstream stages), hashed by content, so that an upstream stage that
+  re-runs but produces the same outputs does not make its downstream stages stale
+* a JSON-serializable fingerprint of other inputs (e.g., the keys of the on-disk data cache, which cover the raw
+  data files and the code that loads them, see src/util/reliability_cache.py)
+The keys of the stages that completed are saved to STATE_FILE. A stage is stale if its key changed or one of its
+outputs is missing; only stale stages are run, after their dependencies, with up to n_jobs stages at once.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+
+STATE_FILE = "cache/pipeline/state.json"
+LOG_DIR = "cache/pipeline/logs"
+
+UP_TO_DATE = "up to date"
+STALE = "stale"
+RAN = "ran"
+FAILED = "failed"
+SKIPPED = "skipped (upstream failed)"
+
+
+class Stage(NamedTuple):
+    name: str
+    command: List[str]
+    outputs: List[str]
+    # files hashed by content (code, configuration, outputs of the stages in deps)
+    inputs: List[str] = []
+    # other inputs (e.g., data cache keys, task configuration), JSON-serializable
+    fingerprint: Any = None
+    # stages that must complete before this one
+    deps: List[str] = []
+
+
+# digests by (path, size, modification time), so that files read by several stages are only hashed once
+_DIGESTS: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_digest(path: str) -> Optional[str]:
+    """
+    :return: the sha256 of the contents of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _DIGESTS:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _DIGESTS[key] = digest.hexdigest()
+    return _DIGESTS[key]
+
+
+def stage_key(stage: Stage) -> str:
+    inputs = {path: file_digest(path) for path in sorted(set(stage.inputs))}
+    return hashlib.sha256(json.dumps([stage.command, stage.fingerprint, inputs], sort_keys=True,
+                                     default=str).encode()).hexdigest()[:16]
+
+
+class Pipeline:
+    """
+    Stages by name, in an order where every stage comes after its dependencies
+    """
+
+    def __init__(self, stages: Sequence[Stage], state_file: str = STATE_FILE, log_dir: str = LOG_DIR):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            missing = [dep for dep in stage.deps if dep not in self.stages]
+            assert not missing, f"unknown dependencies of {stage.name}: {missing}"
+        self.state_file = state_file
+        self.log_dir = log_dir
+        self.state: Dict[str, str] = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+
+    def select(self, patterns: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        The stages matching any of the (fnmatch) patterns, with everything they depend on, in order
+        """
+        names = list(self.stages) if not patterns else \
+            [name for name in self.stages if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+        selected: Set[str] = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.stages[name].deps)
+        return [name for name in self.stages if name in selected]
+
+    def is_stale(self, stage: Stage, key: str) -> bool:
+        return self.state.get(stage.name) != key or not all(os.path.exists(path) for path in stage.outputs)
+
+    def status(self, names: Sequence[str]) -> Dict[str, str]:
+        """
+        Whether each stage would run (stages downstream of a stale stage are reported stale, although they only
+        re-run if the outputs of the upstream stage change)
+        """
+        status = {}
+        for name in names:
+            stage = self.stages[name]
+            upstream_stale = any(status.get(dep) == STALE for dep in stage.deps)
+            status[name] = STALE if upstream_stale or self.is_stale(stage, stage_key(stage)) else UP_TO_DATE
+        return status
+
+    def _save_state(self):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_file)
+
+    def _run_stage(self, stage: Stage) -> Tuple[int, str]:
+        os.makedirs(self.log_dir, exist_ok=True)
+        log_path = os.path.join(self.log_dir, f"{stage.name.replace('/', '_')}.log")
+        with open(log_path, "w") as log:
+            returncode = subprocess.run(stage.command, stdout=log, stderr=subprocess.STDOUT).returncode
+        return returncode, log_path
+
+    def run(self, names: Sequence[str], n_jobs: int = 1, force: bool = False) -> Dict[str, str]:
+        """
+        Run the stale stages among `names` (which must include their dependencies), up to n_jobs at once
+        :param force: run all stages, even if they are up to date
+        :return: the status of each stage (RAN, UP_TO_DATE, FAILED or SKIPPED)
+        """
+        status: Dict[str, str] = {}
+        running: Dict[Future, Tuple[Stage, str]] = {}
+        waiting = list(names)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            while waiting or running:
+                for name in list(waiting):
+                    stage = self.stages[name]
+                    if any(status.get(dep) in {FAILED, SKIPPED} for dep in stage.deps):
+                        status[name] = SKIPPED
+                    elif all(status.get(dep) in {RAN, UP_TO_DATE} for dep in stage.deps):
+                        # upstream outputs are final, so the key can be computed
+                        key = stage_key(stage)
+                        if not force and not self.is_stale(stage, key):
+                            status[name] = UP_TO_DATE
+                        else:
+                            print(f"Running {name}")
+                            running[executor.submit(self._run_stage, stage)] = (stage, key)
+                    else:
+                        continue
+                    waiting.remove(name)
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, key = running.pop(future)
+                    returncode, log_path = future.result()
+                    if returncode == 0:
+                        status[stage.name] = RAN
+                        self.state[stage.name] = key
+                        self._save_state()
+                    else:
+                        status[stage.name] = FAILED
+                        print(f"{stage.name} failed (exit code {returncode}), see {log_path}")
+        return {name: status[name] for name in names}
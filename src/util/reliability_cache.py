@@ -0,0 +1,230 @@
+"""
+On-disk cache of reliability matrices and demographics maps
+
+Building a reliability matrix re-reads and re-parses the raw data files named in config/{dataset}.json.
+Built matrices (dense or sparse) are stored as .npz files (and demographics maps as .json files) under CACHE_DIR, keyed by
+a hash of:
+* the contents of the task's configuration file
+* the size and modification time of every data file it references
+* the source code of the package that builds the matrix (so that code changes invalidate the cache)
+
+Set the environment variable DISABLE_RELIABILITY_CACHE=1 to always rebuild.
+Use src/scripts/cache.py to inspect and evict cache entries.
+"""
+import glob
+import hashlib
+import inspect
+import json
+import os
+from functools import partial, wraps
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.util.lazy import LazyFunction
+from src.util.sparse_matrix import SparseReliabilityMatrix
+
+
+CACHE_DIR = "cache/reliability"
+CONFIG_FILE_FMT = "config/{dataset}.json"
+# bump to invalidate all entries if the storage format changes
+CACHE_FORMAT_VERSION = 1
+
+# code outside of the task packages used when building matrices
+SHARED_SOURCES = [os.path.join(os.path.dirname(__file__), "util.py"),
+                  os.path.join(os.path.dirname(__file__), "sparse_matrix.py"),
+                  os.path.join(os.path.dirname(__file__), "streaming.py"),
+                  os.path.join(os.path.dirname(__file__), os.pardir, "config", "data_columns.py")]
+
+MATRIX = "matrix"
+SPARSE_MATRIX = "sparse_matrix"
+DEMOGRAPHICS = "demographics"
+EXTENSIONS = {MATRIX: ".npz", SPARSE_MATRIX: ".npz", DEMOGRAPHICS: ".json"}
+
+
+class CacheEntry(NamedTuple):
+    task: str
+    kind: str
+    key: str
+    path: str
+    size: int
+    modified: float
+
+
+def _cache_enabled() -> bool:
+    return os.environ.get("DISABLE_RELIABILITY_CACHE", "0") in {"", "0"}
+
+
+def _source_files(config_file: str) -> List[str]:
+    with open(config_file) as f:
+        data_paths = json.load(f)["data_paths"]
+    paths = []
+    for path in data_paths.values():
+        if os.path.isdir(path):
+            paths.extend(sorted(p for p in glob.glob(os.path.join(path, "**"), recursive=True) if os.path.isfile(p)))
+        else:
+            paths.append(path)
+    return paths
+
+
+def _code_version(builder: Callable) -> str:
+    # hash of the source of the package defining the builder (e.g. all of src/tasks/wordsim)
+    while isinstance(builder, partial):
+        builder = builder.func
+    # lazy builders are located without importing them
+    source_file = builder.source_file() if isinstance(builder, LazyFunction) else inspect.getsourcefile(builder)
+    package_dir = os.path.dirname(source_file)
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(package_dir, "*.py"))) + SHARED_SOURCES:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_key(dataset: str, builder: Callable) -> str:
+    """
+    :raise FileNotFoundError: if the config file or one of its data files does not exist
+    """
+    config_file = CONFIG_FILE_FMT.format(dataset=dataset)
+    with open(config_file, "rb") as f:
+        config_hash = hashlib.sha256(f.read()).hexdigest()
+    sources = []
+    for path in _source_files(config_file):
+        stat = os.stat(path)
+        sources.append((path, stat.st_size, stat.st_mtime_ns))
+    components = [CACHE_FORMAT_VERSION, config_hash, sources, _code_version(builder)]
+    return hashlib.sha256(json.dumps(components).encode()).hexdigest()[:16]
+
+
+def _entry_path(task: str, kind: str, key: str) -> str:
+    return os.path.join(CACHE_DIR, task, f"{kind}-{key}{EXTENSIONS[kind]}")
+
+
+def _encode_labels(labels: pd.Index) -> Tuple[np.ndarray, str]:
+    # labels are stored without pickling; tuples (e.g., wordsim word pairs) are stored as a 2D array
+    values = labels.tolist()
+    if len(values) > 0 and all(isinstance(v, tuple) for v in values):
+        return np.array(values), "tuple"
+    array = np.asarray(values)
+    if array.dtype == object:
+        array = array.astype(str)
+    return array, "flat"
+
+
+def _decode_labels(array: np.ndarray, kind: str) -> list:
+    if kind == "tuple":
+        return [tuple(row) for row in array.tolist()]
+    return array.tolist()
+
+
+def _index_arrays(index: pd.Index, columns: pd.Index) -> Dict[str, np.ndarray]:
+    index_array, index_kind = _encode_labels(index)
+    columns_array, columns_kind = _encode_labels(columns)
+    return dict(index=index_array, columns=columns_array, kinds=np.array([index_kind, columns_kind]),
+                names=np.array([str(index.name), str(columns.name)]))
+
+
+def _load_indexes(data) -> Tuple[pd.Index, pd.Index]:
+    index_kind, columns_kind = data["kinds"].tolist()
+    index_name, columns_name = [None if n == "None" else n for n in data["names"].tolist()]
+    return (pd.Index(_decode_labels(data["index"], index_kind), name=index_name, tupleize_cols=False),
+            pd.Index(_decode_labels(data["columns"], columns_kind), name=columns_name, tupleize_cols=False))
+
+
+def _save_matrix(path: str, matrix: pd.DataFrame):
+    np.savez(path, values=matrix.to_numpy(), dtypes=np.array([str(dtype) for dtype in matrix.dtypes]),
+             **_index_arrays(matrix.index, matrix.columns))
+
+
+def _load_matrix(path: str) -> pd.DataFrame:
+    with np.load(path) as data:
+        values, dtypes = data["values"], data["dtypes"].tolist()
+        matrix = pd.DataFrame(values) if set(dtypes) <= {str(values.dtype)} else \
+            pd.DataFrame({i: values[:, i].astype(dtype) for i, dtype in enumerate(dtypes)})
+        matrix.index, matrix.columns = _load_indexes(data)
+        return matrix
+
+
+def _save_sparse_matrix(path: str, matrix: SparseReliabilityMatrix):
+    np.savez(path, indptr=matrix.indptr, item_codes=matrix.item_codes, labels=matrix.labels,
+             **_index_arrays(matrix.index, matrix.columns))
+
+
+def _load_sparse_matrix(path: str) -> SparseReliabilityMatrix:
+    with np.load(path) as data:
+        return SparseReliabilityMatrix(data["indptr"], data["item_codes"], data["labels"], *_load_indexes(data))
+
+
+def _save_demographics(path: str, demographics: Dict[str, Any]):
+    with open(path, "w") as f:
+        json.dump({dem: list(users) for dem, users in demographics.items()}, f)
+
+
+def _load_demographics(path: str) -> Dict[str, List[Any]]:
+    with open(path) as f:
+        return json.load(f)
+
+
+_SAVE = {MATRIX: _save_matrix, SPARSE_MATRIX: _save_sparse_matrix, DEMOGRAPHICS: _save_demographics}
+_LOAD = {MATRIX: _load_matrix, SPARSE_MATRIX: _load_sparse_matrix, DEMOGRAPHICS: _load_demographics}
+
+
+def cached(task: str, dataset: str, kind: str, builder: Callable) -> Callable:
+    """
+    Wrap a (no argument) reliability matrix or demographics builder with the on-disk cache
+    """
+    @wraps(builder)
+    def cached_builder():
+        if not _cache_enabled():
+            return builder()
+        try:
+            key = cache_key(dataset, builder)
+        except FileNotFoundError:
+            # let the builder report missing data
+            return builder()
+
+        path = _entry_path(task, kind, key)
+        if os.path.exists(path):
+            return _LOAD[kind](path)
+        result = builder()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that an interrupted write is never read back
+        tmp_path = f"{path}.{os.getpid()}.tmp{EXTENSIONS[kind]}"
+        _SAVE[kind](tmp_path, result)
+        os.replace(tmp_path, path)
+        return result
+
+    return cached_builder
+
+
+def cached_map(fn_map: Dict[str, Callable], task_datasets: Dict[str, str], kind: str) -> Dict[str, Callable]:
+    return {task: cached(task, task_datasets.get(task, task), kind, builder) for task, builder in fn_map.items()}
+
+
+def list_entries(task: Optional[str] = None) -> Iterator[CacheEntry]:
+    pattern = os.path.join(CACHE_DIR, task or "*", "*")
+    for path in sorted(glob.glob(pattern)):
+        entry_task = os.path.basename(os.path.dirname(path))
+        name, ext = os.path.splitext(os.path.basename(path))
+        if ".tmp" in name or "-" not in name:
+            continue
+        kind, key = name.split("-", 1)
+        stat = os.stat(path)
+        yield CacheEntry(entry_task, kind, key, path, stat.st_size, stat.st_mtime)
+
+
+def current_key(dataset: str, builder: Callable) -> Optional[str]:
+    try:
+        return cache_key(dataset, builder)
+    except FileNotFoundError:
+        return None
+
+
+def evict(entries: List[CacheEntry]):
+    for entry in entries:
+        os.remove(entry.path)
+        task_dir = os.path.dirname(entry.path)
+        if not os.listdir(task_dir):
+            os.rmdir(task_dir)
+
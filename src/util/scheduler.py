@@ -0,0 +1,74 @@
+"""
+Cost-balanced scheduling of per-annotator jobs on a multiprocessing pool
+
+The cost of computing an annotator's agreement grows with the number of items they annotated, which varies from a
+handful to hundreds within a task. Submitting the annotators of one demographic group at a time (one starmap per
+group) leaves the pool idle at the end of every group, and fixed-size chunks put cheap and expensive annotators in
+the same chunk. Instead, the jobs of all groups are:
+* sorted by estimated cost and packed into chunks of about the same total cost, so that the annotators of a chunk
+  have similar costs (the cost of the leave-one-out aggregates grows with the number of items; batched kernels pad
+  every row to the longest row of the matrix, so that their sums do not depend on the chunks, and cost the same for
+  every row)
+* submitted at once, largest chunks first (so the last chunks to finish are small), and streamed back with
+  imap_unordered as they complete
+Results are reassembled in the order of the jobs, so they do not depend on the number of processes.
+"""
+import os
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, Hashable, Iterator, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+
+# chunks per process: enough for the pool to balance the work, few enough to amortize the cost of a task
+DEFAULT_CHUNKS_PER_PROCESS = 4
+
+
+class Chunk(NamedTuple):
+    group: Hashable
+    rows: List[int]
+    cost: float
+
+
+def balanced_chunks(group_rows: Dict[Hashable, Sequence[int]], costs: np.ndarray, n_chunks: int) -> List[Chunk]:
+    """
+    Split the rows of each group into chunks of similar total cost
+    :param costs: estimated cost of each row (e.g., its number of annotations)
+    :param n_chunks: the number of chunks the total cost is divided into (groups may add a chunk each)
+    :return: the chunks, most expensive first
+    """
+    costs = np.asarray(costs, dtype=float)
+    total = sum(costs[np.asarray(rows, dtype=int)].sum() for rows in group_rows.values())
+    target = total / max(n_chunks, 1)
+    chunks = []
+    for group, rows in group_rows.items():
+        rows = np.asarray(rows, dtype=int)
+        # most expensive rows first, so that the rows of a chunk have similar costs
+        rows = rows[np.argsort(-costs[rows], kind="stable")]
+        start, cost = 0, 0.
+        for end, row in enumerate(rows, start=1):
+            cost += costs[row]
+            if cost >= target or end == len(rows):
+                chunks.append(Chunk(group, rows[start:end].tolist(), cost))
+                start, cost = end, 0.
+    return sorted(chunks, key=lambda chunk: -chunk.cost)
+
+
+def default_n_chunks() -> int:
+    # pools do not expose their size, so all cores are assumed to be used
+    return DEFAULT_CHUNKS_PER_PROCESS * (os.cpu_count() or 1)
+
+
+def _indexed(args: Tuple[Callable, int, Tuple]) -> Tuple[int, Any]:
+    fn, i, fn_args = args
+    return i, fn(*fn_args)
+
+
+def imap_balanced(mp_pool: Pool, fn: Callable, chunks: List[Chunk], job: Any) -> Iterator[Tuple[Chunk, Any]]:
+    """
+    Run fn(job, chunk.group, chunk.rows) for every chunk on the pool, in the given order
+    :return: (chunk, result) pairs, as they complete
+    """
+    tasks = [(fn, i, (job, chunk.group, chunk.rows)) for i, chunk in enumerate(chunks)]
+    for i, result in mp_pool.imap_unordered(_indexed, tasks):
+        yield chunks[i], result
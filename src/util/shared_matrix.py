@@ -0,0 +1,157 @@
+"""
+Share a reliability matrix with the processes of a multiprocessing pool
+
+The values of the matrix are published once to shared memory; workers are sent a small handle
+and attach to the same buffer without copying, rather than receiving a pickled DataFrame per task.
+Other representations than DataFrames (src/util/sparse_matrix.py, src/util/coded_matrix.py) are published as
+CSR arrays.
+
+Only the publishing process tracks the blocks (and unlinks them on close): workers attach without registering them
+with a resource tracker, which would otherwise report them as leaked (and try to unlink them again) when the worker
+exits. Workers close their attachments when they exit normally (e.g., after pool.close() and pool.join()).
+"""
+import os
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory, util
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from src.util.sparse_matrix import ReliabilityMatrix, SparseReliabilityMatrix, as_sparse
+
+
+class SharedMatrixHandle(NamedTuple):
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+class SharedSparseHandle(NamedTuple):
+    indptr: SharedMatrixHandle
+    item_codes: SharedMatrixHandle
+    labels: SharedMatrixHandle
+    shape: Tuple[int, int]
+
+    @property
+    def name(self) -> str:
+        return self.labels.name
+
+
+SharedHandle = Union[SharedMatrixHandle, SharedSparseHandle]
+
+
+class SharedReliabilityMatrix:
+    """
+    Owns the shared memory blocks for the values of a reliability matrix
+
+    Use as a context manager (or call close()) so that the blocks are released when done.
+    """
+
+    def __init__(self, reliability_matrix: ReliabilityMatrix):
+        self._shms: List[shared_memory.SharedMemory] = []
+        if isinstance(reliability_matrix, pd.DataFrame):
+            self.handle = self._publish(reliability_matrix.to_numpy(dtype=float))
+        else:
+            # other representations (e.g., coded matrices) are published in sparse form
+            sparse_matrix = as_sparse(reliability_matrix)
+            self.handle = SharedSparseHandle(self._publish(sparse_matrix.indptr),
+                                             self._publish(sparse_matrix.item_codes),
+                                             self._publish(sparse_matrix.labels), sparse_matrix.shape)
+
+    def _publish(self, values: np.ndarray) -> SharedMatrixHandle:
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+        self._shms.append(shm)
+        return SharedMatrixHandle(shm.name, values.shape, values.dtype.str)
+
+    def close(self):
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# shared memory blocks attached by this process, kept open so that arrays stay valid
+_ATTACHED: Dict[str, Tuple[shared_memory.SharedMemory, np.ndarray]] = {}
+# the process that registered the finalizer closing _ATTACHED (forked workers register their own)
+_FINALIZER_PID: Dict[str, int] = {}
+# serializes the patching of resource_tracker.register in _open_untracked
+_REGISTER_LOCK = threading.Lock()
+
+
+def _open_untracked(name: str) -> shared_memory.SharedMemory:
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before Python 3.13, SharedMemory always registers the block with the process's resource tracker, and there is
+    # no public way to prevent it. Registering and unregistering it afterwards would also drop the owner's
+    # registration when the worker shares the owner's tracker (a pool forked after the tracker started), so the
+    # module-level resource_tracker.register is patched while attaching: this relies on shared_memory calling it
+    # through the module (true up to 3.12). The patch only drops the registration of this block; other registrations
+    # (of other threads) are passed on, and the lock keeps concurrent attaches from restoring the wrong function.
+    with _REGISTER_LOCK:
+        register = resource_tracker.register
+
+        def register_others(resource_name: str, rtype: str):
+            if not (rtype == "shared_memory" and resource_name.lstrip("/") == name.lstrip("/")):
+                register(resource_name, rtype)
+
+        resource_tracker.register = register_others
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _close(shm: shared_memory.SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # views of the block are still referenced (e.g., by a worker's cached job); the mapping is released when
+        # the process exits
+        pass
+
+
+def _detach_all():
+    while _ATTACHED:
+        _, (shm, _) = _ATTACHED.popitem()
+        _close(shm)
+
+
+def _attach_array(handle: SharedMatrixHandle) -> np.ndarray:
+    if handle.name not in _ATTACHED:
+        if _FINALIZER_PID.get("pid") != os.getpid():
+            util.Finalize(None, _detach_all, exitpriority=0)
+            _FINALIZER_PID["pid"] = os.getpid()
+        shm = _open_untracked(handle.name)
+        values = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+        values.flags.writeable = False
+        _ATTACHED[handle.name] = (shm, values)
+    return _ATTACHED[handle.name][1]
+
+
+def attach(handle: SharedHandle) -> Union[np.ndarray, SparseReliabilityMatrix]:
+    """
+    Get a (read-only) view of a shared matrix from a worker process
+    Sparse matrices are indexed by position (annotator and item labels are not shared).
+    """
+    if isinstance(handle, SharedSparseHandle):
+        return SparseReliabilityMatrix(_attach_array(handle.indptr), _attach_array(handle.item_codes),
+                                       _attach_array(handle.labels), pd.RangeIndex(handle.shape[0]),
+                                       pd.RangeIndex(handle.shape[1]))
+    return _attach_array(handle)
+
+
+def detach(handle: SharedHandle):
+    handles = [handle.indptr, handle.item_codes, handle.labels] if isinstance(handle, SharedSparseHandle) else [handle]
+    for array_handle in handles:
+        shm, _ = _ATTACHED.pop(array_handle.name, (None, None))
+        if shm is not None:
+            _close(shm)
@@ -0,0 +1,161 @@
+"""
+Sparse (long-format) reliability matrices
+
+Crowdsourced annotators only label a small fraction of the items, so a dense annotators x items matrix is mostly
+NaN. A SparseReliabilityMatrix only stores the annotations, in CSR layout: for each annotator (row), the item codes
+(positions in `columns`) and labels of its annotations, in increasing item order. Memory scales with the number of
+annotations. `index` and `columns` have the same meaning as for the dense DataFrame.
+"""
+from typing import TYPE_CHECKING, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+if TYPE_CHECKING:
+    from src.util.coded_matrix import CodedReliabilityMatrix
+
+
+class SparseReliabilityMatrix:
+    """
+    Annotations of annotator `index[i]` are item_codes[indptr[i]:indptr[i + 1]] and labels[indptr[i]:indptr[i + 1]]
+    """
+
+    def __init__(self, indptr: np.ndarray, item_codes: np.ndarray, labels: np.ndarray, index: pd.Index,
+                 columns: pd.Index):
+        self.indptr = indptr
+        self.item_codes = item_codes
+        self.labels = labels
+        self.index = index
+        self.columns = columns
+
+    @staticmethod
+    def from_long(annotator_codes: np.ndarray, item_codes: np.ndarray, labels: np.ndarray, index: pd.Index,
+                  columns: pd.Index) -> "SparseReliabilityMatrix":
+        """
+        Build from annotations where annotators and items are given as integer codes (e.g., from pd.factorize)
+        into `index` and `columns`. If an annotator labeled an item more than once, the last label is kept (and the
+        annotation is dropped if that label is missing).
+        """
+        flat_idx = np.asarray(annotator_codes, dtype=np.int64) * len(columns) + item_codes
+        # np.unique sorts by (annotator, item); the first occurrence in reversed order is the last label
+        flat_idx, last_reversed = np.unique(flat_idx[::-1], return_index=True)
+        labels = np.asarray(labels, dtype=float)[::-1][last_reversed]
+        annotated = ~np.isnan(labels)
+        annotator_codes, item_codes = np.divmod(flat_idx[annotated], len(columns))
+        labels = labels[annotated]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(annotator_codes, minlength=len(index)))))
+        return SparseReliabilityMatrix(indptr, item_codes, labels, index, columns)
+
+    @staticmethod
+    def from_dense(reliability_matrix: Union[pd.DataFrame, np.ndarray]) -> "SparseReliabilityMatrix":
+        if isinstance(reliability_matrix, pd.DataFrame):
+            values, index, columns = reliability_matrix.to_numpy(dtype=float), reliability_matrix.index, \
+                reliability_matrix.columns
+        else:
+            values = np.asarray(reliability_matrix, dtype=float)
+            index, columns = pd.RangeIndex(values.shape[0]), pd.RangeIndex(values.shape[1])
+        annotated = ~np.isnan(values)
+        # nonzero is in row-major order, which is the CSR order
+        _, item_codes = np.nonzero(annotated)
+        indptr = np.concatenate(([0], np.cumsum(annotated.sum(axis=1))))
+        return SparseReliabilityMatrix(indptr, item_codes, values[annotated], index, columns)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.index), len(self.columns)
+
+    @property
+    def nnz(self) -> int:
+        return len(self.labels)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.item_codes.nbytes + self.labels.nbytes
+
+    def row_lengths(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def row_codes(self) -> np.ndarray:
+        """
+        The row of each annotation
+        """
+        return np.repeat(np.arange(len(self.index)), self.row_lengths())
+
+    def row(self, row: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (item codes, labels) of the annotations of a row
+        """
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.item_codes[start:end], self.labels[start:end]
+
+    def take(self, rows) -> "SparseReliabilityMatrix":
+        """
+        The matrix with only the given rows (in the given order)
+        """
+        rows = np.asarray(rows, dtype=int).reshape(-1)
+        positions = self.positions(rows)
+        return SparseReliabilityMatrix(np.concatenate(([0], np.cumsum(self.row_lengths()[rows]))),
+                                       self.item_codes[positions], self.labels[positions], self.index[rows],
+                                       self.columns)
+
+    def positions(self, rows) -> np.ndarray:
+        """
+        Positions (in item_codes and labels) of the annotations of the given rows, row by row
+        """
+        rows = np.asarray(rows, dtype=int).reshape(-1)
+        lengths = self.row_lengths()[rows]
+        starts = np.repeat(self.indptr[rows] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        return starts + np.arange(lengths.sum())
+
+    def padded(self, rows=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Annotations of the given rows (all rows by default) padded to the row with the most annotations
+        :return: (item codes, labels), both of shape (n_rows, max annotations per row); padding has item code 0
+            and a NaN label
+        """
+        matrix = self if rows is None else self.take(rows)
+        lengths = matrix.row_lengths()
+        width = max(int(lengths.max(initial=0)), 1)
+        row_codes = matrix.row_codes()
+        positions = np.arange(matrix.nnz) - matrix.indptr[row_codes]
+        items = np.zeros((len(lengths), width), dtype=int)
+        labels = np.full((len(lengths), width), np.nan)
+        items[row_codes, positions] = matrix.item_codes
+        labels[row_codes, positions] = matrix.labels
+        return items, labels
+
+    def sort_index(self) -> "SparseReliabilityMatrix":
+        """
+        The matrix with rows sorted by annotator, as DataFrame.sort_index
+        """
+        return self.take(self.index.argsort(kind="stable"))
+
+    def to_dense(self) -> pd.DataFrame:
+        values = np.full(self.shape, np.nan)
+        values[self.row_codes(), self.item_codes] = self.labels
+        return pd.DataFrame(values, index=self.index, columns=self.columns)
+
+
+ReliabilityMatrix = Union[pd.DataFrame, SparseReliabilityMatrix, "CodedReliabilityMatrix"]
+
+
+def as_sparse(values: Union[np.ndarray, ReliabilityMatrix]) -> SparseReliabilityMatrix:
+    """
+    :param values: a dense reliability matrix (DataFrame or values), a SparseReliabilityMatrix, or another
+        representation with a to_sparse() method (e.g., CodedReliabilityMatrix)
+    """
+    if isinstance(values, SparseReliabilityMatrix):
+        return values
+    if isinstance(values, (pd.DataFrame, np.ndarray)):
+        return SparseReliabilityMatrix.from_dense(values)
+    return values.to_sparse()
+
+
+def matrix_values(reliability_matrix: ReliabilityMatrix) -> Union[np.ndarray, ReliabilityMatrix]:
+    """
+    The values of a reliability matrix for the agreement and permutation engines, without densifying sparse or
+    coded matrices
+    """
+    if isinstance(reliability_matrix, pd.DataFrame):
+        return reliability_matrix.to_numpy(dtype=float)
+    return reliability_matrix
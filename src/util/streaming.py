@@ -0,0 +1,35 @@
+"""
+Chunked reading of large annotation CSV files
+
+Reading a whole export with pd.read_csv and filtering afterwards holds every column of every row at once, including
+free text that is discarded. read_csv_chunked only parses the needed columns and cleans (e.g. filters) each chunk
+before the next one is read, so peak memory is bounded by the size of the kept annotations plus one chunk.
+Filters that need all of the data (e.g. remove_inconsistent_gender_annotators) are applied to the result.
+"""
+from typing import Callable, Dict, Optional
+
+import pandas as pd
+
+
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def read_csv_chunked(path: str, col_mapping: Optional[Dict[str, str]] = None,
+                     clean_chunk: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+                     chunksize: int = DEFAULT_CHUNK_SIZE, **read_csv_kwargs) -> pd.DataFrame:
+    """
+    :param col_mapping: columns of the file to read (others are not parsed), renamed to their values. Columns of the
+        mapping that are not in the file are skipped. All columns are read if None.
+    :param clean_chunk: applied to each (renamed) chunk, before the chunks are concatenated
+    :param read_csv_kwargs: passed to pd.read_csv; pass the dtypes of the ID and label columns (by their names in the
+        file), as pandas otherwise infers the dtype of each chunk separately
+    :return: the cleaned chunks, with the row numbers of the file as index (as with a single pd.read_csv)
+    """
+    if col_mapping is not None:
+        read_csv_kwargs["usecols"] = lambda column: column in col_mapping
+    chunks = []
+    for chunk in pd.read_csv(path, chunksize=chunksize, **read_csv_kwargs):
+        if col_mapping is not None:
+            chunk = chunk.rename(columns=col_mapping)
+        chunks.append(chunk if clean_chunk is None else clean_chunk(chunk))
+    return pd.concat(chunks)